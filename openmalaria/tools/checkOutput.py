@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Sanity checks of survey output files: counts are non-negative, nPatent <=
+nInfect <= nHost, no unexpected NaN values, and all files have the same
+surveys.
+
+Each rule is evaluated as a numpy mask over the columns of a whole file;
+files are checked in parallel. Violating cells are listed and a summary can
+be written as JSON.
+"""
+
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import unittest
+from optparse import OptionParser
+
+import numpy
+
+from openmalaria.tools.readOutput import decodeGroups, packKeys, readColumns
+
+# Measures which are counts of hosts, events or deployments
+countMeasures = [0, 1, 3, 6, 8, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 22, 23, 24, 25,
+                 27, 39, 41, 42, 43, 44, 45, 46, 47, 48, 50, 51, 52, 53, 54, 55, 56, 57,
+                 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 69, 70, 72]
+
+# Pairs (a, b) of measures such that a <= b in every cell: nPatent <= nInfect <= nHost
+orderedMeasures = [(3, 1), (1, 0)]
+
+# Ratio measures, which are NaN when their denominator is zero (e.g. annAvgK
+# and kappaPerDayOfYear without any inoculations); NaN values of these are not
+# reported
+nanMeasures = [21, 26, 29]
+
+def checkNonNegative(m, s, g, v):
+    """Rows with a negative count."""
+    return numpy.flatnonzero(numpy.isin(m, countMeasures) & (v < 0))
+
+def checkNaN(m, s, g, v):
+    """Rows with a NaN value."""
+    return numpy.flatnonzero(numpy.isnan(v) & ~numpy.isin(m, nanMeasures))
+
+def checkOrdered(m, s, g, v):
+    """Rows of measure a with a larger value than measure b in the same
+    survey and group, for each pair in orderedMeasures."""
+    r = list()
+    cell = packKeys(0, s, g)
+    for a, b in orderedMeasures:
+        rowsA = numpy.flatnonzero(m == a)
+        rowsB = numpy.flatnonzero(m == b)
+        common, iA, iB = numpy.intersect1d(cell[rowsA], cell[rowsB], return_indices=True)
+        bad = v[rowsA[iA]] > v[rowsB[iB]]
+        r.append(rowsA[iA[bad]])
+    return numpy.concatenate(r) if r else numpy.empty(0, dtype=numpy.intp)
+
+# Rules applied to each file; 'surveys' (same surveys in all files) is
+# checked across files.
+rules = collections.OrderedDict([
+    ('nonNegative', checkNonNegative),
+    ('order', checkOrdered),
+    ('nan', checkNaN),
+])
+
+def checkRuleNames(ruleNames):
+    """Raise ValueError if any of ruleNames is not a rule or 'surveys'."""
+    unknown = [name for name in ruleNames if name not in rules and name != 'surveys']
+    if unknown:
+        raise ValueError("unknown rule(s): " + ", ".join(unknown) + " (valid rules: " +
+                         ", ".join(list(rules.keys()) + ['surveys']) + ")")
+
+def checkFile(fileName, ruleNames=None, maxCells=100, useCache=False):
+    """Apply rules to fileName. Return a dict with the number of violations
+    per rule ('counts'), up to maxCells violating cells per rule ('cells', as
+    lists [rule, measure, survey, group, cohort, genotype, value], where
+    values which are not finite are given as strings such as 'nan') and the
+    sorted survey numbers ('surveys'). Parsed columns are only cached (see
+    readOutput.columnCache) if useCache is set. Raises ValueError if
+    ruleNames includes an unknown rule."""
+    checkRuleNames(ruleNames or [])
+    cols = readColumns(fileName, useCache=useCache)
+    m, s, g, v = cols['m'], cols['s'], cols['g'], cols['v']
+    r = {'file': fileName, 'counts': dict(), 'cells': list(),
+         'surveys': numpy.unique(s[m != 21]).tolist()}
+    for name in (ruleNames or rules.keys()):
+        if name == 'surveys':
+            continue    # checked across files by checkFiles
+        rows = numpy.sort(rules[name](m, s, g, v))
+        r['counts'][name] = len(rows)
+        rows = rows[:maxCells]
+        grp, coh, gt = decodeGroups(g[rows])
+        vals = [x if numpy.isfinite(x) else repr(x) for x in v[rows].tolist()]
+        for x in zip(m[rows].tolist(), s[rows].tolist(), grp.tolist(), coh.tolist(), gt.tolist(), vals):
+            r['cells'].append([name] + list(x))
+    return r
+
+def checkFiles(fileNames, ruleNames=None, maxCells=100, workers=None, useCache=False):
+    """Check each of fileNames (in up to workers processes) and return a
+    summary: total violations per rule, per-file results of files with
+    violations, and files whose surveys differ from the most common set.
+    Raises ValueError if ruleNames includes an unknown rule."""
+    ruleNames = ruleNames or list(rules.keys()) + ['surveys']
+    checkRuleNames(ruleNames)
+    args = (fileNames, [ruleNames] * len(fileNames), [maxCells] * len(fileNames), [useCache] * len(fileNames))
+    if workers == 1 or len(fileNames) == 1:
+        results = list(map(checkFile, *args))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(checkFile, *args, chunksize=max(1, len(fileNames) // 64)))
+
+    totals = collections.OrderedDict((name, 0) for name in ruleNames)
+    if 'surveys' in ruleNames and results:
+        common = collections.Counter(tuple(r['surveys']) for r in results).most_common(1)[0][0]
+        for r in results:
+            if tuple(r['surveys']) != common:
+                r['counts']['surveys'] = 1
+                r['cells'].append(['surveys', None, len(r['surveys']), None, None, None, len(common)])
+    files = list()
+    for r in results:
+        for name, n in r['counts'].items():
+            totals[name] += n
+        if any(r['counts'].values()):
+            files.append({'file': r['file'], 'counts': r['counts'], 'cells': r['cells']})
+    return {'files': len(fileNames), 'filesWithViolations': len(files),
+            'violations': totals, 'details': files}
+
+def writeReport(summary, out):
+    """Print violating cells as tab-separated lines, then totals."""
+    out.write("file\trule\tmeasure\tsurvey\tgroup\tcohort\tgenotype\tvalue\n")
+    for f in summary['details']:
+        for cell in f['cells']:
+            out.write(f['file'] + "\t" + "\t".join(str(x) for x in cell) + "\n")
+    for name, n in summary['violations'].items():
+        out.write("# " + name + ": " + str(n) + " violations\n")
+    out.write("# " + str(summary['filesWithViolations']) + " of " + str(summary['files']) +
+              " files have violations\n")
+
+class TestCheckOutput (unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        good = "1\t1\t0\t100\n1\t1\t1\t20\n1\t1\t3\t10\n2\t1\t0\t100\n2\t1\t1\t5\n2\t1\t3\t5\n"
+        bad = "1\t1\t0\t100\n1\t1\t1\t20\n1\t1\t3\t30\n1\t1\t14\t-1\n1\t1\t5\tnan\n1\t1\t26\tnan\n"
+        self.files = list()
+        for i, text in enumerate((good, good, bad)):
+            name = os.path.join(self.dir.name, "out" + str(i) + ".txt")
+            with open(name, 'w') as f:
+                f.write(text)
+            self.files.append(name)
+    def tearDown(self):
+        self.dir.cleanup()
+    def testRules (self):
+        r = checkFile(self.files[2])
+        self.assertEqual (r['counts'], {'nonNegative': 1, 'order': 1, 'nan': 1})
+        self.assertEqual (r['cells'][1], ['order', 3, 1, 1, 0, 0, 30.0])
+        self.assertEqual (r['surveys'], [1])
+        self.assertEqual (checkFile(self.files[0])['counts'], {'nonNegative': 0, 'order': 0, 'nan': 0})
+        self.assertEqual (checkFile(self.files[2], ['nan', 'surveys'])['counts'], {'nan': 1})
+        with self.assertRaises (ValueError):
+            checkFile(self.files[0], ['nan', 'order2'])
+        with self.assertRaises (ValueError):
+            checkFiles(self.files, ['nonNegativ'])
+        with self.assertRaises (SystemExit):
+            main(['checkOutput', '-r', 'nan,bogus'] + self.files)
+    def testSummary (self):
+        summary = checkFiles(self.files, workers=2)
+        self.assertEqual (summary['violations'], {'nonNegative': 1, 'order': 1, 'nan': 1, 'surveys': 1})
+        self.assertEqual ([f['file'] for f in summary['details']], [self.files[2]])
+        def noConstants(name):
+            raise ValueError("not JSON: " + name)
+        out = os.path.join(self.dir.name, 'bad.json')
+        self.assertEqual (main(['checkOutput', '-j', '1', '-o', out] + self.files), 1)
+        with open(out) as f:
+            cells = json.loads(f.read(), parse_constant=noConstants)['details'][0]['cells']
+        self.assertTrue (['nan', 5, 1, 1, 0, 0, 'nan'] in cells)
+        self.assertEqual (main(['checkOutput', '-j', '1', '-o', os.path.join(self.dir.name, 's.json')] +
+                               self.files[:2]), 0)
+
+def main(args):
+    parser = OptionParser(usage="Usage: %prog [options] FILES",
+            description="Check OpenMalaria survey output files for impossible "
+            "values: negative counts, nPatent > nInfect or nInfect > nHost, NaN "
+            "values and surveys differing between files. Violating cells are "
+            "printed; the exit status is 1 if there are any.")
+    parser.add_option("-o", "--summary", action="store", type="string", dest="summary", default=None,
+            help="Write a JSON summary of the results to this file ('-' for standard output)")
+    parser.add_option("-r", "--rules", action="store", type="string", dest="rules", default=None,
+            help="Comma-separated list of rules to check (default: all of " +
+                 ", ".join(list(rules.keys()) + ['surveys']) + ")")
+    parser.add_option("-n", "--max-cells", action="store", type="int", dest="maxCells", default=100,
+            help="Report at most this many cells per rule and file (default: 100)")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=None,
+            help="Number of processes used to check files (default: one per CPU)")
+    parser.add_option("--cache", action="store_true", dest="cache", default=False,
+            help="Use and fill the cache of parsed output files (off by default, since "
+                 "checking many files would evict everything else from it)")
+    (options, others) = parser.parse_args(args=args[1:])
+    if len(others) == 0:
+        parser.print_usage()
+        return 1
+
+    ruleNames = options.rules.split(',') if options.rules else None
+    try:
+        checkRuleNames(ruleNames or [])
+    except ValueError as e:
+        parser.error(str(e))
+    summary = checkFiles(others, ruleNames, options.maxCells, options.jobs, options.cache)
+    if options.summary == '-':
+        json.dump(summary, sys.stdout, indent=1, allow_nan=False)
+    else:
+        writeReport(summary, sys.stdout)
+        if options.summary is not None:
+            with open(options.summary, 'w') as f:
+                json.dump(summary, f, indent=1, allow_nan=False)
+    return 1 if summary['filesWithViolations'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Derived measures: indicators computed from the measures in a ValDict, such
+as prevalence (nPatent / nHost), defined by expressions like 'm3 / m0'.
+
+Expressions are evaluated with numpy over whole arrays of each measure
+(indexed by [file, survey, group, cohort, genotype], see ValDict.toArray),
+after aggregation. The results can be stored back into the ValDict as new
+measures (numbered from firstNumber), which then plot like any other.
+"""
+
+import ast
+import operator
+import unittest
+from io import StringIO
+
+import numpy
+
+from openmalaria.tools.readOutput import Keys, ValDict
+
+# Derived measures are numbered from here, above all OpenMalaria measures.
+firstNumber = 100
+
+# Predefined derived measures: name, expression, description
+builtins = [
+    ('prevalence', 'm3 / m0', 'patent hosts per host'),
+    ('infectionPrevalence', 'm1 / m0', 'infected hosts per host'),
+    ('uncompPerPerson', 'm14 / m0', 'uncomplicated episodes per host per survey period'),
+    ('severePerPerson', 'm15 / m0', 'severe episodes per host per survey period'),
+    ('caseFatality', 'm19 / m15', 'direct deaths per severe episode'),
+    ('hospitalCaseFatality', 'm17 / m13', 'in-hospital deaths per hospital treatment'),
+]
+
+class DerivedMeasure(object):
+    """A named expression over measures. Measures are written mN (e.g. m3)
+    or by any name in the dict names (name to measure number); the
+    operators + - * / ** and functions in Engine.functions may be used."""
+    def __init__(self, number, name, expr, names=None):
+        self.number = number
+        self.name = name
+        self.expr = expr
+        self.names = names or dict()
+        self.tree = ast.parse(expr, mode='eval').body
+        self.operands = set()
+        self.check(self.tree)
+        if not self.operands:
+            raise Exception("derived measure " + name + " uses no measures: " + expr)
+
+    def measureOf(self, name):
+        """Measure number referred to by name, or None."""
+        if name in self.names:
+            return self.names[name]
+        if name[:1] == 'm' and name[1:].isdigit():
+            return int(name[1:])
+        return None
+
+    def check(self, node):
+        """Raise an exception unless node is a supported expression; collect
+        the measures used."""
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return
+        if isinstance(node, ast.Name):
+            m = self.measureOf(node.id)
+            if m is None:
+                raise Exception("unknown measure " + node.id + " in " + self.expr)
+            self.operands.add(m)
+            return
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            self.check(node.operand)
+            return
+        if isinstance(node, ast.BinOp) and type(node.op) in Engine.binOps:
+            self.check(node.left)
+            self.check(node.right)
+            return
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and \
+                node.func.id in Engine.functions and not node.keywords:
+            for x in node.args:
+                self.check(x)
+            return
+        raise Exception("unsupported expression in derived measure " + self.name + ": " + self.expr)
+
+class Engine(object):
+    """Evaluates derived measures over a ValDict. Intermediate results (the
+    padded arrays of each measure and of each sub-expression) are cached, so
+    that e.g. m0 is fetched once for several ratios over it."""
+    binOps = {
+        ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+        ast.Div: operator.truediv, ast.Pow: operator.pow,
+    }
+    functions = {
+        'abs': numpy.abs, 'sqrt': numpy.sqrt, 'log': numpy.log, 'exp': numpy.exp,
+        'minimum': numpy.fmin, 'maximum': numpy.fmax, 'where': numpy.where,
+    }
+
+    def __init__(self, values, definitions=()):
+        self.values = values
+        self.definitions = dict((d.number, d) for d in definitions)
+        self.cache = dict()
+
+    def shapeOf(self, m):
+        if m in self.definitions:
+            d = self.definitions[m]
+            return self.commonShape(d.operands)
+        if m not in self.values.measures:
+            raise KeyError("measure " + str(m) + " was not read")
+        return self.values.toArray(m).shape
+
+    def commonShape(self, measures):
+        shapes = [self.shapeOf(m) for m in sorted(measures)]
+        return tuple(max(n) for n in zip(*shapes))
+
+    def measure(self, m, shape):
+        """Array of measure m padded with NaN to shape."""
+        key = (m, shape)
+        if key not in self.cache:
+            if m in self.definitions:
+                a = self.compute(self.definitions[m])
+            else:
+                a = self.values.toArray(m)
+            if a.shape != shape:
+                padded = numpy.full(shape, numpy.nan)
+                padded[tuple(slice(0, n) for n in a.shape)] = a
+                a = padded
+            self.cache[key] = a
+        return self.cache[key]
+
+    def evaluate(self, node, d, shape):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return self.measure(d.measureOf(node.id), shape)
+        key = (ast.dump(node), shape)
+        if key in self.cache:
+            return self.cache[key]
+        if isinstance(node, ast.UnaryOp):
+            r = self.evaluate(node.operand, d, shape)
+            if isinstance(node.op, ast.USub):
+                r = -r
+        elif isinstance(node, ast.BinOp):
+            r = self.binOps[type(node.op)](self.evaluate(node.left, d, shape),
+                                           self.evaluate(node.right, d, shape))
+        else:
+            r = self.functions[node.func.id](*[self.evaluate(x, d, shape) for x in node.args])
+        self.cache[key] = r
+        return r
+
+    def compute(self, d):
+        """Return the values of derived measure d, indexed like
+        ValDict.toArray. Cells which are undefined (e.g. division by zero)
+        are NaN."""
+        shape = self.commonShape(d.operands)
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            r = numpy.array(numpy.broadcast_to(self.evaluate(d.tree, d, shape), shape), dtype=numpy.float64)
+        r[~numpy.isfinite(r)] = numpy.nan
+        return r
+
+def parseSpecs(specs, measureNames):
+    """Turn a list of specifications, each either the name of a builtin or
+    'name=expression', into DerivedMeasures numbered from firstNumber.
+    Expressions may refer to measures by the names in measureNames (a dict
+    of number to name, like plotResult.measureNames) and to derived measures
+    defined earlier in the list."""
+    known = dict((name, expr) for name, expr, desc in builtins)
+    names = dict((name, m) for m, name in measureNames.items())
+    r = list()
+    for spec in specs:
+        if '=' in spec and spec.split('=', 1)[0].strip().isidentifier():
+            name, expr = [x.strip() for x in spec.split('=', 1)]
+        elif spec in known:
+            name, expr = spec, known[spec]
+        else:
+            raise Exception("unknown derived measure '" + spec + "' (use NAME=EXPRESSION or one of: " +
+                            ", ".join(known) + ")")
+        if name in names:
+            raise Exception("derived measure name " + name + " is already used")
+        d = DerivedMeasure(firstNumber + len(r), name, expr, dict(names))
+        names[name] = d.number
+        r.append(d)
+    return r
+
+def operandsOf(derived):
+    """Measures read from output files which are needed to compute all of
+    derived (not including other derived measures)."""
+    numbers = set(d.number for d in derived)
+    r = set()
+    for d in derived:
+        r |= d.operands - numbers
+    return r
+
+def derive(values, derived, source=None):
+    """Compute each of derived from the measures in ValDict source (default:
+    values) and store them in values."""
+    source = values if source is None else source
+    engine = Engine(source, derived)
+    for d in derived:
+        label = None
+        first = min(d.operands)
+        if first in source.measures:
+            label = source.getGroupLabel(first)
+        values.setArray(d.number, engine.compute(d), label)
+
+class TestDerived (unittest.TestCase):
+    def setUp(self):
+        text = ("1\t0\t0\t100\n1\t0\t3\t20\n1\t1\t0\t50\n1\t1\t3\t0\n"
+                "2\t0\t0\t100\n2\t0\t3\t10\n2\t1\t0\t0\n2\t1\t3\t0\n"
+                "1\t0\t15\t4\n1\t0\t19\t1\n")
+        self.values = ValDict(set([Keys.MEASURE, Keys.SURVEY, Keys.GROUP]))
+        self.values.read(StringIO(text), "True", False)
+    def testBuiltin (self):
+        derived = parseSpecs(['prevalence', 'caseFatality'], {0: 'nHost', 3: 'nPatent'})
+        derive(self.values, derived)
+        self.assertEqual ([d.number for d in derived], [100, 101])
+        a = self.values.getArray(100, (Keys.SURVEY, Keys.GROUP))
+        numpy.testing.assert_array_equal (a, [[0.2, 0.0], [0.1, numpy.nan]])
+        self.assertEqual (self.values.get(101, 1, 0, 0, 0, 0), 0.25)
+        self.assertTrue (numpy.isnan(self.values.get(101, 2, 0, 0, 0, 0)))
+    def testNamesAndChaining (self):
+        derived = parseSpecs(['p=nPatent / nHost', 'pct = 100 * p', 'r=maximum(m3, 1) / m0'],
+                             {0: 'nHost', 3: 'nPatent'})
+        self.assertEqual (operandsOf(derived), set([0, 3]))
+        engine = Engine(self.values, derived)
+        numpy.testing.assert_allclose (engine.compute(derived[1])[0, 1:, 0, 0, 0], [20.0, 10.0])
+        self.assertTrue ((0, (1, 3, 2, 1, 1)) in engine.cache)
+        self.assertTrue ((100, (1, 3, 2, 1, 1)) in engine.cache)
+        numpy.testing.assert_allclose (engine.compute(derived[2])[0, 1:, 0, 0, 0], [0.2, 0.1])
+    def testErrors (self):
+        self.assertRaises (Exception, parseSpecs, ['unknown'], {})
+        self.assertRaises (Exception, parseSpecs, ['x=nFoo / m0'], {})
+        self.assertRaises (Exception, parseSpecs, ['x=m3.real'], {})
+        self.assertRaises (Exception, parseSpecs, ['x=2 * 3'], {})
+        self.assertRaises (KeyError, derive, self.values, parseSpecs(['x=m7 / m0'], {}))
+
+if __name__ == '__main__':
+    unittest.main()
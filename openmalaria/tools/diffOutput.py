@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Numeric comparison of survey output files, e.g. outputs of the same
+scenarios from two versions of OpenMalaria.
+
+Usage: diffOutput.py OLD NEW, where OLD and NEW are files or directories
+(files with the same relative path are compared). See --help.
+
+Entries are aligned on (measure, survey, group code) by joining the sorted
+packed keys of each file (see readOutput.Entries); values are compared with
+per-measure absolute and relative tolerances as in numpy.isclose. Pairs of
+files are compared in parallel.
+"""
+
+import concurrent.futures
+import fnmatch
+import json
+import os
+import sys
+import tempfile
+import unittest
+from io import StringIO
+from optparse import OptionParser
+
+import numpy
+
+from openmalaria.tools.readOutput import decodeGroups, readEntries, unpackKeys
+
+class Tolerances(object):
+    """Absolute and relative tolerance per measure, with defaults for
+    measures not listed."""
+    def __init__(self, atol=0.0, rtol=1e-9):
+        self.atol = atol
+        self.rtol = rtol
+        self.perMeasure = dict()
+
+    def set(self, m, atol, rtol):
+        self.perMeasure[m] = (atol, rtol)
+
+    def arrays(self, m):
+        """Return (atol, rtol) arrays for an array of measures m."""
+        n = max(self.perMeasure.keys(), default=0) + 1
+        atol = numpy.full(n, self.atol)
+        rtol = numpy.full(n, self.rtol)
+        for k, (a, r) in self.perMeasure.items():
+            atol[k] = a
+            rtol[k] = r
+        i = numpy.minimum(m, n - 1)
+        inTable = m < n
+        return (numpy.where(inTable, atol[i], self.atol), numpy.where(inTable, rtol[i], self.rtol))
+
+    @staticmethod
+    def parse(spec, tol=None):
+        """Parse 'M:ATOL:RTOL' and add it to tol (a new Tolerances if None)."""
+        tol = tol or Tolerances()
+        parts = spec.split(':')
+        if len(parts) != 3:
+            raise ValueError("tolerance should be MEASURE:ATOL:RTOL, not " + spec)
+        tol.set(int(parts[0]), float(parts[1]), float(parts[2]))
+        return tol
+
+def cellsOf(keys, old, new):
+    """List [measure, survey, group, cohort, genotype, old, new] for packed
+    keys. Values which are not finite are given as strings ('nan', 'inf' or
+    '-inf'), so that results can be written as strict JSON."""
+    m, s, code = unpackKeys(keys)
+    g, c, gt = decodeGroups(code)
+    old = [x if numpy.isfinite(x) else repr(x) for x in old.tolist()]
+    new = [x if numpy.isfinite(x) else repr(x) for x in new.tolist()]
+    return [list(x) for x in zip(m.tolist(), s.tolist(), g.tolist(), c.tolist(), gt.tolist(), old, new)]
+
+def largest(x):
+    """Largest finite value of x, or None if there is none."""
+    x = x[numpy.isfinite(x)]
+    return float(x.max()) if len(x) else None
+
+def diffFiles(oldName, newName, tol=None, maxCells=20, useCache=False):
+    """Compare two output files. Return a dict with counts of entries
+    compared, differing and present in only one file, the largest absolute
+    and relative differences (None if no differing cell has a finite one;
+    cells with a new value of 0 have no relative difference), and up to
+    maxCells differing cells (as lists [measure, survey, group, cohort,
+    genotype, old, new], with None for a missing value). Parsed columns are
+    only cached (see readOutput.columnCache) if useCache is set."""
+    tol = tol or Tolerances()
+    a = readEntries(oldName, useCache)
+    b = readEntries(newName, useCache)
+    common, iA, iB = numpy.intersect1d(a.packed, b.packed, assume_unique=True, return_indices=True)
+    va = a.vals[iA]
+    vb = b.vals[iB]
+    m = unpackKeys(common)[0]
+    atol, rtol = tol.arrays(m)
+    bothNaN = numpy.isnan(va) & numpy.isnan(vb)
+    with numpy.errstate(invalid='ignore'):
+        delta = numpy.abs(va - vb)
+        differ = ~bothNaN & ~(delta <= atol + rtol * numpy.abs(vb))
+    onlyOld = numpy.setdiff1d(a.packed, common, assume_unique=True)
+    onlyNew = numpy.setdiff1d(b.packed, common, assume_unique=True)
+    hasRel = differ & (vb != 0)
+    rel = delta[hasRel] / numpy.abs(vb[hasRel])
+    r = {'old': oldName, 'new': newName, 'compared': len(common),
+         'differ': int(differ.sum()), 'onlyOld': len(onlyOld), 'onlyNew': len(onlyNew),
+         'maxAbs': largest(delta[differ]), 'maxRel': largest(rel),
+         'measures': sorted(set(m[differ].tolist())), 'cells': list()}
+    rows = numpy.flatnonzero(differ)[:maxCells]
+    r['cells'] += cellsOf(common[rows], va[rows], vb[rows])
+    n = max(0, maxCells - len(rows))
+    for cell in cellsOf(onlyOld[:n], a.lookup(*unpackKeys(onlyOld[:n])), numpy.full(len(onlyOld[:n]), numpy.nan)):
+        r['cells'].append(cell[:6] + [None])
+    n = max(0, maxCells - len(r['cells']))
+    for cell in cellsOf(onlyNew[:n], numpy.full(len(onlyNew[:n]), numpy.nan), b.lookup(*unpackKeys(onlyNew[:n]))):
+        r['cells'].append(cell[:5] + [None, cell[6]])
+    return r
+
+def filePairs(old, new, pattern='output.txt*'):
+    """Pairs of files to compare, plus lists of files only under old and
+    only under new. If old and new are directories, files whose names match
+    pattern (see fnmatch) are matched by relative path; others are
+    ignored."""
+    if not (os.path.isdir(old) and os.path.isdir(new)):
+        return [(old, new)], [], []
+    def walk(top):
+        r = set()
+        for d, dirs, files in os.walk(top):
+            for f in fnmatch.filter(files, pattern):
+                r.add(os.path.relpath(os.path.join(d, f), top))
+        return r
+    a = walk(old)
+    b = walk(new)
+    pairs = [(os.path.join(old, f), os.path.join(new, f)) for f in sorted(a & b)]
+    return pairs, sorted(a - b), sorted(b - a)
+
+def diffPairs(pairs, tol=None, maxCells=20, workers=None, useCache=False):
+    """Compare each (old, new) pair of files in up to workers processes;
+    return the results of diffFiles for pairs which differ, and the number
+    of pairs which are equal."""
+    n = len(pairs)
+    args = ([p[0] for p in pairs], [p[1] for p in pairs], [tol] * n, [maxCells] * n, [useCache] * n)
+    if workers == 1 or n <= 1:
+        results = map(diffFiles, *args)
+        return summarise(results)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return summarise(pool.map(diffFiles, *args, chunksize=max(1, n // 64)))
+
+def summarise(results):
+    differing = list()
+    equal = 0
+    for r in results:
+        if r['differ'] or r['onlyOld'] or r['onlyNew']:
+            differing.append(r)
+        else:
+            equal += 1
+    return differing, equal
+
+def writeReport(differing, equal, onlyOld, onlyNew, out):
+    """Print a compact report: one line per differing pair, followed by its
+    differing cells, then totals."""
+    for r in differing:
+        out.write(r['old'] + " vs " + r['new'] + ": " + str(r['differ']) + " of " + str(r['compared']) +
+                  " differ (max abs " + repr(r['maxAbs']) + ", max rel " + repr(r['maxRel']) +
+                  "; measures " + ",".join(str(m) for m in r['measures']) + "), " +
+                  str(r['onlyOld']) + " only old, " + str(r['onlyNew']) + " only new\n")
+        for cell in r['cells']:
+            out.write("\tm=" + str(cell[0]) + " s=" + str(cell[1]) + " g=" + str(cell[2]) +
+                      " c=" + str(cell[3]) + " gt=" + str(cell[4]) + ": " + str(cell[5]) + " -> " + str(cell[6]) + "\n")
+    for f in onlyOld:
+        out.write("only in old: " + f + "\n")
+    for f in onlyNew:
+        out.write("only in new: " + f + "\n")
+    out.write("# " + str(len(differing)) + " pairs differ, " + str(equal) + " equal, " +
+              str(len(onlyOld)) + " only in old, " + str(len(onlyNew)) + " only in new\n")
+
+class TestDiffOutput (unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        for d, text in (('old', "1\t0\t0\t100\n1\t0\t3\t10\n2\t0\t3\t11\n2\t0\t14\t1\n"),
+                        ('new', "1\t0\t0\t100\n1\t0\t3\t10.5\n2\t0\t3\t11.0000000001\n3\t0\t0\t5\n")):
+            os.mkdir(os.path.join(self.dir.name, d))
+            for name in ('output.txt', d + '.txt', 'scenario.xml'):
+                with open(os.path.join(self.dir.name, d, name), 'w') as f:
+                    f.write(text)
+        self.old = os.path.join(self.dir.name, 'old')
+        self.new = os.path.join(self.dir.name, 'new')
+    def tearDown(self):
+        self.dir.cleanup()
+    def testDiff (self):
+        r = diffFiles(os.path.join(self.old, 'output.txt'), os.path.join(self.new, 'output.txt'))
+        self.assertEqual ((r['compared'], r['differ'], r['onlyOld'], r['onlyNew']), (3, 1, 1, 1))
+        self.assertEqual (r['cells'], [[3, 1, 0, 0, 0, 10.0, 10.5], [14, 2, 0, 0, 0, 1.0, None],
+                                       [0, 3, 0, 0, 0, None, 5.0]])
+        self.assertAlmostEqual (r['maxRel'], 0.5 / 10.5)
+        tol = Tolerances.parse('3:0.5:0')
+        self.assertEqual (diffFiles(os.path.join(self.old, 'output.txt'), os.path.join(self.new, 'output.txt'), tol)['differ'], 0)
+        with open(os.path.join(self.new, 'output.txt'), 'a') as f:
+            f.write("1\t0\t14\t0\n2\t0\t0\tnan\n")
+        with open(os.path.join(self.old, 'output.txt'), 'a') as f:
+            f.write("1\t0\t14\t3\n2\t0\t0\t7\n")
+        r = diffFiles(os.path.join(self.old, 'output.txt'), os.path.join(self.new, 'output.txt'))
+        self.assertEqual ((r['differ'], r['maxAbs']), (3, 3.0))
+        self.assertAlmostEqual (r['maxRel'], 0.5 / 10.5)
+        self.assertEqual (r['cells'][0], [0, 2, 0, 0, 0, 7.0, 'nan'])
+        summary = os.path.join(self.dir.name, 's.json')
+        self.assertEqual (main(['diffOutput', '-q', '-o', summary, self.old, self.new]), 1)
+        with open(summary) as f:
+            self.assertEqual (json.load(f)['differing'][0]['maxRel'], r['maxRel'])
+        r = diffFiles(StringIO("1\t0\t14\t3\n"), StringIO("1\t0\t14\t0\n"))
+        self.assertEqual ((r['differ'], r['maxRel']), (1, None))
+    def testPairs (self):
+        self.assertEqual (filePairs(self.old, self.new)[1:], ([], []))
+        pairs, onlyOld, onlyNew = filePairs(self.old, self.new, '*.txt')
+        self.assertEqual ((len(pairs), onlyOld, onlyNew), (1, ['old.txt'], ['new.txt']))
+        differing, equal = diffPairs(pairs + pairs, workers=2)
+        self.assertEqual ((len(differing), equal), (2, 0))
+        self.assertEqual (main(['diffOutput', '-q', self.old, self.new]), 1)
+
+def main(args):
+    parser = OptionParser(usage="Usage: %prog [options] OLD NEW",
+            description="Compare OpenMalaria survey outputs numerically. OLD "
+            "and NEW are output files or directories (in which case files with "
+            "the same relative path are compared). The exit status is 1 if any "
+            "outputs differ.")
+    parser.add_option("--atol", action="store", type="float", dest="atol", default=0.0,
+            help="Default absolute tolerance (default: 0)")
+    parser.add_option("--rtol", action="store", type="float", dest="rtol", default=1e-9,
+            help="Default relative tolerance (default: 1e-9)")
+    parser.add_option("-t", "--tolerance", action="append", type="string", dest="tolerance", default=None,
+            metavar="M:ATOL:RTOL", help="Tolerances for measure M; may be repeated")
+    parser.add_option("-p", "--pattern", action="store", type="string", dest="pattern", default="output.txt*",
+            help="When comparing directories, only compare files whose names match "
+                 "this shell pattern (default: output.txt*)")
+    parser.add_option("-n", "--max-cells", action="store", type="int", dest="maxCells", default=20,
+            help="Show at most this many differing cells per pair (default: 20)")
+    parser.add_option("-q", "--quiet", action="store_true", dest="quiet", default=False,
+            help="Print nothing; only set the exit status")
+    parser.add_option("-o", "--summary", action="store", type="string", dest="summary", default=None,
+            help="Write the results as JSON to this file")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=None,
+            help="Number of processes used to compare files (default: one per CPU)")
+    parser.add_option("--cache", action="store_true", dest="cache", default=False,
+            help="Use and fill the cache of parsed output files (off by default)")
+    (options, others) = parser.parse_args(args=args[1:])
+    if len(others) != 2:
+        parser.print_usage()
+        return 1
+    old, new = others
+
+    tol = Tolerances(options.atol, options.rtol)
+    for spec in options.tolerance or []:
+        Tolerances.parse(spec, tol)
+    pairs, onlyOld, onlyNew = filePairs(old, new, options.pattern)
+    differing, equal = diffPairs(pairs, tol, options.maxCells, options.jobs, options.cache)
+    if not options.quiet:
+        writeReport(differing, equal, onlyOld, onlyNew, sys.stdout)
+    if options.summary is not None:
+        with open(options.summary, 'w') as f:
+            json.dump({'differing': differing, 'equal': equal, 'onlyOld': onlyOld, 'onlyNew': onlyNew}, f,
+                      indent=1, allow_nan=False)
+    return 1 if differing or onlyOld or onlyNew else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
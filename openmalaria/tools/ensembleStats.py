@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Summary statistics of each output cell (measure, survey, group) over an
+ensemble of survey output files, e.g. runs of one scenario with different
+seeds.
+
+Files are read one at a time and folded into running statistics (Welford
+mean and variance, min, max and a quantile sketch), so memory use depends on
+the number of cells but not on the number of files.
+"""
+
+import math
+import sys
+import unittest
+from io import StringIO
+from optparse import OptionParser
+
+import numpy
+
+from openmalaria.tools.readOutput import Filter, decodeGroups, iterColumns, packKeys, readColumns, unpackKeys
+
+def sumByKey(keys, v):
+    """Return the unique keys (sorted) and the sum of v for each."""
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    return keys, numpy.bincount(inverse, weights=v, minlength=len(keys))
+
+class QuantileSketch(object):
+    """Per-cell quantile sketch with relative accuracy alpha (the DDSketch
+    approach): values are counted in logarithmic buckets, such that any
+    value in a bucket is within a factor (1 +/- alpha) of the bucket's
+    representative value. The number of buckets per cell depends on the
+    range of values seen, not on how many there are.
+
+    Counts are stored as columns sorted by (cell, bucket). Updates are
+    buffered and merged in batches."""
+    # values with magnitude below this are counted as zero
+    minValue = 1e-9
+    bias = 1<<20
+
+    def __init__(self, alpha=0.01, batchSize=1<<22):
+        self.gamma = (1.0 + alpha) / (1.0 - alpha)
+        self.logGamma = math.log(self.gamma)
+        self.batchSize = batchSize
+        self.cells = numpy.empty(0, dtype=numpy.int64)
+        self.buckets = numpy.empty(0, dtype=numpy.int32)
+        self.counts = numpy.empty(0, dtype=numpy.int64)
+        self.pending = list()
+        self.nPending = 0
+
+    def bucketOf(self, x):
+        """Bucket index of each value; order-preserving."""
+        a = numpy.abs(x)
+        big = a > self.minValue
+        k = numpy.ceil(numpy.log(numpy.where(big, a, 1.0)) / self.logGamma).astype(numpy.int32)
+        return numpy.where(big, numpy.sign(x).astype(numpy.int32) * (k + self.bias), 0)
+
+    def valueOf(self, bucket):
+        """Representative value of each bucket."""
+        k = numpy.abs(bucket) - self.bias
+        return numpy.where(bucket == 0, 0.0,
+                numpy.sign(bucket) * 2.0 * numpy.power(self.gamma, k) / (self.gamma + 1.0))
+
+    def add(self, cells, values):
+        """Count one observation of values (non-NaN) for each of cells."""
+        self.pending.append((cells, self.bucketOf(values)))
+        self.nPending += len(cells)
+        if self.nPending >= max(self.batchSize, len(self.cells)):
+            self.consolidate()
+
+    def consolidate(self):
+        if not self.pending:
+            return
+        cells = numpy.concatenate([self.cells] + [p[0] for p in self.pending])
+        buckets = numpy.concatenate([self.buckets] + [p[1] for p in self.pending])
+        counts = numpy.concatenate([self.counts] + [numpy.ones(len(p[0]), dtype=numpy.int64) for p in self.pending])
+        order = numpy.lexsort((buckets, cells))
+        cells = cells[order]
+        buckets = buckets[order]
+        starts = numpy.flatnonzero((numpy.diff(cells, prepend=-1) != 0) | (numpy.diff(buckets, prepend=-1) != 0))
+        self.cells = cells[starts]
+        self.buckets = buckets[starts]
+        self.counts = numpy.add.reduceat(counts[order], starts) if len(starts) else counts
+        self.pending = list()
+        self.nPending = 0
+
+    def quantiles(self, cells, n, q):
+        """Estimate quantile q of each of the (sorted) cells, where n is the
+        number of observations of each."""
+        self.consolidate()
+        cum = numpy.cumsum(self.counts)
+        first = numpy.searchsorted(self.cells, cells)
+        offset = numpy.where(first > 0, cum[numpy.maximum(first - 1, 0)], 0)
+        rank = numpy.floor(q * (n - 1)).astype(numpy.int64)
+        i = numpy.searchsorted(cum, offset + rank, side='right')
+        i = numpy.minimum(i, len(cum) - 1)
+        return numpy.where(n > 0, self.valueOf(self.buckets[i]), numpy.nan)
+
+class EnsembleStats(object):
+    """Running statistics per output cell (measure, survey, group code) over
+    an ensemble of files. Call add() once per file, then use table()."""
+    def __init__(self, alpha=0.01):
+        self.cells = numpy.empty(0, dtype=numpy.int64)    # sorted packed keys
+        self.n = numpy.empty(0, dtype=numpy.int64)
+        self.nNaN = numpy.empty(0, dtype=numpy.int64)
+        self.mean = numpy.empty(0)
+        self.m2 = numpy.empty(0)
+        self.min = numpy.empty(0)
+        self.max = numpy.empty(0)
+        self.sketch = QuantileSketch(alpha)
+        self.nFiles = 0
+
+    def grow(self, keys):
+        """Add any of keys (sorted, unique) which are not yet cells."""
+        cells = numpy.union1d(self.cells, keys)
+        if len(cells) == len(self.cells):
+            return
+        old = numpy.searchsorted(cells, self.cells)
+        for name, fill in (('n', 0), ('nNaN', 0), ('mean', 0.0), ('m2', 0.0),
+                           ('min', numpy.inf), ('max', -numpy.inf)):
+            a = getattr(self, name)
+            b = numpy.full(len(cells), fill, dtype=a.dtype)
+            b[old] = a
+            setattr(self, name, b)
+        self.cells = cells
+
+    def add(self, m, s, g, v):
+        """Add one file's values, given as column arrays of measure, survey,
+        group code and value. Repeated cells within the file are summed."""
+        self.addSums(*sumByKey(packKeys(m, s, g), v))
+
+    def addSums(self, keys, v):
+        """Add one file's values, given as sorted unique packed keys (see
+        packKeys) and the value of each."""
+        self.nFiles += 1
+        self.grow(keys)
+        i = numpy.searchsorted(self.cells, keys)
+        isNaN = numpy.isnan(v)
+        self.nNaN[i[isNaN]] += 1
+        i = i[~isNaN]
+        x = v[~isNaN]
+        # Welford's update
+        self.n[i] += 1
+        delta = x - self.mean[i]
+        self.mean[i] += delta / self.n[i]
+        self.m2[i] += delta * (x - self.mean[i])
+        self.min[i] = numpy.minimum(self.min[i], x)
+        self.max[i] = numpy.maximum(self.max[i], x)
+        self.sketch.add(self.cells[i], x)
+
+    def addFile(self, fileName, flt=None, useCache=False, chunkSize=1<<24):
+        """Read fileName and add its values, keeping only those passing
+        Filter flt (if given). The file is read in chunks of about chunkSize
+        bytes, each reduced to one sum per cell, so memory use depends on the
+        number of cells, not the size of the file. Parsed columns are only
+        cached (see readOutput.columnCache) if useCache is set."""
+        keys = numpy.empty(0, dtype=numpy.int64)
+        v = numpy.empty(0)
+        for cols in iterColumns(fileName, chunkSize=chunkSize, useCache=useCache):
+            if flt is not None:
+                g, c, gt = decodeGroups(cols['g'])
+                cols = cols[flt(fileName, cols['m'], cols['s'], g, c, gt)]
+            keys, v = sumByKey(numpy.concatenate((keys, packKeys(cols['m'], cols['s'], cols['g']))),
+                               numpy.concatenate((v, cols['v'])))
+        self.addSums(keys, v)
+
+    def table(self, quantiles=(0.05, 0.5, 0.95)):
+        """Return a dict of column name to array: measure, survey, group, n,
+        nNaN, mean, var (sample variance), min, max and one column per
+        quantile."""
+        m, s, g = unpackKeys(self.cells)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            empty = self.n == 0
+            r = {'measure': m, 'survey': s, 'group': g, 'n': self.n, 'nNaN': self.nNaN,
+                 'mean': numpy.where(empty, numpy.nan, self.mean),
+                 'var': numpy.where(self.n > 1, self.m2 / (self.n - 1), numpy.nan),
+                 'min': numpy.where(empty, numpy.nan, self.min),
+                 'max': numpy.where(empty, numpy.nan, self.max)}
+        for q in quantiles:
+            # estimates are within the relative accuracy; min and max are exact
+            r['q' + str(q)] = numpy.clip(self.sketch.quantiles(self.cells, self.n, q), r['min'], r['max'])
+        return r
+
+    def write(self, out, quantiles=(0.05, 0.5, 0.95)):
+        """Write the table as tab-separated text with a header line."""
+        t = self.table(quantiles)
+        names = list(t.keys())
+        out.write('\t'.join(names) + '\n')
+        columns = [t[n].tolist() for n in names]
+        for row in zip(*columns):
+            out.write('\t'.join(repr(x) if isinstance(x, float) else str(x) for x in row) + '\n')
+
+class TestEnsembleStats (unittest.TestCase):
+    def testStats (self):
+        rng = numpy.random.default_rng(1)
+        data = rng.lognormal(3.0, 1.0, size=(500, 4))
+        data[:, 3] = -data[:, 3]
+        stats = EnsembleStats(alpha=0.01)
+        m = numpy.array([0, 0, 3, 3])
+        s = numpy.array([1, 2, 1, 1])
+        g = numpy.array([0, 0, 0, 1])
+        for row in data:
+            stats.add(m, s, g, row)
+        stats.add(m[:1], s[:1], numpy.array([5]), numpy.array([numpy.nan]))
+        t = stats.table((0.1, 0.5, 0.9))
+        self.assertEqual (list(t['group']), [0, 5, 0, 0, 1])
+        self.assertEqual (list(t['n']), [500, 0, 500, 500, 500])
+        self.assertEqual (t['nNaN'][1], 1)
+        cols = [0, 2, 3, 4]
+        numpy.testing.assert_allclose (t['mean'][cols], data.mean(axis=0))
+        numpy.testing.assert_allclose (t['var'][cols], data.var(axis=0, ddof=1))
+        numpy.testing.assert_array_equal (t['min'][cols], data.min(axis=0))
+        for q in (0.1, 0.5, 0.9):
+            exact = numpy.sort(data, axis=0)[int(q * 499)]
+            numpy.testing.assert_allclose (t['q' + str(q)][cols], exact, rtol=0.0101)
+        self.assertTrue (numpy.isnan(t['q0.5'][1]))
+    def testWrite (self):
+        stats = EnsembleStats()
+        stats.add(numpy.array([3]), numpy.array([1]), numpy.array([0]), numpy.array([2.0]))
+        out = StringIO()
+        stats.write(out, (0.5,))
+        self.assertEqual (out.getvalue().splitlines()[1].split('\t')[:5], ['3', '1', '0', '1', '0'])
+    def testAddFile (self):
+        lines = "".join("%d\t%d\t%d\t%d\n" % (s, g, m, s * g) for s in range(1, 4) for g in range(3) for m in (0, 3))
+        text = lines * 2    # every cell is repeated, in another chunk
+        chunked = EnsembleStats()
+        chunked.addFile(StringIO(text), Filter("m != 0"), chunkSize=64)
+        whole = EnsembleStats()
+        cols = readColumns(StringIO(text), useCache=False)
+        cols = cols[cols['m'] != 0]
+        whole.add(cols['m'], cols['s'], cols['g'], cols['v'])
+        self.assertEqual (chunked.nFiles, 1)
+        for name, a in whole.table().items():
+            numpy.testing.assert_array_equal (chunked.table()[name], a)
+        self.assertEqual (chunked.table()['measure'].tolist(), [3]*9)
+        self.assertEqual (chunked.table()['mean'].tolist(), [2.0 * s * g for s in range(1, 4) for g in range(3)])
+
+def main(args):
+    parser = OptionParser(usage="Usage: %prog [options] FILES",
+            description="Compute the mean, variance, min, max and quantiles "
+            "of each output (measure, survey, group) over an ensemble of "
+            "OpenMalaria survey output files.")
+    parser.add_option("-o", "--output", action="store", type="string", dest="output", default=None,
+            help="Write the summary table here (default: standard output)")
+    parser.add_option("-q", "--quantiles", action="store", type="string", dest="quantiles", default="0.05,0.5,0.95",
+            help="Comma-separated list of quantiles to estimate (default: 0.05,0.5,0.95)")
+    parser.add_option("-a", "--accuracy", action="store", type="float", dest="accuracy", default=0.01,
+            help="Relative accuracy of quantile estimates (default: 0.01)")
+    parser.add_option("-e", "--filter", action="store", type="string", dest="filterExpr", default="True",
+            help="Only include entries for which this expression is true (see plotResult)")
+    parser.add_option("--cache", action="store_true", dest="cache", default=False,
+            help="Use and fill the cache of parsed output files (off by default)")
+    (options, others) = parser.parse_args(args=args[1:])
+    if len(others) == 0:
+        parser.print_usage()
+        return 1
+
+    quantiles = [float(q) for q in options.quantiles.split(',') if q]
+    flt = Filter(options.filterExpr)
+    stats = EnsembleStats(options.accuracy)
+    for fileName in others:
+        stats.addFile(fileName, flt, options.cache)
+    if options.output is None:
+        stats.write(sys.stdout, quantiles)
+    else:
+        with open(options.output, 'w') as out:
+            stats.write(out, quantiles)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Local SQLite database of survey outputs, for querying slices of large
+scenario sweeps repeatedly without parsing the text outputs again.
+
+Usage: ensembleStore.py DATABASE FILES...  (see --help)
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from optparse import OptionParser
+
+import numpy
+
+from openmalaria.tools import readOutput
+from openmalaria.tools.outputCache import fingerprint
+from openmalaria.tools.readOutput import Keys, ValDict, decodeGroups, readColumns
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    scenario TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS files_scenario ON files (scenario);
+CREATE TABLE IF NOT EXISTS entries (
+    file INTEGER NOT NULL REFERENCES files (id),
+    measure INTEGER NOT NULL,
+    survey INTEGER NOT NULL,
+    grp INTEGER NOT NULL,
+    cohort INTEGER NOT NULL,
+    genotype INTEGER NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS entries_key ON entries (file, measure, survey, grp, cohort, genotype);
+"""
+
+class EnsembleStore(object):
+    """A SQLite database holding the entries of many survey output files."""
+    def __init__(self, dbName):
+        self.db = sqlite3.connect(dbName)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def ingest(self, fileName, scenario=None, batchSize=100000, useCache=False):
+        """Load fileName into the store, replacing any older version of the
+        same file. Returns False (doing nothing) if the stored version is
+        unchanged. scenario defaults to the name of the file's directory.
+        Parsed columns are only cached (see readOutput.columnCache) if
+        useCache is set."""
+        path = os.path.abspath(fileName)
+        st = os.stat(path)
+        fp = fingerprint(path, st.st_size)
+        if scenario is None:
+            scenario = os.path.basename(os.path.dirname(path))
+        row = self.db.execute("SELECT id, size, mtime, fingerprint, scenario FROM files WHERE path=?",
+                              (path,)).fetchone()
+        if row is not None and tuple(row[1:]) == (st.st_size, st.st_mtime_ns, fp, scenario):
+            return False
+
+        cols = readColumns(path, useCache=useCache)
+        g, c, gt = decodeGroups(cols['g'])
+        with self.db:       # one transaction per file
+            if row is not None:
+                self.db.execute("DELETE FROM entries WHERE file=?", (row[0],))
+                self.db.execute("UPDATE files SET scenario=?, size=?, mtime=?, fingerprint=? WHERE id=?",
+                                (scenario, st.st_size, st.st_mtime_ns, fp, row[0]))
+                fID = row[0]
+            else:
+                fID = self.db.execute("INSERT INTO files (path, scenario, size, mtime, fingerprint) "
+                                      "VALUES (?, ?, ?, ?, ?)",
+                                      (path, scenario, st.st_size, st.st_mtime_ns, fp)).lastrowid
+            for i in range(0, len(cols), batchSize):
+                j = slice(i, i + batchSize)
+                rows = zip([fID] * len(cols[j]), cols['m'][j].tolist(), cols['s'][j].tolist(),
+                           g[j].tolist(), c[j].tolist(), gt[j].tolist(), cols['v'][j].tolist())
+                self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return True
+
+    def findFiles(self, names=None):
+        """Return [(id, path)] of stored files whose path or scenario is in
+        names (all files if names is None), in the order of names."""
+        if names is None:
+            return self.db.execute("SELECT id, path FROM files ORDER BY id").fetchall()
+        r = list()
+        for name in names:
+            path = os.path.abspath(name)
+            for row in self.db.execute("SELECT id, path FROM files WHERE path=? OR scenario=? ORDER BY id",
+                                       (path, name)):
+                if row not in r:
+                    r.append(row)
+        return r
+
+    def query(self, fID, measures=None):
+        """Return arrays (m, s, g, c, gt, v) of the entries of file fID,
+        optionally only for the given measures."""
+        sql = "SELECT measure, survey, grp, cohort, genotype, value FROM entries WHERE file=?"
+        params = [fID]
+        if measures is not None:
+            sql += " AND measure IN (" + ",".join("?" * len(measures)) + ")"
+            params += sorted(measures)
+        rows = self.db.execute(sql, params).fetchall()
+        ints = numpy.array([r[:5] for r in rows], dtype=numpy.int64).reshape(len(rows), 5)
+        v = numpy.array([r[5] for r in rows], dtype=numpy.float64)
+        return tuple(ints.T) + (v,)
+
+class TestEnsembleStore (unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = list()
+        for i in range(2):
+            os.mkdir(os.path.join(self.dir.name, "scen"+str(i)))
+            name = os.path.join(self.dir.name, "scen"+str(i), "output.txt")
+            with open(name, 'w') as f:
+                f.write("1\t0\t0\t%d\n1\t1\t3\t2\n2\t2001001\t3\t4\n" % (100+i))
+            self.files.append(name)
+        self.db = os.path.join(self.dir.name, "store.sqlite")
+        self.cache = readOutput.columnCache
+        readOutput.columnCache = None
+    def tearDown(self):
+        readOutput.columnCache = self.cache
+        self.dir.cleanup()
+    def testIngestQuery (self):
+        store = EnsembleStore(self.db)
+        self.assertTrue (store.ingest(self.files[0]))
+        self.assertTrue (store.ingest(self.files[1]))
+        self.assertFalse (store.ingest(self.files[0]))
+        store.close()
+        for keys in (Keys.all, set([Keys.MEASURE, Keys.SURVEY])):
+            fromText = ValDict(keys)
+            for name in self.files:
+                fromText.read(name, "m!=0", False)
+            fromDB = ValDict.fromStore(keys, self.db, ["scen0", self.files[1]], "m!=0")
+            self.assertEqual (fromDB.getMeasures(), [3])
+            self.assertEqual (fromDB.nSurveys, fromText.nSurveys)
+            numpy.testing.assert_array_equal (fromDB.toArray(3), fromText.toArray(3))
+        self.assertEqual (ValDict.fromStore(Keys.all, self.db, ["scen1"]).files, [os.path.abspath(self.files[1])])
+
+def main(args):
+    parser = OptionParser(usage="Usage: %prog [options] DATABASE FILES",
+            description="Load OpenMalaria survey output files into a SQLite "
+            "database (see plotResult --store), which is created if necessary. "
+            "Files which are already stored and unchanged are skipped.")
+    parser.add_option("-s", "--scenario", action="store", type="string", dest="scenario", default=None,
+            help="Scenario name to record for the files (default: name of each file's directory)")
+    parser.add_option("--cache", action="store_true", dest="cache", default=False,
+            help="Use and fill the cache of parsed output files (off by default)")
+    (options, others) = parser.parse_args(args=args[1:])
+    if len(others) < 2:
+        parser.print_usage()
+        return 1
+    db, files = others[0], others[1:]
+
+    store = EnsembleStore(db)
+    try:
+        n = 0
+        for fileName in files:
+            if store.ingest(fileName, options.scenario, useCache=options.cache):
+                n += 1
+    finally:
+        store.close()
+    print("Loaded " + str(n) + " files (" + str(len(files) - n) + " unchanged)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Persistent on-disk cache of arrays derived from output files (e.g. the
+parsed columns of a survey output file), so that repeat reads of the same
+file need not parse the text again."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+# Bump when the format of cached data changes; older entries are ignored.
+CACHE_VERSION = 1
+
+def defaultCacheDir():
+    """Use $OPENMALARIA_CACHE_DIR if set, otherwise a directory under the
+    user's cache directory."""
+    d = os.environ.get('OPENMALARIA_CACHE_DIR')
+    if d:
+        return d
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'openmalaria.tools')
+
+def fingerprint(path, size, block=1<<20):
+    """Hash of the file's size and its first and last block of content. This
+    is cheap for huge files and catches most rewrites which keep the size
+    and modification time."""
+    h = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(block))
+        if size > 2*block:
+            f.seek(size - block)
+        h.update(f.read(block))
+    return h.hexdigest()
+
+class ColumnCache(object):
+    """Cache of numpy arrays keyed on a source file's path, size,
+    modification time and content fingerprint.
+
+    Each entry is a .npy file (loaded with memory mapping) plus a small .json
+    file describing the source. The total size of .npy files is kept below
+    maxBytes by evicting the least recently used entries."""
+    def __init__(self, directory=None, maxBytes=2<<30):
+        self.directory = directory or defaultCacheDir()
+        self.maxBytes = maxBytes
+
+    def entryName(self, path, kind):
+        path = os.path.abspath(path)
+        return hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest() + '.' + kind
+
+    def describe(self, path):
+        st = os.stat(path)
+        return {'version': CACHE_VERSION,
+                'path': os.path.abspath(path),
+                'size': st.st_size,
+                'mtime': st.st_mtime_ns}
+
+    def load(self, path, kind='columns'):
+        """Return the cached array of this kind for file path, or None."""
+        name = os.path.join(self.directory, self.entryName(path, kind))
+        try:
+            with open(name + '.json') as f:
+                meta = json.load(f)
+            source = self.describe(path)
+            for k, v in source.items():
+                if meta.get(k) != v:
+                    return None
+            if meta.get('fingerprint') != fingerprint(path, source['size']):
+                return None
+            data = numpy.load(name + '.npy', mmap_mode='r')
+            os.utime(name + '.npy')     # mark as recently used
+            return data
+        except (OSError, ValueError):
+            return None
+
+    def store(self, path, data, kind='columns'):
+        """Store array data for file path, then evict old entries if the
+        cache is too large. Failures to write are ignored."""
+        try:
+            meta = self.describe(path)
+            os.makedirs(self.directory, exist_ok=True)
+            # write to temporary files and rename, so that concurrent
+            # readers never see partial entries
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save(f, numpy.ascontiguousarray(data))
+            self.commit(path, kind, meta, tmp)
+        except OSError:
+            return
+
+    def writer(self, path, dtype, kind='columns'):
+        """Return a CacheWriter for building an entry for file path from
+        several one-dimensional chunks."""
+        return CacheWriter(self, path, dtype, kind)
+
+    def commit(self, path, kind, meta, tmp):
+        """Move the .npy file tmp into place as the entry for path, given
+        meta as returned by describe() before the source was read."""
+        name = os.path.join(self.directory, self.entryName(path, kind))
+        meta['fingerprint'] = fingerprint(path, meta['size'])
+        if self.describe(path)['mtime'] != meta['mtime']:
+            # source changed while being read
+            os.remove(tmp)
+            return
+        os.replace(tmp, name + '.npy')
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, name + '.json')
+        self.evict()
+
+    def entries(self):
+        """List (mtime, size, name) for each entry, oldest first."""
+        r = list()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return r
+        for n in names:
+            if n.endswith('.npy'):
+                try:
+                    st = os.stat(os.path.join(self.directory, n))
+                except OSError:
+                    continue
+                r.append((st.st_mtime, st.st_size, n[:-4]))
+        r.sort()
+        return r
+
+    def remove(self, name):
+        for ext in ('.npy', '.json'):
+            try:
+                os.remove(os.path.join(self.directory, name + ext))
+            except OSError:
+                pass
+
+    def evict(self):
+        """Remove least recently used entries until under maxBytes."""
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in entries:
+            if total <= self.maxBytes:
+                break
+            self.remove(name)
+            total -= size
+
+    def clear(self):
+        """Remove all entries."""
+        for mtime, size, name in self.entries():
+            self.remove(name)
+
+class CacheWriter(object):
+    """Writes chunks of an array to a temporary file, then (on commit) turns
+    them into a cache entry. Memory use does not depend on the total size."""
+    def __init__(self, cache, path, dtype, kind):
+        self.cache = cache
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.kind = kind
+        self.n = 0
+        self.raw = None
+        try:
+            self.meta = cache.describe(path)
+            if self.meta['size'] > cache.maxBytes:
+                # would be evicted straight away
+                return
+            os.makedirs(cache.directory, exist_ok=True)
+            self.raw = tempfile.TemporaryFile(dir=cache.directory)
+        except OSError:
+            pass
+
+    def append(self, data):
+        if self.raw is None:
+            return
+        assert data.dtype == self.dtype
+        try:
+            self.raw.write(numpy.ascontiguousarray(data).tobytes())
+            self.n += len(data)
+        except OSError:
+            self.abort()
+
+    def commit(self):
+        if self.raw is None:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.cache.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                header = {'descr': numpy.lib.format.dtype_to_descr(self.dtype),
+                          'fortran_order': False, 'shape': (self.n,)}
+                numpy.lib.format.write_array_header_1_0(f, header)
+                self.raw.seek(0)
+                shutil.copyfileobj(self.raw, f)
+            self.cache.commit(self.path, self.kind, self.meta, tmp)
+        except OSError:
+            pass
+        self.abort()
+
+    def abort(self):
+        if self.raw is not None:
+            self.raw.close()
+            self.raw = None
+
+class TestColumnCache (unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = ColumnCache(os.path.join(self.dir.name, 'cache'), maxBytes=1000)
+        self.source = os.path.join(self.dir.name, 'output.txt')
+        with open(self.source, 'w') as f:
+            f.write("1\t0\t0\t100\n")
+    def tearDown(self):
+        self.dir.cleanup()
+    def testStoreLoad (self):
+        self.assertTrue (self.cache.load(self.source) is None)
+        self.cache.store(self.source, numpy.arange(10))
+        self.assertEqual (list(self.cache.load(self.source)), list(range(10)))
+        with open(self.source, 'a') as f:
+            f.write("2\t0\t0\t100\n")
+        self.assertTrue (self.cache.load(self.source) is None)
+    def testWriter (self):
+        w = self.cache.writer(self.source, numpy.int64)
+        w.append(numpy.arange(3))
+        w.append(numpy.arange(3, 7))
+        w.commit()
+        self.assertEqual (list(self.cache.load(self.source)), list(range(7)))
+    def testEvict (self):
+        self.cache.store(self.source, numpy.arange(200))
+        self.assertEqual (self.cache.entries(), [])
+        self.cache.store(self.source, numpy.arange(10))
+        self.assertEqual (len(self.cache.entries()), 1)
+        self.cache.clear()
+        self.assertEqual (self.cache.entries(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,14 +11,22 @@
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from optparse import OptionParser
+import concurrent.futures
+import os
+import re
+import subprocess
 import sys
 import math
+import tempfile
+import time
+import unittest
+from io import BytesIO, StringIO
 from numbers import Number
 
 import numpy
-import matplotlib.pyplot as plt
-from matplotlib.colors import cnames
 
+from openmalaria.tools import derivedMeasures, readOutput, surveyTimes
+from openmalaria.tools.outputCache import ColumnCache
 from openmalaria.tools.readOutput import Keys, ValDict
 
 
@@ -146,6 +154,8 @@ combinedMeasures = [
     ('user defined', [(90, '90', 'red'), (91, '91', 'brown'), (92, '92', 'green')]),
     ('sum log', [(73, 'drug concentration', 'green')]),
 ]
+# Colours used for derived measures (see --derive), in order
+derivedColours = ['darkred', 'teal', 'olive', 'navy', 'magenta', 'darkorange']
 appendMeasureNumber = None
 
 
@@ -156,161 +166,113 @@ def measureNumber(m):
         return ""
 
 
-def findMeasureGroup(m):
-    for i in range(len(combinedMeasures)):
-        for md in combinedMeasures[i][1]:
-            if m == md[0]:
-                return i
-    raise KeyError("measure " + str(m) + " not in combinedMeasures")
-
-
-def getMeasureLabel(mg, m):
-    if mg is None:
-        return measureNames[m] + measureNumber(m)
-    else:
-        for md in combinedMeasures[mg][1]:
-            if m == md[0]:
-                return md[1] + measureNumber(m)
-        raise KeyError("measure " + str(m) + " not in combinedMeasures[" + str(mg) + "]")
-
-
-def getMeasureColour(mg, m):
-    if mg is None:
-        return 'blue'
-    else:
-        for md in combinedMeasures[mg][1]:
-            if m == md[0]:
-                return md[2]
-        raise KeyError("measure " + str(m) + " not in combinedMeasures[" + str(mg) + "]")
-
-
-def ensureUnique(colour, used):
+# matplotlib colour names (matplotlib.colors.CSS4_COLORS) in order, and their
+# indices; a plain table so that plans can be made without matplotlib
+colourNames = [
+    'aliceblue', 'antiquewhite', 'aqua', 'aquamarine', 'azure', 'beige', 'bisque', 'black',
+    'blanchedalmond', 'blue', 'blueviolet', 'brown', 'burlywood', 'cadetblue', 'chartreuse',
+    'chocolate', 'coral', 'cornflowerblue', 'cornsilk', 'crimson', 'cyan', 'darkblue',
+    'darkcyan', 'darkgoldenrod', 'darkgray', 'darkgreen', 'darkgrey', 'darkkhaki',
+    'darkmagenta', 'darkolivegreen', 'darkorange', 'darkorchid', 'darkred', 'darksalmon',
+    'darkseagreen', 'darkslateblue', 'darkslategray', 'darkslategrey', 'darkturquoise',
+    'darkviolet', 'deeppink', 'deepskyblue', 'dimgray', 'dimgrey', 'dodgerblue', 'firebrick',
+    'floralwhite', 'forestgreen', 'fuchsia', 'gainsboro', 'ghostwhite', 'gold', 'goldenrod',
+    'gray', 'green', 'greenyellow', 'grey', 'honeydew', 'hotpink', 'indianred', 'indigo',
+    'ivory', 'khaki', 'lavender', 'lavenderblush', 'lawngreen', 'lemonchiffon', 'lightblue',
+    'lightcoral', 'lightcyan', 'lightgoldenrodyellow', 'lightgray', 'lightgreen', 'lightgrey',
+    'lightpink', 'lightsalmon', 'lightseagreen', 'lightskyblue', 'lightslategray',
+    'lightslategrey', 'lightsteelblue', 'lightyellow', 'lime', 'limegreen', 'linen', 'magenta',
+    'maroon', 'mediumaquamarine', 'mediumblue', 'mediumorchid', 'mediumpurple',
+    'mediumseagreen', 'mediumslateblue', 'mediumspringgreen', 'mediumturquoise',
+    'mediumvioletred', 'midnightblue', 'mintcream', 'mistyrose', 'moccasin', 'navajowhite',
+    'navy', 'oldlace', 'olive', 'olivedrab', 'orange', 'orangered', 'orchid', 'palegoldenrod',
+    'palegreen', 'paleturquoise', 'palevioletred', 'papayawhip', 'peachpuff', 'peru', 'pink',
+    'plum', 'powderblue', 'purple', 'rebeccapurple', 'red', 'rosybrown', 'royalblue',
+    'saddlebrown', 'salmon', 'sandybrown', 'seagreen', 'seashell', 'sienna', 'silver',
+    'skyblue', 'slateblue', 'slategray', 'slategrey', 'snow', 'springgreen', 'steelblue', 'tan',
+    'teal', 'thistle', 'tomato', 'turquoise', 'violet', 'wheat', 'white', 'whitesmoke',
+    'yellow', 'yellowgreen']
+colourIndex = dict((name, i) for i, name in enumerate(colourNames))
+
+
+def ensureUnique(colour, used, nextFree=None):
+    """Return colour, or the next matplotlib colour after it which is not in
+    used, and add it to used. nextFree (a dict) may be passed with used to
+    skip runs of used colours on later calls."""
     if colour in used:
-        colours = list(cnames.keys())
-        i = 0
-        while colours[i] != colour:
-            i += 1
-            if i >= len(colours):
-                raise KeyError("colour " + colour + " not found!")
+        colours = colourNames
+        if colour not in colourIndex:
+            raise KeyError("colour " + colour + " not found!")
+        i = colourIndex[colour]
+        skipped = list()
         # TODO: replace the following with a check of whether the colour is similar to any used colour
-        while colours[i] in used:
-            i += 1
-            if i >= len(colours):
-                i -= 1
-                break
+        while colours[i] in used and i + 1 < len(colours):
+            skipped.append(i)
+            i = nextFree.get(i, i + 1) if nextFree is not None else i + 1
+        if nextFree is not None:
+            for j in skipped:
+                nextFree[j] = i
         colour = colours[i]
     used.add(colour)
     return colour
 
 
+def measureTable(combined):
+    """Lookup tables built from combined (a list like combinedMeasures): the
+    index of the first group containing each measure, and (label, colour) of
+    each (group index, measure)."""
+    groupOf = dict()
+    info = dict()
+    for mg, (name, measures) in enumerate(combined):
+        for md in measures:
+            groupOf.setdefault(md[0], mg)
+            info.setdefault((mg, md[0]), (md[1], md[2]))
+    return groupOf, info
+
+
 replaceFN = None
 
 
-class MultiKey(object):
-    __slots__ = ["mg", "m", "s", "g", "c", "gt", "f"]
-
-    def __init__(self, measureGroup=None, measure=None, survey=None, group=None, cohort=None, genotype=None,
-                 fileName=None):
-        self.mg = measureGroup  # int index in combinedMeasures
-        self.m = measure  # int
-        self.s = survey  # int
-        self.g = group  # int (age group or species)
-        self.c = cohort  # int
-        self.gt = genotype  # int
-        self.f = fileName  # int
-
-    def __and__(self, other):
-        """Set each member from other if not set in self.
-        Should complain if set in self and in other, but this is a bit unnecessary."""
-        assert isinstance(other, MultiKey)
-        first = MultiKey(self.mg, self.m, self.s, self.g, self.c, self.gt, self.f)
-        if first.mg is None:
-            first.mg = other.mg
-        if first.m is None:
-            first.m = other.m
-        if first.s is None:
-            first.s = other.s
-        if first.g is None:
-            first.g = other.g
-        if first.c is None:
-            first.c = other.c
-        if first.gt is None:
-            first.gt = other.gt
-        if first.f is None:
-            first.f = other.f
-        return first
-
-    @staticmethod
-    def fromMeasureGroups(measureGroups):
-        r = [MultiKey(measureGroup=measureGroup) for measureGroup in measureGroups]
-        return r
-
-    @staticmethod
-    def fromMeasures(measures):
-        r = [MultiKey(measure=measure) for measure in measures]
-        return r
-
-    @staticmethod
-    def fromSurveys(surveys):
-        return [MultiKey(survey=survey) for survey in surveys]
-
-    @staticmethod
-    def fromGroups(groups):
-        return [MultiKey(group=group) for group in groups]
-
-    @staticmethod
-    def fromCohorts(cohorts):
-        return [MultiKey(cohort=cohort) for cohort in cohorts]
-
-    @staticmethod
-    def fromGenotypes(genotypes):
-        return [MultiKey(genotype=genotype) for genotype in genotypes]
-
-    @staticmethod
-    def fromFiles(files):
-        return [MultiKey(fileName=fl) for fl in files]
-
-    @staticmethod
-    def expand(r, x):
-        "r,x are expected to be lists of MultiKeys"
-        "this creates a list of all combinations of a&b for a in r and b in x"
-        lx = len(x)
-        assert lx > 0, "expected len>0"
-        r *= lx  # shallow copy: all references point to same object
-        for i in range(len(r)):
-            r[i] = r[i] & x[i % lx]
-
-    def __str__(self):
-        return self.label(MultiKey(), True)
-
-    def label(self, base, valDict):
-        r = ""
-        if self.m != base.m:
-            r = getMeasureLabel(self.mg, self.m)
-        if self.s != base.s:
-            if len(r):
-                r += ","
-            r += "survey " + str(self.s)
-        if self.g != base.g:
-            if len(r):
-                r += ","
-            r += "group " + str(self.g)
-        if self.c != base.c:
-            if len(r):
-                r += ","
-            r += "cohort " + str(self.c)
-        if self.gt != base.gt:
-            if len(r):
-                r += ","
-            r += "genotype " + str(self.gt)
-        if self.f != base.f:
-            if len(r):
-                r += ","
-            if replaceFN:
-                r += "file " + str(self.f + 1)
-            else:
-                r += valDict.getFileName(self.f)
-        return r
+class SubplotPlan(object):
+    """One subplot of a PlotPlan.
+
+    series is an integer array with one row (m, f, s, g, c, gt) per line or
+    bar drawn, where -1 means the key is on the x-axis or aggregated;
+    labels and colours have one entry per row. For bar charts, stacks gives
+    the stack (x-offset) of each row and stackLabels the annotation of each
+    stack (auto-measures only)."""
+    __slots__ = ["name", "title", "xLabel", "yLabel", "x", "bars", "series", "labels", "colours",
+                 "stacks", "stackLabels"]
+
+    def __init__(self, name, title, xLabel, yLabel, x, bars):
+        self.name = name
+        self.title = title
+        self.xLabel = xLabel
+        self.yLabel = yLabel
+        self.x = x
+        self.bars = bars
+        self.series = numpy.empty((0, 6), dtype=numpy.int64)
+        self.labels = list()
+        self.colours = list()
+        self.stacks = numpy.empty(0, dtype=numpy.int64)
+        self.stackLabels = list()
+
+
+class PlotPlan(object):
+    """Everything needed to draw a set of plots except the data: the x-axis
+    key, whether measures are grouped (auto-measures) and a SubplotPlan per
+    subplot. Plans contain only plain values and numpy arrays, so they can
+    be cached or sent to other processes."""
+    def __init__(self, xAxis, am, subplots):
+        self.xAxis = xAxis
+        self.am = am
+        self.subplots = subplots
+
+
+# Order in which keys are combined into subplots and lines, with the index of
+# each in plan keys (mg, m, s, g, c, gt, f) and labels
+planKeys = [(Keys.SURVEY, 2, "survey"), (Keys.GROUP, 3, "group"), (Keys.COHORT, 4, "cohort"),
+            (Keys.GENOTYPE, 5, "genotype"), (Keys.FILE, 6, "file")]
 
 
 class Plotter(object):
@@ -322,283 +284,686 @@ class Plotter(object):
         self.showYLabel = None
         self.horizSubBars = None
         self.scale = None
+        self.decimate = None    # reduce lines to the width of the plot (see decimate)
+        self.plans = dict()     # cached PlotPlans (see plan)
+        self.followers = list() # readOutput.OutputFollowers (see follow)
+        self.live = None        # (plan, drawn) of the figure drawn by drawLive
+        # measureNames and combinedMeasures plus this plotter's derived measures
+        self.measureNames = dict(measureNames)
+        self.combinedMeasures = list(combinedMeasures)
 
     def read(self, fileName, filterExpr, debugFilter):
+        self.plans.clear()
         self.values.read(fileName, filterExpr, debugFilter)
         if len(self.values.getMeasures()) == 0:
             raise Exception("No data to plot (after filtering)!")
 
-    def plot(self, am, s, g, c, gt, f):
-        x_axis = Keys.NONE
-        x_label = ""
-        if s == "x-axis":
-            assert x_axis == Keys.NONE, "dual assignment to x-axis!"
-            x_axis = Keys.SURVEY
-            x_label = "survey"
-        if g == "x-axis":
-            assert x_axis == Keys.NONE, "dual assignment to x-axis!"
-            x_axis = Keys.GROUP
-            x_label = "group"
-        if c == "x-axis":
-            assert x_axis == Keys.NONE, "dual assignment to x-axis!"
-            x_axis = Keys.COHORT
-            x_label = "cohort"
-        if gt == "x-axis":
-            assert x_axis == Keys.NONE, "dual assignment to x-axis!"
-            x_axis = Keys.GENOTYPE
-            x_label = "genotype"
-        if f == "x-axis":
-            assert x_axis == Keys.NONE, "dual assignment to x-axis!"
-            x_axis = Keys.FILE
-            x_label = "file"
-            x = self.values.getFileNames(replaceFN)
-        assert x_axis != Keys.NONE, "nothing to plot on x-axis!"
-
-        lines = set()
-        if s == "line":
-            lines.add(Keys.SURVEY)
-        if g == "line":
-            lines.add(Keys.GROUP)
-        if c == "line":
-            lines.add(Keys.COHORT)
-        if gt == "line":
-            lines.add(Keys.GENOTYPE)
-        if f == "line":
-            lines.add(Keys.FILE)
-
-        plots = [MultiKey()]
+    def readMany(self, fileNames, filterExpr, debugFilter, jobs):
+        self.plans.clear()
+        self.values.readMany(fileNames, filterExpr, debugFilter, jobs)
+        if len(self.values.getMeasures()) == 0:
+            raise Exception("No data to plot (after filtering)!")
+
+    def readStore(self, dbName, names, filterExpr, debugFilter):
+        self.plans.clear()
+        self.values.readStore(dbName, names, filterExpr, debugFilter)
+        if len(self.values.getMeasures()) == 0:
+            raise Exception("No data to plot (after filtering)!")
+
+    def follow(self, fileNames, filterExpr):
+        """Read fileNames, which may still be written to, such that poll
+        reads only lines appended since."""
+        self.plans.clear()
+        self.followers = [readOutput.OutputFollower(self.values, name, filterExpr) for name in fileNames]
+        self.poll()
+
+    def poll(self):
+        """Read lines appended to the followed files. Returns the set of
+        (file, measure) read, or None if a file was replaced or truncated
+        (and so read again from the start)."""
+        changed = set()
+        restarted = False
+        for follower in self.followers:
+            follower.update()
+            if follower.measures is None:
+                restarted = True
+            else:
+                changed.update((follower.fID, m) for m in follower.measures)
+        if restarted:
+            # with files aggregated, a restart clears all values, which the
+            # other followers must read again (see readOutput.OutputFollower)
+            for follower in self.followers:
+                if follower.generation != self.values.generation:
+                    follower.update()
+        if changed or restarted:
+            self.plans.clear()
+        return None if restarted else changed
+
+    def derive(self, derived, source=None):
+        """Compute derivedMeasures derived from source (default: the values
+        read) and add them to the values to plot, with labels and colours
+        (kept by this plotter, not added to the module's tables)."""
+        self.plans.clear()
+        derivedMeasures.derive(self.values, derived, source)
+        group = [md for md in self.combinedMeasures if md[0] == 'derived measures']
+        if group:
+            group = group[0][1]
+        else:
+            group = list()
+            self.combinedMeasures.append(('derived measures', group))
+        numbers = set(d.number for d in derived)
+        group[:] = [md for md in group if md[0] not in numbers]
+        for d in derived:
+            self.measureNames[d.number] = d.name
+            group.append((d.number, d.name, derivedColours[len(group) % len(derivedColours)]))
+
+    def seriesValues(self, row, x_axis, n):
+        """Values of series row (see SubplotPlan) along x_axis, as an array
+        of length n (padded with NaN if necessary)."""
+        m, f, s, g, c, gt = [int(i) for i in row]
+        fixed = {Keys.FILE: f, Keys.SURVEY: s, Keys.GROUP: g, Keys.COHORT: c, Keys.GENOTYPE: gt}
+        for key in fixed:
+            if fixed[key] < 0:
+                fixed[key] = None
+        y = self.values.getArray(m, x_axis, fixed)
+        if len(y) != n:
+            y = numpy.concatenate([y[:n], numpy.full(max(0, n - len(y)), numpy.nan)])
+        return y
+
+    def plan(self, am, s, g, c, gt, f):
+        """Return a PlotPlan for these options (see main). Plans are cached
+        until more values are read."""
+        options = (am, s, g, c, gt, f, appendMeasureNumber, replaceFN)
+        if options not in self.plans:
+            self.plans[options] = self.makePlan(am, s, g, c, gt, f)
+        return self.plans[options]
+
+    def makePlan(self, am, s, g, c, gt, f):
+        values = self.values
+        targets = {Keys.SURVEY: s, Keys.GROUP: g, Keys.COHORT: c, Keys.GENOTYPE: gt, Keys.FILE: f}
+        xKeys = [k for k, i, name in planKeys if targets[k] == "x-axis"]
+        assert len(xKeys) <= 1, "dual assignment to x-axis!"
+        assert len(xKeys) == 1, "nothing to plot on x-axis!"
+        x_axis = xKeys[0]
+        lines = [k for k, i, name in planKeys if targets[k] == "line"]
+        groupOf, info = measureTable(self.combinedMeasures)
+        fileNames = values.getFileNames(replaceFN)
+
+        def measureLabel(mg, m):
+            if mg is None:
+                return self.measureNames[m] + measureNumber(m)
+            if (mg, m) not in info:
+                raise KeyError("measure " + str(m) + " not in combinedMeasures[" + str(mg) + "]")
+            return info[(mg, m)][0] + measureNumber(m)
+
+        def colourOf(mg, m):
+            return 'blue' if mg is None else info[(mg, m)][1]
+
+        def label(key, base):
+            r = list()
+            if key[1] != base[1]:
+                r.append(measureLabel(key[0], key[1]))
+            for k, i, name in planKeys:
+                if key[i] != base[i]:
+                    if k != Keys.FILE:
+                        r.append(name + " " + str(key[i]))
+                    elif replaceFN:
+                        r.append("file " + str(key[i] + 1))
+                    else:
+                        r.append(values.getFileName(key[i]))
+            return ",".join(r)
+
+        def keyValues(k, m):
+            if k == Keys.SURVEY:
+                return values.getSurveys(m)
+            if k == Keys.GROUP:
+                return values.getGroups(m)
+            if k == Keys.COHORT:
+                return values.getCohorts(m)
+            if k == Keys.GENOTYPE:
+                return values.getGenotypes(m)
+            return values.getFiles()
+
+        def expand(keys, k, choices):
+            # all combinations of keys with each of choices for key k
+            i = [x[1] for x in planKeys if x[0] == k][0]
+            return [key[:i] + (v,) + key[i+1:] for key in keys for v in choices]
+
+        # keys are tuples (mg, m, s, g, c, gt, f), None where unset
+        measureGroups = dict()
         if am:
-            measureGroups = dict()
-            for m in self.values.getMeasures():
-                mg = findMeasureGroup(m)
-                if mg in measureGroups:
-                    measureGroups[mg].append(m)
-                else:
-                    measureGroups[mg] = list([m])
-            # note: here "measure" is used to represent "measure group"
-            MultiKey.expand(plots, MultiKey.fromMeasureGroups(list(measureGroups.keys())))
+            for m in values.getMeasures():
+                if m not in groupOf:
+                    raise KeyError("measure " + str(m) + " not in combinedMeasures")
+                measureGroups.setdefault(groupOf[m], list()).append(m)
+            plotKeys = [(mg, None) + (None,) * 5 for mg in measureGroups]
         else:
-            MultiKey.expand(plots, MultiKey.fromMeasures(self.values.getMeasures()))
+            plotKeys = [(None, m) + (None,) * 5 for m in values.getMeasures()]
         if s == "plot":
             # NOTE: probably not going to include measure 21 — this doesn't include multiple surveys
-            MultiKey.expand(plots, MultiKey.fromSurveys(self.values.getSurveys(0)))
+            plotKeys = expand(plotKeys, Keys.SURVEY, values.getSurveys(0))
         if g == "plot":
-            # like MultiKey.expand, but only using those groups applicable to each measure
-            origplots = plots
-            plots = list()
-            for p in origplots:
-                plots += [p & b for b in MultiKey.fromGroups(self.values.getGroups(p.m))]
+            # only using those groups applicable to each measure (or first measure of the group)
+            plotKeys = [key for p in plotKeys
+                        for key in expand([p], Keys.GROUP, values.getGroups(
+                            p[1] if p[1] is not None else measureGroups[p[0]][0]))]
         # TODO: cohorts and genotypes like groups?
         if f == "plot":
             # NOTE: we assume all files contain data over same measures, surveys and groups
-            MultiKey.expand(plots, MultiKey.fromFiles(self.values.getFiles()))
-
-        n = len(plots)
-        d1 = int(math.ceil(math.sqrt(float(n))))
-        d2 = int(math.ceil(float(n) / float(d1)))
-
-        fig = plt.figure(1, figsize=(10,8))
-        plt.rcParams.update({'font.size': 6})
-        plotNumber = 1
-        for plot in plots:
-            subplot = fig.add_subplot(d1, d2, plotNumber)
-            plotNumber += 1
+            plotKeys = expand(plotKeys, Keys.FILE, values.getFiles())
+
+        subplots = list()
+        for key in plotKeys:
+            mg = key[0]
+            m = key[1] if not am else measureGroups[mg][0]  # take first — not necessary correct but we need a measure
+            measures = measureGroups[mg] if am else [m]
+
+            x_label = [name for k, i, name in planKeys if k == x_axis][0]
+            if x_axis == Keys.FILE:
+                x = fileNames
+            elif x_axis == Keys.SURVEY and values.surveyTimes is not None:
+                x = (values.getSurveyTimes(m) / surveyTimes.daysPerYear).tolist()
+                x_label = "time (years)"
+            else:
+                x = keyValues(x_axis, m)
+                if x_axis == Keys.GROUP:
+                    x_label = values.getGroupLabel(m)
 
-            m = plot.m
             if am:
-                m = measureGroups[plot.mg][0]  # take first — not necessary correct but we need a measure
-
-            if x_axis == Keys.GROUP:
-                x = self.values.getGroups(m)
-                x_label = self.values.getGroupLabel(m)
-            elif x_axis == Keys.SURVEY:
-                x = self.values.getSurveys(m)
-            elif x_axis == Keys.COHORT:
-                x = self.values.getCohorts(m)
-            elif x_axis == Keys.GENOTYPE:
-                x = self.values.getGenotypes(m)
-            #else x was set previously
-
-            pLines = [plot]
-
-            #TODO: colour is not unique for any key other than measures from measure groups
-            # i.e. we need to somehow manipulate colours to make them unique
-            if Keys.SURVEY in lines:
-                MultiKey.expand(pLines, MultiKey.fromSurveys(self.values.getSurveys(m)))
-            if Keys.GROUP in lines:
-                MultiKey.expand(pLines, MultiKey.fromGroups(self.values.getGroups(m)))
-            if Keys.COHORT in lines:
-                MultiKey.expand(pLines, MultiKey.fromCohorts(self.values.getCohorts(m)))
-            if Keys.GENOTYPE in lines:
-                MultiKey.expand(pLines, MultiKey.fromGenotypes(self.values.getGenotypes(m)))
-            if Keys.FILE in lines:
-                MultiKey.expand(pLines, MultiKey.fromFiles(self.values.getFiles()))
-
+                title = "Measures " + ", ".join(str(x) for x in measures)
+                y_label = self.combinedMeasures[mg][0]
+                name = [self.combinedMeasures[mg][0]]
+            else:
+                title = "Measure " + str(m)
+                y_label = measureLabel(mg, m)
+                name = ["m" + str(m), self.measureNames.get(m, "")]
+            for k, i, part in planKeys:
+                if key[i] is not None:
+                    if k != Keys.FILE:
+                        name.append(part + "-" + str(key[i]))
+                    elif replaceFN:
+                        name.append("file-" + str(key[i] + 1))
+                    else:
+                        name.append(os.path.basename(values.getFileName(key[i])))
+            name = "_".join(re.sub(r"[^A-Za-z0-9.]+", "-", part).strip("-") for part in name if part)
+
+            lineKeys = [key]
+            for k in lines:
+                lineKeys = expand(lineKeys, k, keyValues(k, m))
+
+            sp = SubplotPlan(name, title, x_label, y_label, x,
+                             not (len(x) > 1 and isinstance(x[0], Number)))
             # use to avoid reusing colours or white (and similar)
-            lineColours = set()
-            for colour in ['white', 'azure', 'floralwhite', 'ghostwhite', 'honeydew', 'ivory', 'snow', 'whitesmoke']:
-                lineColours.add(colour)
-
-            if self.showTitle:
-                """ This is an aglomeration of all information constant in the
-                plot. Unfortunately it's rather useless to show.
-                # Only include y-axis info if not shown on y-axis:
-                base=MultiKey(measure=plot.m) if self.showYLabel else MultiKey()
-                subplot.set_title(plot.label(base,self.values))
-                """
-                if am:
-                    measures = measureGroups[plot.mg]
-                    title = "Measures " + str(measures[0])
-                    for m in measures[1:]:
-                        title += ", " + str(m)
-                else:
-                    title = "Measure " + str(plot.m)
-                subplot.set_title(title)
-            if self.showXLabel:
-                subplot.set_xlabel(x_label)
-            if self.showYLabel:
+            lineColours = set(['white', 'azure', 'floralwhite', 'ghostwhite', 'honeydew', 'ivory', 'snow', 'whitesmoke'])
+            nextFree = dict()
+            series = list()
+            stacks = list()
+            for j, lineKey in enumerate(lineKeys):
                 if am:
-                    y_label = combinedMeasures[plot.mg][0]
+                    blocks = [(lineKey[0], mb) + lineKey[2:] for mb in measures]
+                    if sp.bars:
+                        sp.stackLabels.append(label(lineKey, key))
                 else:
-                    y_label = getMeasureLabel(plot.mg, plot.m)
-                subplot.set_ylabel(y_label)
-            if self.scale == "log":
-                subplot.set_yscale('log')
-            elif self.scale == "auto":
-                pass  #TODO
+                    blocks = [lineKey]
+                for block in blocks:
+                    series.append([-1 if v is None else v for v in block[1:]])
+                    stacks.append(j)
+                    colour = colourOf(block[0], block[1])
+                    if not (am and sp.bars):
+                        colour = ensureUnique(colour, lineColours, nextFree)
+                    sp.colours.append(colour)
+                    if not sp.bars:
+                        sp.labels.append(label(block, key))
+                    elif j == 0:
+                        sp.labels.append(label(block, lineKeys[0]))
+                    else:
+                        sp.labels.append("")
+            # rows are (m, s, g, c, gt, f); store as (m, f, s, g, c, gt)
+            series = numpy.array(series, dtype=numpy.int64).reshape(len(series), 6)
+            sp.series = series[:, [0, 5, 1, 2, 3, 4]]
+            sp.stacks = numpy.array(stacks, dtype=numpy.int64)
+            subplots.append(sp)
+        return PlotPlan(x_axis, am, subplots)
 
-            plotted = list()
+    def plot(self, am, s, g, c, gt, f):
+        """Draw all plots as subplots of one figure and show it."""
+        plt = pyplot()
+        plan = self.plan(am, s, g, c, gt, f)
+        fig = plt.figure(1, figsize=(10,8))
+        plt.rcParams.update({'font.size': 6})
+        self.drawFigure(fig, plan)
+        plt.tight_layout()
+        plt.show()
 
-            if len(x) > 1 and isinstance(x[0], Number):  # draw an xy line chart
-                if am:
-                    measures = measureGroups[plot.mg]
-                    MultiKey.expand(pLines, MultiKey.fromMeasures(measures))
-
-                for pLine in pLines:
-                    xKeys = [pLine]
-                    if x_axis == Keys.SURVEY:
-                        MultiKey.expand(xKeys, MultiKey.fromSurveys(self.values.getSurveys(m)))
-                    elif x_axis == Keys.GROUP:
-                        MultiKey.expand(xKeys, MultiKey.fromGroups(self.values.getGroups(m)))
-                    elif x_axis == Keys.COHORT:
-                        MultiKey.expand(xKeys, MultiKey.fromCohorts(self.values.getCohorts(m)))
-                    elif x_axis == Keys.GENOTYPE:
-                        MultiKey.expand(xKeys, MultiKey.fromGenotypes(self.values.getGenotypes(m)))
-                    elif x_axis == Keys.FILE:
-                        MultiKey.expand(xKeys, MultiKey.fromFiles(self.values.getFiles()))
-                    y = [self.values.get(k.m, k.s, k.g, k.c, k.gt, k.f) for k in xKeys]
-                    colour = ensureUnique(getMeasureColour(pLine.mg, pLine.m), lineColours)
+    def drawFigure(self, fig, plan):
+        """Draw all subplots of plan in a grid on fig. Returns a list of
+        (subplot, artist) (see drawSubplot) for each SubplotPlan."""
+        n = len(plan.subplots)
+        d1 = int(math.ceil(math.sqrt(float(n))))
+        d2 = int(math.ceil(float(n) / float(d1)))
+        plotNumber = 1
+        drawn = list()
+        for sp in plan.subplots:
+            subplot = fig.add_subplot(d1, d2, plotNumber)
+            plotNumber += 1
+            drawn.append((subplot, self.drawSubplot(subplot, plan, sp)))
+        return drawn
+
+    def drawLive(self, fig, am, s, g, c, gt, f):
+        """Clear fig and draw all plots on it, remembering the artists so
+        that refresh can update them."""
+        plan = self.plan(am, s, g, c, gt, f)
+        fig.clf()
+        self.live = (plan, self.drawFigure(fig, plan))
+
+    def refresh(self, fig, changed, am, s, g, c, gt, f):
+        """Update the figure drawn by drawLive after poll returned changed.
+        Lines of series with new values get new data and their subplots are
+        rescaled; other artists are untouched. The whole figure is drawn
+        again only if the plots or lines themselves changed (e.g. a new
+        measure or group appeared). Returns the number of lines updated, or
+        None if the figure was drawn again."""
+        old, drawn = self.live
+        plan = self.plan(am, s, g, c, gt, f)
+        if changed is None or not samePlots(old, plan):
+            self.drawLive(fig, am, s, g, c, gt, f)
+            return None
+        measures = set(m for fID, m in changed)
+        n = 0
+        for sp, (subplot, artist) in zip(plan.subplots, drawn):
+            rows = [i for i, row in enumerate(sp.series)
+                    if row[0] in measures and (row[1] < 0 or (int(row[1]), int(row[0])) in changed)]
+            if not rows:
+                continue
+            if artist is None:
+                subplot.cla()
+                self.drawSubplot(subplot, plan, sp)
+            elif len(sp.series) == 1:
+                artist.set_data(*self.lineData(subplot, sp.x, sp.series[0], plan.xAxis))
+                subplot.relim()
+                subplot.autoscale_view()
+            else:
+                segments = artist.get_segments()
+                for i in rows:
+                    segments[i] = numpy.column_stack(self.lineData(subplot, sp.x, sp.series[i], plan.xAxis))
+                artist.set_segments(segments)
+                subplot.ignore_existing_data_limits = True
+                subplot.update_datalim(numpy.concatenate(segments))
+                subplot.autoscale_view()
+            n += len(rows)
+        self.live = (plan, drawn)
+        return n
+
+    def watch(self, am, s, g, c, gt, f, interval=5.0):
+        """Show all plots and keep them up to date with the followed files
+        (see follow), checking every interval seconds, until the figure is
+        closed."""
+        plt = pyplot()
+        fig = plt.figure(1, figsize=(10,8))
+        plt.rcParams.update({'font.size': 6})
+        self.drawLive(fig, am, s, g, c, gt, f)
+        plt.tight_layout()
+        plt.show(block=False)
+        while plt.fignum_exists(fig.number):
+            plt.pause(interval)
+            changed = self.poll()
+            if changed is None or changed:
+                if self.refresh(fig, changed, am, s, g, c, gt, f) is None:
+                    fig.tight_layout()
+                fig.canvas.draw_idle()
+
+    def render(self, am, s, g, c, gt, f, outDir, fmt="png", workers=None):
+        """Draw each plot as a separate figure, written to outDir as
+        NNN_NAME.fmt (NAME is SubplotPlan.name) without using an interactive
+        backend. Figures are drawn in up to workers processes (default or
+        0: one per CPU). Returns the list of files written."""
+        plan = self.plan(am, s, g, c, gt, f)
+        os.makedirs(outDir, exist_ok=True)
+        names = [os.path.join(outDir, "%03d_%s.%s" % (i, sp.name, fmt)) for i, sp in enumerate(plan.subplots)]
+        jobs = list(zip(plan.subplots, names))
+        if not workers:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(jobs))
+        if workers <= 1:
+            renderFigures(self, plan, jobs)
+        else:
+            chunks = [jobs[i::workers] for i in range(workers)]
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                list(pool.map(renderFigures, [self] * workers, [plan] * workers, chunks))
+        return names
+
+    def drawSubplot(self, subplot, plan, sp):
+        """Draw SubplotPlan sp of plan on subplot. Returns the artist
+        drawing the lines of a line chart (a Line2D or LineCollection with a
+        line per series), or None for a bar chart."""
+        am = plan.am
+        x = sp.x
+        if self.showTitle:
+            subplot.set_title(sp.title)
+        if self.showXLabel:
+            subplot.set_xlabel(sp.xLabel)
+        if self.showYLabel:
+            subplot.set_ylabel(sp.yLabel)
+        if self.scale == "log":
+            subplot.set_yscale('log')
+        elif self.scale == "auto":
+            pass  #TODO
+
+        plotted = list()
+        artist = None
+
+        if not sp.bars:  # draw an xy line chart
+            lines = [self.lineData(subplot, x, row, plan.xAxis) for row in sp.series]
+            if len(lines) == 1:
+                plotted.append(subplot.plot(lines[0][0], lines[0][1], sp.colours[0]))
+                artist = plotted[0][0]
+            elif lines:
+                # one collection is much cheaper to draw (and smaller in SVG
+                # and PDF) than one Line2D per line
+                from matplotlib.collections import LineCollection
+                from matplotlib.lines import Line2D
+                segments = [numpy.column_stack(line) for line in lines]
+                artist = LineCollection(segments, colors=sp.colours, capstyle='projecting', joinstyle='round')
+                subplot.add_collection(artist)
+                subplot.autoscale_view()
+                plotted = [[Line2D([], [], color=colour)] for colour in sp.colours]
+
+            if self.showLegends and (am or len(plotted) > 1):
+                subplot.legend([p[0] for p in plotted], sp.labels, loc=1)
+        else:  # one x-coord or non-numeric x-coords: draw a bar chart
+            nStacks = int(sp.stacks.max()) + 1 if len(sp.stacks) else 0
+            xind = numpy.arange(len(x))
+            propPlotUse = 0.95
+            width = propPlotUse / max(nStacks, 1)
+            xincr = 0.5 * (1.0 - propPlotUse)
+
+            # each stack has a vertical bar/stack for each x-position
+            for j in range(nStacks):
+                rows = numpy.flatnonzero(sp.stacks == j)
+                ytop = numpy.zeros(len(x))
+                probBarUse = 0.8
+                subwidth = width * probBarUse / len(rows)
+                xsubincr = width * 0.5 * (1.0 - probBarUse)
+                # each bar is a stack of one or more items
+                for i in rows:
+                    y = self.seriesValues(sp.series[i], plan.xAxis, len(x))
+                    colour = sp.colours[i]
                     try:
-                        plotted.append(subplot.plot(x, y, colour))
+                        if self.horizSubBars:
+                            #multiple bars
+                            lastPlotted = subplot.bar(xind + xincr + xsubincr, y, subwidth, color=colour)
+                            ytop = numpy.fmax(ytop, y)
+                        else:
+                            #stack
+                            lastPlotted = subplot.bar(xind + xincr, y, width, color=colour, bottom=ytop)
+                            ytop = ytop + y
+                        xsubincr += subwidth
+                        plotted.append(lastPlotted)
                     except ValueError as e:
                         print("Bad plot values (script error):")
-                        print(("x:", x))
+                        print(("x:", xind + xincr))
                         print(("y:", y))
-                        print(("colour:", colour))
-
-                if self.showLegends and (am or len(plotted) > 1):
-                    plots = [p[0] for p in plotted]
-                    legends = [pLine.label(plot, self.values) for pLine in pLines]
-                    subplot.legend(legends, loc=1)
-            else:  # one x-coord or non-numeric x-coords: draw a bar chart
-                plotted = list()
-                firstLine = None
-                firstStack = None
-
-                xind = numpy.arange(len(x))
-                propPlotUse = 0.95
-                width = propPlotUse / len(pLines)
-                xincr = 0.5 * (1.0 - propPlotUse)
-
-                # each pLine has a vertical bar/stack for each x-position
-                for pLine in pLines:
-                    pLStack = [pLine]
-                    if am:
-                        measures = measureGroups[plot.mg]
-                        MultiKey.expand(pLStack, MultiKey.fromMeasures(measures))
-
-                    if firstLine is None:
-                        firstLine = pLine
-                        firstStack = pLStack
-
-                    ytop = None
-                    probBarUse = 0.8
-                    subwidth = width * probBarUse / len(pLStack)
-                    xsubincr = width * 0.5 * (1.0 - probBarUse)
-                    lastPlotted = None
-                    # each bar is a stack of one or more items
-                    for pLSBlock in pLStack:
-                        # finally, we have several x-positions
-                        xKeys = [pLSBlock]
-                        if x_axis == Keys.SURVEY:
-                            MultiKey.expand(xKeys, MultiKey.fromSurveys(self.values.getSurveys(m)))
-                        elif x_axis == Keys.GROUP:
-                            MultiKey.expand(xKeys, MultiKey.fromGroups(self.values.getGroups(m)))
-                        elif x_axis == Keys.COHORT:
-                            MultiKey.expand(xKeys, MultiKey.fromCohorts(self.values.getCohorts(m)))
-                        elif x_axis == Keys.GENOTYPE:
-                            MultiKey.expand(xKeys, MultiKey.fromGenotypes(self.values.getGenotypes(m)))
-                        elif x_axis == Keys.FILE:
-                            MultiKey.expand(xKeys, MultiKey.fromFiles(self.values.getFiles()))
-
-                        if ytop is None:
-                            ytop = [0.0 for k in xKeys]
-                        y = [self.values.get(k.m, k.s, k.g, k.c, k.gt, k.f) for k in xKeys]
-                        colour = getMeasureColour(pLSBlock.mg, pLSBlock.m)
-                        if not am:
-                            colour = ensureUnique(colour, lineColours)
-                        try:
-                            if self.horizSubBars:
-                                #multiple bars
-                                lastPlotted = subplot.bar(xind + xincr + xsubincr, y, subwidth, color=colour)
-                                for i in range(0, len(y)):
-                                    ytop[i] = max(ytop[i], y[i])
-                            else:
-                                #stack
-                                lastPlotted = subplot.bar(xind + xincr, y, width, color=colour, bottom=ytop)
-                                for i in range(0, len(y)):
-                                    ytop[i] += y[i]
-                            xsubincr += subwidth
-                            plotted.append(lastPlotted)
-                        except ValueError as e:
-                            print("Bad plot values (script error):")
-                            print(("x:", xind + xincr))
-                            print(("y:", y))
-                            print(("ytop:", ytop))
-
-                    if am:
-                        message = pLine.label(plot, self.values)
-                        lims = subplot.get_ylim()
-                        yincr = (lims[1] - lims[0]) * 0.02
-                        for i in range(0, len(ytop)):
-                            xl = xind[i] + xincr
-                            xc = xl + width / 2.
-                            yc = ytop[i] + yincr
-                            if len(pLStack) > 1:
-                                subplot.errorbar(xc, yc, xerr=width * probBarUse * 0.5, ecolor='black')
-                                yc += yincr
-                            subplot.text(
-                                xc,
-                                yc,
-                                message,
-                                ha='center', va='bottom')
-                    xincr += width
-
-                plots = [p[0] for p in plotted]
-                #if len(x)>1:
-                subplot.set_xticks(xind + 0.5)
-                subplot.set_xticklabels(x)
-                subplot.set_xlim((0.0, float(len(x))))
-
-                if self.showLegends and (am or len(plotted) > 1):
-                    legends = [block.label(firstLine, self.values) for block in firstStack]
-                    subplot.legend(plots, legends)
-        
-        plt.tight_layout()
-        plt.show()
-
+                        print(("ytop:", ytop))
 
-def main(args):
+                if am:
+                    message = sp.stackLabels[j]
+                    lims = subplot.get_ylim()
+                    yincr = (lims[1] - lims[0]) * 0.02
+                    for i in range(0, len(ytop)):
+                        xl = xind[i] + xincr
+                        xc = xl + width / 2.
+                        yc = ytop[i] + yincr
+                        if len(rows) > 1:
+                            subplot.errorbar(xc, yc, xerr=width * probBarUse * 0.5, ecolor='black')
+                            yc += yincr
+                        subplot.text(
+                            xc,
+                            yc,
+                            message,
+                            ha='center', va='bottom')
+                xincr += width
+
+            handles = [p[0] for p in plotted]
+            #if len(x)>1:
+            subplot.set_xticks(xind + 0.5)
+            subplot.set_xticklabels(x)
+            subplot.set_xlim((0.0, float(len(x))))
+
+            if self.showLegends and (am or len(plotted) > 1):
+                first = numpy.flatnonzero(sp.stacks == 0)
+                subplot.legend(handles, [sp.labels[i] for i in first])
+        return artist
+
+    def lineData(self, subplot, x, row, x_axis):
+        """(x, y) arrays of series row to draw on subplot, decimated to its
+        width if self.decimate is set."""
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = self.seriesValues(row, x_axis, len(x))
+        if self.decimate:
+            i = decimate(y, int(subplot.get_window_extent().width))
+            return x[i], y[i]
+        return x, y
+
+
+def samePlots(a, b):
+    """True if PlotPlans a and b have the same subplots with the same
+    series, labels and colours (x values may differ)."""
+    if len(a.subplots) != len(b.subplots):
+        return False
+    for x, y in zip(a.subplots, b.subplots):
+        if x.name != y.name or x.bars != y.bars or x.labels != y.labels or x.colours != y.colours or \
+                not numpy.array_equal(x.series, y.series):
+            return False
+    return True
+
+
+def decimate(y, columns):
+    """Indices of the points of y to draw in a plot columns pixels wide: the
+    points are split into that many consecutive runs and the smallest and
+    largest value of each run are kept (along with the first and last point,
+    and the first NaN of each run so gaps in lines remain). Returns all
+    indices if y has no more than two points per column."""
+    n = len(y)
+    if columns <= 0 or n <= 2 * columns:
+        return numpy.arange(n)
+    k = -(-n // columns)
+    blocks = numpy.full(columns * k, numpy.nan)
+    blocks[:n] = y
+    blocks = blocks.reshape(columns, k)
+    isNaN = numpy.isnan(blocks)
+    starts = numpy.arange(columns) * k
+    lo = numpy.where(isNaN, numpy.inf, blocks).argmin(axis=1)
+    hi = numpy.where(isNaN, -numpy.inf, blocks).argmax(axis=1)
+    gaps = (starts + isNaN.argmax(axis=1))[isNaN.any(axis=1)]
+    i = numpy.unique(numpy.concatenate([starts + lo, starts + hi, gaps, [0, n - 1]]))
+    return i[i < n]
+
+
+def pyplot():
+    """Import matplotlib.pyplot (and hence an interactive backend) only when
+    figures are to be shown."""
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def renderFigures(plotter, plan, jobs):
+    """Draw each (SubplotPlan, fileName) of jobs as a figure with a single
+    plot, using the non-interactive Agg renderer, and save it to fileName
+    (the format is taken from the extension)."""
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    with matplotlib.rc_context({'font.size': 6}):
+        for sp, fileName in jobs:
+            fig = Figure(figsize=(10, 8))
+            FigureCanvasAgg(fig)
+            plotter.drawSubplot(fig.add_subplot(1, 1, 1), plan, sp)
+            fig.tight_layout()
+            fig.savefig(fileName)
+
+
+class TestPlotPlan (unittest.TestCase):
+    def setUp(self):
+        text = "".join("%d\t%d\t%d\t%d\n" % (s, g, m, 10 * m + g + s)
+                       for m in (0, 1, 3) for s in range(1, 4) for g in range(1, 3))
+        self.plotter = Plotter(set([Keys.MEASURE, Keys.SURVEY, Keys.GROUP]))
+        self.plotter.read(StringIO(text), "True", False)
+        self.cache = readOutput.columnCache
+        readOutput.columnCache = None
+        # set by configure (see main)
+        self.labelGlobals = (appendMeasureNumber, replaceFN)
+    def tearDown(self):
+        global appendMeasureNumber, replaceFN
+        readOutput.columnCache = self.cache
+        appendMeasureNumber, replaceFN = self.labelGlobals
+    def testLines (self):
+        plan = self.plotter.plan(False, "x-axis", "line", None, None, None)
+        self.assertEqual ([sp.name for sp in plan.subplots], ["m0_nHost", "m1_nInfect", "m3_nPatent"])
+        sp = plan.subplots[2]
+        self.assertEqual (sp.series.tolist(), [[3, -1, -1, 0, -1, -1], [3, -1, -1, 1, -1, -1], [3, -1, -1, 2, -1, -1]])
+        self.assertEqual (sp.labels, ["group 0", "group 1", "group 2"])
+        self.assertEqual (sp.colours, ["blue", "blueviolet", "brown"])
+        self.assertEqual (list(self.plotter.seriesValues(sp.series[2], plan.xAxis, len(sp.x))), [33.0, 34.0, 35.0])
+        self.assertTrue (self.plotter.plan(False, "x-axis", "line", None, None, None) is plan)
+    def testProduct (self):
+        plan = self.plotter.plan(True, "x-axis", "line", None, None, None)
+        self.assertEqual ([sp.title for sp in plan.subplots], ["Measures 0", "Measures 1, 3"])
+        sp = plan.subplots[1]
+        keys = [tuple(row) for row in sp.series.tolist()]
+        self.assertEqual (len(set(keys)), len(keys))
+        self.assertEqual (sp.labels, ["all,group 0", "patent,group 0", "all,group 1",
+                                      "patent,group 1", "all,group 2", "patent,group 2"])
+        plan = self.plotter.plan(True, "x-axis", "plot", None, None, None)
+        self.assertEqual ([sp.name for sp in plan.subplots], ["hosts_group-0", "hosts_group-1", "hosts_group-2",
+                                                             "infected-hosts_group-0", "infected-hosts_group-1",
+                                                             "infected-hosts_group-2"])
+    def testDerivedNames (self):
+        # derived measures are numbered from 100 in each plotter
+        plotters = list()
+        for spec in ("prev=nPatent/nHost", "double=2*nPatent", "prev=nPatent/nHost"):
+            plotter = Plotter(set([Keys.MEASURE, Keys.SURVEY, Keys.GROUP]))
+            plotter.values = self.plotter.values
+            plotter.derive(derivedMeasures.parseSpecs([spec], measureNames))
+            plotters.append(plotter)
+        for plotter, name in zip(plotters, ("prev", "double", "prev")):
+            plan = plotter.plan(False, "x-axis", "none", None, None, None)
+            self.assertEqual (plan.subplots[-1].yLabel, name + measureNumber(100))
+            plan = plotter.plan(True, "x-axis", "none", None, None, None)
+            self.assertEqual (plan.subplots[-1].series[:, 0].tolist(), [100])
+        self.assertTrue (100 not in measureNames)
+        self.assertEqual ([md[0] for md in combinedMeasures].count('derived measures'), 0)
+    def testWithoutMatplotlib (self):
+        # plans, including colours made unique, need no matplotlib
+        code = ("import sys; sys.modules['matplotlib'] = None\n"
+                "from io import BytesIO\n"
+                "from openmalaria.tools.plotResult import Plotter, Keys, ValDict\n"
+                "plotter = Plotter(set([Keys.MEASURE, Keys.SURVEY, Keys.GROUP]))\n"
+                "plotter.values = ValDict.load(BytesIO(sys.stdin.buffer.read()))\n"
+                "print(plotter.plan(True, 'x-axis', 'line', None, None, None).subplots[1].colours)\n")
+        saved = BytesIO()
+        self.plotter.values.save(saved)
+        top = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        out = subprocess.check_output([sys.executable, "-c", code], input=saved.getvalue(), cwd=top)
+        plan = self.plotter.plan(True, 'x-axis', 'line', None, None, None)
+        self.assertEqual (out.decode().strip(), str(plan.subplots[1].colours))
+    def testManySeries (self):
+        text = "".join("%d\t1\t0\t%d\n" % (s, s) for s in range(1, 5001))
+        plotter = Plotter(set([Keys.MEASURE, Keys.SURVEY, Keys.GROUP]))
+        plotter.read(StringIO(text), "True", False)
+        start = time.time()
+        plan = plotter.plan(False, "line", "x-axis", None, None, None)
+        self.assertEqual (plan.subplots[0].series.shape, (5000, 6))
+        self.assertLess (time.time() - start, 5.0)
+    def testFollow (self):
+        from matplotlib.figure import Figure
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, "output.txt")
+            with open(name, 'w') as f:
+                f.write("1\t1\t1\t10\n1\t2\t1\t20\n2\t2\t1\t21\n1\t1\t0\t50\n2\t1\t0\t50\n")
+            plotter = Plotter(set([Keys.MEASURE, Keys.SURVEY, Keys.GROUP, Keys.FILE]))
+            plotter.follow([name], "True")
+            fig = Figure()
+            plotter.drawLive(fig, False, "x-axis", "line", None, None, "plot")
+            self.assertEqual (plotter.poll(), set())
+            with open(name, 'a') as f:
+                f.write("3\t1\t1\t11\n3\t2\t1\t22\n")
+            changed = plotter.poll()
+            self.assertEqual (changed, set([(0, 1)]))
+            subplot, artist = plotter.live[1][1]
+            self.assertEqual (plotter.refresh(fig, changed, False, "x-axis", "line", None, None, "plot"), 3)
+            self.assertTrue (plotter.live[1][1][1] is artist)
+            self.assertEqual (artist.get_segments()[2][:, 1].tolist(), [20.0, 21.0, 22.0])
+            with open(name, 'a') as f:
+                f.write("3\t1\t3\t5\n")
+            self.assertEqual (plotter.refresh(fig, plotter.poll(), False, "x-axis", "line", None, None, "plot"), None)
+            self.assertEqual (len(plotter.live[0].subplots), 3)
+    def testFollowTruncated (self):
+        from matplotlib.figure import Figure
+        with tempfile.TemporaryDirectory() as d:
+            names = [os.path.join(d, name) for name in ("a.txt", "b.txt")]
+            for name in names:
+                with open(name, 'w') as f:
+                    f.write("1\t1\t1\t10\n2\t1\t1\t20\n")
+            # files aggregated (-f none)
+            plotter = Plotter(set([Keys.MEASURE, Keys.SURVEY]))
+            plotter.follow(names, "True")
+            fig = Figure()
+            plotter.drawLive(fig, False, "x-axis", "none", None, None, "none")
+            artist = plotter.live[1][0][1]
+            self.assertEqual (artist.get_ydata().tolist(), [20.0, 40.0])
+            with open(names[1], 'w') as f:
+                f.write("1\t1\t1\t5\n")
+            changed = plotter.poll()
+            self.assertEqual (changed, None)
+            self.assertEqual (plotter.refresh(fig, changed, False, "x-axis", "none", None, None, "none"), None)
+            artist = plotter.live[1][0][1]
+            self.assertEqual (artist.get_ydata().tolist(), [15.0, 20.0])
+            with open(names[1], 'a') as f:
+                f.write("2\t1\t1\t6\n")
+            changed = plotter.poll()
+            self.assertEqual (plotter.refresh(fig, changed, False, "x-axis", "none", None, None, "none"), 1)
+            self.assertEqual (artist.get_ydata().tolist(), [15.0, 26.0])
+    def testDecimate (self):
+        y = numpy.sin(numpy.arange(10000) * 0.01)
+        y[5000:5003] = numpy.nan
+        i = decimate(y, 100)
+        self.assertLessEqual (len(i), 301)
+        self.assertEqual ((i[0], i[-1]), (0, 9999))
+        self.assertTrue (numpy.all(numpy.diff(i) > 0))
+        self.assertEqual (numpy.nanmax(y[i]), numpy.nanmax(y))
+        self.assertEqual (numpy.nanmin(y[i]), numpy.nanmin(y))
+        self.assertTrue (numpy.isnan(y[i]).any())
+        self.assertEqual (len(decimate(y[:150], 100)), 150)
+    def testRender (self):
+        with tempfile.TemporaryDirectory() as d:
+            self.plotter.decimate = True
+            names = self.plotter.render(False, "x-axis", "line", None, None, None, d, "svg", 1)
+            self.assertEqual ([os.path.basename(n) for n in names],
+                              ["000_m0_nHost.svg", "001_m1_nInfect.svg", "002_m3_nPatent.svg"])
+            self.assertTrue (all(os.path.getsize(n) > 0 for n in names))
+    def testRenderFiles (self):
+        magic = {'png': b'\x89PNG', 'pdf': b'%PDF'}
+        with tempfile.TemporaryDirectory() as d:
+            # one figure per (measure, group) plot, drawn in two processes
+            names = self.plotter.render(False, "x-axis", "plot", None, None, None, d, "png", 2)
+            self.assertEqual (len(names), 9)
+            self.assertEqual (sorted(os.listdir(d)), sorted(os.path.basename(n) for n in names))
+            for n in names:
+                with open(n, 'rb') as f:
+                    self.assertEqual (f.read(4), magic['png'])
+            name = os.path.join(d, "output.txt")
+            with open(name, 'w') as f:
+                f.write("1\t1\t1\t10\n2\t1\t1\t11\n1\t1\t3\t5\n2\t1\t3\t6\n")
+            out = os.path.join(d, "pdf")
+            self.assertEqual (main(["plotResult", "-o", out, "--format", "pdf", name]), 0)
+            self.assertEqual (sorted(os.listdir(out)), ["000_infected-hosts_file-1.pdf"])
+            for n in os.listdir(out):
+                with open(os.path.join(out, n), 'rb') as f:
+                    self.assertEqual (f.read(4), magic['pdf'])
+
+
+def makeParser():
+    """The command-line options of plotResult (also used by plotServer)."""
     parser = OptionParser(usage="Usage: %prog [options] FILES",
                           description="""Plots results from an OpenMalaria (surveys) output
 file by time. Currently no support for simultaeneously handling
@@ -640,12 +1005,53 @@ genotype, file will be assigned to the x-axis.""", version="%prog 0.1")
     parser.add_option("--scale", action="store", type="choice", dest="scale", default="auto",
                       choices=["auto", "linear", "log"],
                       help="Set y-axis scale to linear, log or auto (currently auto does nothing)")
-
-    (options, others) = parser.parse_args(args=args[1:])
-    if len(others) == 0:
-        parser.print_usage()
-        return 1
-
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1,
+                      help="Number of processes used to read files and draw figures with -o "
+                           "(default: 1; 0 for one per CPU)")
+    parser.add_option("--no-cache", action="store_false", dest="cache", default=True,
+                      help="Don't use or update the cache of parsed output files")
+    parser.add_option("--clear-cache", action="store_true", dest="clearCache", default=False,
+                      help="Empty the cache of parsed output files before reading")
+    parser.add_option("--cache-dir", action="store", type="string", dest="cacheDir", default=None,
+                      help="Directory for the cache of parsed output files "
+                           "(default: $OPENMALARIA_CACHE_DIR or ~/.cache/openmalaria.tools)")
+    parser.add_option("-d", "--derive", action="append", dest="derive", default=[],
+                      help="Also plot a derived measure: either NAME=EXPRESSION over measures, "
+                           "e.g. 'prev=m3/m0' or 'prev=nPatent/nHost', or one of: " +
+                           ", ".join(name for name, expr, desc in derivedMeasures.builtins) +
+                           ". May be repeated. Measures used are read regardless of FILTEREXPR.")
+    parser.add_option("--scenario", action="store", type="string", dest="scenario", default=None,
+                      help="Scenario XML file of the outputs; when surveys are on the x-axis, "
+                           "plot against survey time (in years) instead of survey number")
+    parser.add_option("-o", "--output-dir", action="store", type="string", dest="outDir", default=None,
+                      help="Write each plot as a separate figure to this directory instead of "
+                           "showing them (no display is needed). Files are named by number and "
+                           "content, e.g. 001_infected-hosts_file-1.png")
+    parser.add_option("--format", action="store", type="choice", dest="format", default="png",
+                      choices=["png", "svg", "pdf"], help="File format of figures written with -o (default: png)")
+    parser.add_option("--decimate", action="store_true", dest="decimate", default=False,
+                      help="Reduce long lines to about two points (the minimum and maximum) per "
+                           "pixel of plot width before drawing; faster and smaller files for long "
+                           "series, but not exact (default: draw all points)")
+    parser.add_option("--store", action="store", type="string", dest="store", default=None,
+                      help="Read from this database (see ensembleStore) instead of output files; "
+                           "FILES are then file paths or scenario names in the database "
+                           "(default: all files)")
+    parser.add_option("--follow", action="store_true", dest="follow", default=False,
+                      help="Keep the plots up to date while FILES are being written (e.g. by a "
+                           "running simulation), reading only lines appended since the last check")
+    parser.add_option("--interval", action="store", type="float", dest="interval", default=5.0,
+                      help="Seconds between checks of FILES with --follow (default: 5)")
+    parser.add_option("--serve", action="store_true", dest="serve", default=False,
+                      help="Run a plot server on localhost instead of plotting FILES; see plotServer")
+    parser.add_option("--port", action="store", type="int", dest="port", default=8765,
+                      help="Port of the plot server (default: 8765)")
+    return parser
+
+
+def chooseXAxis(options):
+    """If no key is on the x-axis, put the first unassigned key there.
+    Returns False if there is none."""
     if options.s != "x-axis" and options.g != "x-axis" and options.c != "x-axis" and options.gt != "x-axis" and options.f != "x-axis":
         if options.s == "none":
             options.s = "x-axis"
@@ -658,9 +1064,12 @@ genotype, file will be assigned to the x-axis.""", version="%prog 0.1")
         elif options.f == "none":
             options.f = "x-axis"
         else:
-            print("Error: nothing assigned to x-axis!")
-            return 1
+            return False
+    return True
+
 
+def keysOf(options):
+    """Keys which are not aggregated."""
     keys = set()
     keys.add(Keys.MEASURE)
     if options.s != "none":
@@ -673,9 +1082,11 @@ genotype, file will be assigned to the x-axis.""", version="%prog 0.1")
         keys.add(Keys.GENOTYPE)
     if options.f != "none":
         keys.add(Keys.FILE)
+    return keys
 
-    plotter = Plotter(keys)
 
+def configure(plotter, options):
+    """Set how plotter draws (labels, legends, etc.) from options."""
     global appendMeasureNumber
     appendMeasureNumber = not ('t' in options.labels)
     global replaceFN
@@ -686,11 +1097,77 @@ genotype, file will be assigned to the x-axis.""", version="%prog 0.1")
     plotter.showYLabel = 'y' in options.labels
     plotter.horizSubBars = options.horizSubBars
     plotter.scale = options.scale
+    plotter.decimate = options.decimate
 
-    for output in others:
-        plotter.read(output, options.filterExpr, options.debugFilter)
 
-    plotter.plot(options.am, options.s, options.g, options.c, options.gt, options.f)
+def readValues(plotter, options, others):
+    """Read the values selected by options from the files (or store
+    entries) others, then attach survey times and compute derived measures."""
+    if options.store is not None:
+        plotter.readStore(options.store, others or None, options.filterExpr, options.debugFilter)
+    else:
+        plotter.readMany(others, options.filterExpr, options.debugFilter, options.jobs)
+
+    if options.scenario is not None:
+        surveyTimes.attach(plotter.values, options.scenario)
+
+    if options.derive:
+        derived = derivedMeasures.parseSpecs(options.derive, measureNames)
+        source = None
+        if options.filterExpr != "True":
+            # read the measures used, which the filter may have excluded
+            source = ValDict(keysOf(options))
+            operands = "m in " + str(sorted(derivedMeasures.operandsOf(derived)))
+            if options.store is not None:
+                source.readStore(options.store, others or None, operands, False)
+            else:
+                source.readMany(others, operands, False, options.jobs)
+        plotter.derive(derived, source)
+
+
+def main(args):
+    parser = makeParser()
+    (options, others) = parser.parse_args(args=args[1:])
+    if options.cacheDir is not None:
+        readOutput.columnCache = ColumnCache(options.cacheDir)
+    if options.clearCache:
+        readOutput.columnCache.clear()
+        if len(others) == 0 and not options.serve:
+            return 0
+    if not options.cache:
+        readOutput.columnCache = None
+    if options.serve:
+        if len(others) == 0:
+            print("Error: give the files or directories to serve")
+            return 1
+        from openmalaria.tools import plotServer
+        return plotServer.serve(options.port, others)
+    if len(others) == 0 and options.store is None:
+        parser.print_usage()
+        return 1
+
+    if not chooseXAxis(options):
+        print("Error: nothing assigned to x-axis!")
+        return 1
+
+    plotter = Plotter(keysOf(options))
+    configure(plotter, options)
+    if options.follow:
+        if options.store is not None or options.derive or options.outDir is not None:
+            print("Error: --follow can't be used with --store, --derive or -o")
+            return 1
+        plotter.follow(others, options.filterExpr)
+        if options.scenario is not None:
+            surveyTimes.attach(plotter.values, options.scenario)
+        plotter.watch(options.am, options.s, options.g, options.c, options.gt, options.f, options.interval)
+        return 0
+    readValues(plotter, options, others)
+
+    if options.outDir is not None:
+        plotter.render(options.am, options.s, options.g, options.c, options.gt, options.f,
+                       options.outDir, options.format, options.jobs)
+    else:
+        plotter.plot(options.am, options.s, options.g, options.c, options.gt, options.f)
 
     return 0
 
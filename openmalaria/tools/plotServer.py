@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+A plot server for plotResult, started with plotResult.py --serve [--port
+PORT] FILES_OR_DIRS. It listens on localhost only and keeps the values read
+from output files in memory, so plotting the same files again with another
+layout only costs drawing.
+
+Requests take the usual plotResult command line (options and FILES) in the
+args parameter, and the token printed when the server starts:
+
+    /plot?token=T&args=-g line -s x-axis output.txt    figure of all plots (--format)
+    /data?token=T&args=-g line output.txt              the same plots as JSON
+
+Only the files and directories given at startup (and files under those
+directories) may be read. Filters are restricted to those evaluated as numpy
+masks (see readOutput.Filter), and options which write files or print
+debugging output are refused. Requests whose Host header is not this server's
+localhost address are refused, so that web pages can't reach the server
+through DNS rebinding.
+
+Values are cached per set of files (by path, size and modification time),
+filter, keys, scenario and derived measures; the least recently used are
+dropped when more than cacheSize sets are held.
+"""
+
+import collections
+import hmac
+import http.client
+import http.server
+import json
+import os
+import secrets
+import shlex
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+from io import BytesIO
+
+import matplotlib
+import numpy
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from openmalaria.tools import plotResult, readOutput
+
+contentTypes = {'png': 'image/png', 'svg': 'image/svg+xml', 'pdf': 'application/pdf'}
+
+# plotResult options (dest, flag) refused in requests
+refusedOptions = [('debugFilter', '--debug-filter'), ('outDir', '-o'), ('serve', '--serve'),
+                  ('follow', '--follow'), ('cacheDir', '--cache-dir'), ('clearCache', '--clear-cache')]
+
+def fileIdentity(name):
+    """(path, size, modification time) of file name, or name if it is not
+    a file (e.g. a scenario name in a store)."""
+    if not os.path.isfile(name):
+        return name
+    st = os.stat(name)
+    return (os.path.abspath(name), st.st_size, st.st_mtime_ns)
+
+class PlotterCache(object):
+    """Plotters with values read, least recently used first."""
+    def __init__(self, maxSize=8):
+        self.maxSize = maxSize
+        self.plotters = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, options, others):
+        """A Plotter with the values selected by options read from others,
+        reading them only if they are not cached or files have changed."""
+        keys = plotResult.keysOf(options)
+        key = (tuple(fileIdentity(name) for name in others), options.filterExpr,
+               tuple(sorted(keys)), options.store and fileIdentity(options.store),
+               options.scenario and fileIdentity(options.scenario), tuple(options.derive))
+        if key in self.plotters:
+            self.hits += 1
+            self.plotters.move_to_end(key)
+            return self.plotters[key]
+        self.misses += 1
+        plotter = plotResult.Plotter(keys)
+        plotResult.readValues(plotter, options, others)
+        self.plotters[key] = plotter
+        while len(self.plotters) > self.maxSize:
+            self.plotters.popitem(last=False)
+        return plotter
+
+def isServed(name, roots):
+    """True if name is one of roots (real paths) or under one which is a
+    directory."""
+    path = os.path.realpath(name)
+    for root in roots:
+        if path == root or (os.path.isdir(root) and path.startswith(os.path.join(root, ''))):
+            return True
+    return False
+
+def parseArgs(text, roots):
+    """Parse a plotResult command line; raise ValueError if it is invalid,
+    uses a refused option or filter, or names files which are not under
+    roots (real paths of the files and directories served)."""
+    parser = plotResult.makeParser()
+    def error(msg):
+        raise ValueError(msg)
+    def exit(status=0, msg=None):
+        raise ValueError("--help and --version are not available from the plot server")
+    parser.error = error
+    # --help and --version would print to the server's output and exit
+    parser.exit = exit
+    parser.print_help = parser.print_version = lambda file=None: None
+    options, others = parser.parse_args(args=shlex.split(text))
+    for dest, flag in refusedOptions:
+        if getattr(options, dest) != parser.defaults[dest]:
+            raise ValueError("option " + flag + " is not allowed by the plot server")
+    if not readOutput.Filter(options.filterExpr).vectorized:
+        raise ValueError("filter " + repr(options.filterExpr) + " is not allowed by the plot server "
+                         "(use only f, m, s, g, c, gt, constants, comparisons and arithmetic)")
+    if len(others) == 0 and options.store is None:
+        raise ValueError("no files given")
+    files = [name for name in (options.store, options.scenario) if name is not None]
+    if options.store is None:
+        files += others
+    for name in files:
+        if not isServed(name, roots):
+            raise ValueError(name + " is not one of the files served")
+    if not plotResult.chooseXAxis(options):
+        raise ValueError("nothing assigned to x-axis")
+    return options, others
+
+def planData(plotter, plan):
+    """The subplots of plan and their values, as JSON-compatible objects
+    (NaN becomes null)."""
+    r = list()
+    for sp in plan.subplots:
+        series = list()
+        for row, label, colour in zip(sp.series, sp.labels, sp.colours):
+            y = plotter.seriesValues(row, plan.xAxis, len(sp.x))
+            series.append({'key': dict(zip(('m', 'f', 's', 'g', 'c', 'gt'), row.tolist())),
+                           'label': label, 'colour': colour,
+                           'y': [None if numpy.isnan(v) else v for v in y.tolist()]})
+        r.append({'name': sp.name, 'title': sp.title, 'xLabel': sp.xLabel, 'yLabel': sp.yLabel,
+                  'x': list(sp.x), 'series': series})
+    return {'subplots': r}
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        port = str(self.server.server_address[1])
+        if self.headers.get('Host') not in ('127.0.0.1:' + port, 'localhost:' + port):
+            self.send_error(403, explain="unexpected Host header")
+            return
+        if not hmac.compare_digest(query.get('token', [''])[0], self.server.token):
+            self.send_error(403, explain="missing or wrong token")
+            return
+        if url.path == '/':
+            self.reply(200, 'text/plain', (__doc__.strip() + "\n").encode())
+            return
+        if url.path not in ('/plot', '/data'):
+            self.send_error(404)
+            return
+        try:
+            options, others = parseArgs(query.get('args', [''])[0], self.server.roots)
+            plotter = self.server.plotters.get(options, others)
+            plotResult.configure(plotter, options)
+            plan = plotter.plan(options.am, options.s, options.g, options.c, options.gt, options.f)
+            if url.path == '/data':
+                body = json.dumps(planData(plotter, plan)).encode()
+                self.reply(200, 'application/json', body)
+            else:
+                self.reply(200, contentTypes[options.format], renderPlan(plotter, plan, options.format))
+        except Exception as e:
+            self.send_error(400, explain=str(e))
+
+    def reply(self, code, contentType, body):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def renderPlan(plotter, plan, fmt):
+    """Draw plan as one figure (as Plotter.plot would) and return it in
+    format fmt."""
+    with matplotlib.rc_context({'font.size': 6}):
+        fig = Figure(figsize=(10, 8))
+        FigureCanvasAgg(fig)
+        plotter.drawFigure(fig, plan)
+        fig.tight_layout()
+        out = BytesIO()
+        fig.savefig(out, format=fmt)
+    return out.getvalue()
+
+def makeServer(port, roots, cacheSize=8):
+    """An HTTP server on localhost:port (0 for any free port) for the files
+    roots and files under the directories roots. Requests are handled one at
+    a time and must include server.token."""
+    server = http.server.HTTPServer(('127.0.0.1', port), Handler)
+    server.plotters = PlotterCache(cacheSize)
+    server.roots = [os.path.realpath(name) for name in roots]
+    server.token = secrets.token_urlsafe(16)
+    server.quiet = False
+    return server
+
+def serve(port, roots, cacheSize=8):
+    server = makeServer(port, roots, cacheSize)
+    print("Serving plots of " + ", ".join(roots) + " on http://127.0.0.1:" +
+          str(server.server_address[1]) + "/?token=" + server.token + " (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+class TestPlotServer (unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "output.txt")
+        with open(self.file, 'w') as f:
+            f.write("".join("%d\t%d\t%d\t%d\n" % (s, g, m, s + g) for m in (1, 3) for s in range(1, 6) for g in (1, 2)))
+        self.cache = readOutput.columnCache
+        readOutput.columnCache = None
+        self.server = makeServer(0, [self.dir.name])
+        self.server.quiet = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        readOutput.columnCache = self.cache
+        self.dir.cleanup()
+    def get(self, path, args, token=None):
+        url = "http://127.0.0.1:" + str(self.server.server_address[1]) + path + "?" + \
+            urllib.parse.urlencode({'token': token or self.server.token, 'args': args})
+        with urllib.request.urlopen(url, timeout=10) as r:
+            return r.headers['Content-Type'], r.read()
+    def status(self, path, args, token=None):
+        try:
+            self.get(path, args, token)
+        except urllib.error.HTTPError as e:
+            return e.code
+        return 200
+    def testPlotAndData (self):
+        kind, body = self.get("/plot", "-g line " + shlex.quote(self.file))
+        self.assertEqual ((kind, body[:4]), ('image/png', b'\x89PNG'))
+        start = time.time()
+        kind, body = self.get("/data", "-s line -g x-axis " + shlex.quote(self.file))
+        self.assertLess (time.time() - start, 1.0)
+        data = json.loads(body.decode())
+        self.assertEqual ([sp['title'] for sp in data['subplots']], ["Measures 1, 3"])
+        self.assertEqual (len(data['subplots'][0]['series']), 10)
+        self.assertEqual (data['subplots'][0]['series'][0]['y'], [None, 2.0, 3.0])
+        self.assertEqual ((self.server.plotters.hits, self.server.plotters.misses), (1, 1))
+    def testInvalidation (self):
+        self.get("/data", self.file)
+        with open(self.file, 'a') as f:
+            f.write("6\t1\t1\t7\n")
+        self.get("/data", self.file)
+        self.assertEqual (self.server.plotters.misses, 2)
+        self.assertEqual (self.status("/plot", "--bad-option " + shlex.quote(self.file)), 400)
+        for args in ("--help", "--version " + shlex.quote(self.file)):
+            self.assertEqual (self.status("/data", args), 400)
+            self.assertEqual (self.status("/data", shlex.quote(self.file)), 200)
+    def testRestrictions (self):
+        name = shlex.quote(self.file)
+        self.assertEqual (self.status("/data", "-e 'm == 3 and s > 1' " + name), 200)
+        self.assertEqual (self.status("/data", name, "x" + self.server.token), 403)
+        for args in ("-e \"__import__('os').system('true')\" " + name, "-e 'open(f)' " + name,
+                     "-e \"'a' * 9999999999\" " + name, "-e 'm * (f * 9999999999)' " + name,
+                     "--debug-filter " + name, "-o " + shlex.quote(self.dir.name) + " " + name,
+                     "--cache-dir /tmp " + name, "/etc/passwd", shlex.quote(self.dir.name + "/../x"),
+                     "--scenario /etc/hosts " + name):
+            self.assertEqual (self.status("/data", args), 400, args)
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1])
+        try:
+            connection.request("GET", "/?token=" + self.server.token, headers={'Host': 'attacker.example:80'})
+            self.assertEqual (connection.getresponse().status, 403)
+        finally:
+            connection.close()
+    def testDerivedNames (self):
+        # the last request is served by the first (cached) plotter, with a new plan
+        for spec, layout in (("ratio=m3/m1", ""), ("double=2*m3", ""), ("ratio=m3/m1", "-n ")):
+            data = json.loads(self.get("/data", "-a " + layout + "-d " + spec + " " + shlex.quote(self.file))[1].decode())
+            self.assertEqual (data['subplots'][-1]['yLabel'].split(" (")[0], spec.split("=")[0])
+
+if __name__ == '__main__':
+    unittest.main()
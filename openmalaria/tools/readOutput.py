@@ -11,7 +11,22 @@
 
 
 import unittest
-from io import StringIO, BytesIO
+import ast
+import bz2
+import concurrent.futures
+import gzip
+import itertools
+import json
+import lzma
+import functools
+import operator
+import os
+import tempfile
+from io import StringIO
+
+import numpy
+
+from openmalaria.tools.outputCache import ColumnCache
 
 class Keys:
     NONE=0
@@ -52,7 +67,7 @@ class Multi3Keys(object):
     def __eq__(self,other):
         return (self.a == other.a) and (self.b == other.b) and (self.c == other.c)
     def __hash__(self):
-        return self.a.__hash__() ^ self.b.__hash__() ^ self.c.__hash__()
+        return hash((self.a, self.b, self.c))
 
 class TestMultiKeys (unittest.TestCase):
     def setUp(self):
@@ -71,48 +86,454 @@ class TestMultiKeys (unittest.TestCase):
         self.assertTrue (self.a1.__hash__() != self.a3.__hash__()) # actually, hash collisions are possible
         self.assertTrue (self.b1.__hash__() == self.b2.__hash__())
 
+class TestEntries (unittest.TestCase):
+    def testEntries (self):
+        e = Entries([3,0,3,0],[1,1,1,2],[2001000,0,2001000,1],[1.0,2.0,3.0,4.0])
+        self.assertEqual (len(e), 3)
+        self.assertEqual (e[Multi3Keys(3,1,2001000)], 3.0)
+        self.assertEqual (e[Multi3Keys(0,2,1)], 4.0)
+        self.assertTrue (Multi3Keys(0,2,0) not in e)
+        self.assertTrue (Multi3Keys(0,"abc",0) not in e)
+        self.assertRaises (KeyError, e.__getitem__, Multi3Keys(0,3,0))
+        self.assertEqual ([(k.a,k.b,k.c) for k in e.keys()], [(0,1,0),(0,2,1),(3,1,2001000)])
+        r = e.lookup([0,0,3],[2,2,1],[1,0,2001000])
+        self.assertEqual (r[0], 4.0)
+        self.assertTrue (numpy.isnan(r[1]))
+        self.assertEqual (r[2], 3.0)
+        # many genotypes
+        e = Entries([1,1],[1,2],[250003001,0],[5.0,6.0])
+        self.assertEqual (e[Multi3Keys(1,1,250003001)], 5.0)
+        self.assertEqual (list(unpackKeys(e.packed)[2]), [250003001,0])
+
+class TestParse (unittest.TestCase):
+    def testParse (self):
+        text = "1\t0\t0\t100\n1\t2001003\t3\t-nan\n2\t0\t3\t1.#QNAN\n"
+        cols, nErrs = parseLines(text, "test")
+        self.assertEqual (nErrs, 0)
+        self.assertEqual (list(cols['s']), [1,1,2])
+        self.assertEqual (cols['v'][0], 100.0)
+        self.assertTrue (numpy.isnan(cols['v'][1:]).all())
+        g, c, gt = decodeGroups(cols['g'])
+        self.assertEqual ((g[1],c[1],gt[1]), (3,1,2))
+    def testErrors (self):
+        text = "1 0 0 100\n\n1 0 0\n1 0 0 5 6\n2 0 0 3\n"
+        cols, nErrs = parseLines(text, "test", 2)
+        self.assertEqual (nErrs, 5)
+        self.assertEqual (list(cols['v']), [100.0, 3.0])
+        self.assertRaises (Exception, parseLines, text, "test", 3)
+
+class TestFilter (unittest.TestCase):
+    def check (self, expr, vectorized):
+        flt = Filter(expr)
+        self.assertEqual (flt.vectorized, vectorized)
+        m = numpy.array([0,3,11,12,14])
+        s = numpy.array([1,2,3,4,5])
+        g = numpy.array([0,1,0,1,0])
+        z = numpy.zeros(5, dtype=int)
+        expected = [bool(eval(expr, {}, {'f':"out.txt", 'm':m1, 's':s1, 'g':g1, 'c':0, 'gt':0}))
+                    for m1,s1,g1 in zip(m.tolist(),s.tolist(),g.tolist())]
+        self.assertEqual (flt("out.txt",m,s,g,z,z).tolist(), expected)
+    def testVectorized (self):
+        self.check ("True", True)
+        self.check ("m!=0", True)
+        self.check ("m in [11,12,13]", True)
+        self.check ("s > 2 and m not in (3,) or not g", True)
+        self.check ("1 < s <= 4 and g % 2 == 1", True)
+        self.check ("f == 'out.txt' and m", True)
+        self.check ("-(m + 1) < -s * 2.5 and not -g", True)
+    def testFallback (self):
+        self.check ("abs(m - 12) < 2", False)
+        self.check ("len('ab' * 2) == 4 and m", False)
+        self.check ("m > -s and f + 'x' != 'out.txtx'", False)
+
+class TestMeasureDict (unittest.TestCase):
+    def testAdd (self):
+        md = MeasureDict(0)
+        md.add(2,1,0,0,0,1.5)
+        md.add(2,1,0,0,0,2.0)
+        md.add(5,0,0,1,1,3.0)
+        self.assertEqual (md.get(2,1,0,0,0), 3.5)
+        self.assertEqual (md.get(5,0,0,1,1), 3.0)
+        self.assertTrue (numpy.isnan(md.get(1,0,0,0,0)))
+        self.assertTrue (numpy.isnan(md.get(6,0,0,0,0)))
+        self.assertEqual (md.getArray().shape, (2,6,2,1,2))
+        self.assertEqual (md.getGroups(), [0,1])
+    def testAddArrays (self):
+        md = MeasureDict(0)
+        md.addArrays([1,1,2],[0,0,3],0,0,0,numpy.array([1.0,2.0,4.0]))
+        md.add(1,0,0,0,0,1.0)
+        self.assertEqual (md.get(1,0,0,0,0), 4.0)
+        self.assertEqual (md.get(2,3,0,0,0), 4.0)
+        self.assertEqual (md.getArray().shape, (1,3,4,1,1))
+
+class TestGetArray (unittest.TestCase):
+    def testGetArray (self):
+        values = ValDict(Keys.all)
+        values.read(StringIO("1\t0\t0\t1\n1\t1\t0\t2\n2\t0\t0\t3\n2\t0\t3\t4\n3\t2001000\t3\t5\n"), "True", False)
+        for m in (0, 3):
+            for axis in arrayAxes:
+                for fixed in ({}, {Keys.SURVEY: 2}, {Keys.GROUP: 1, Keys.SURVEY: 1}, {Keys.GROUP: 7}):
+                    start, stop = values.axisRange(m, axis)
+                    k = [fixed.get(key) for key in (Keys.SURVEY, Keys.GROUP, Keys.COHORT, Keys.GENOTYPE, Keys.FILE)]
+                    expected = list()
+                    for i in range(start, stop):
+                        k[[Keys.SURVEY, Keys.GROUP, Keys.COHORT, Keys.GENOTYPE, Keys.FILE].index(axis)] = i
+                        expected.append(values.get(m, *k))
+                    numpy.testing.assert_array_equal (values.getArray(m, axis, fixed), expected)
+        a = values.getArray(0, (Keys.GROUP, Keys.SURVEY))
+        self.assertEqual (a.shape, (2, 3))
+        self.assertEqual (a[1,0], 2.0)
+        a = values.getArray(3, (Keys.COHORT, Keys.SURVEY), {Keys.GENOTYPE: 2})
+        self.assertEqual (a.shape, (2, 3))
+        self.assertEqual (a[1,2], 5.0)
+        self.assertTrue (numpy.may_share_memory(a, values.values[3].v))
+
+class TestIndex (unittest.TestCase):
+    def setUp(self):
+        global columnCache
+        self.cache = columnCache
+        self.dir = tempfile.TemporaryDirectory()
+        columnCache = ColumnCache(os.path.join(self.dir.name, "cache"))
+        self.name = os.path.join(self.dir.name, "output.txt")
+        with open(self.name, 'w') as f:
+            for s in range(1,6):
+                for m in (0,3,14):
+                    for g in range(5):
+                        f.write("%d\t%d\t%d\t%d\n" % (s, g, m, s*m+g))
+            f.write("6\t0\t3\n")
+    def tearDown(self):
+        global columnCache
+        columnCache = self.cache
+        self.dir.cleanup()
+    def testErrorsNotCached (self):
+        with open(self.name, 'a') as f:
+            f.write("7\t0\t3\n" * 6)
+        self.assertEqual (len(readEntries(self.name).vals), 75)
+        self.assertTrue (columnCache.load(self.name) is None)
+        with self.assertRaises (Exception):
+            readColumns(self.name)
+        with self.assertRaises (Exception):
+            ValDict(Keys.all).read(self.name, "True", False)
+    def testRestriction (self):
+        self.assertEqual (Filter("m in [3,14] and s > 2").restriction('m'), set([3,14]))
+        self.assertEqual (Filter("m == 3 or 14 == m").restriction('m'), set([3,14]))
+        self.assertEqual (Filter("m == 3 or s == 2").restriction('m'), None)
+        self.assertEqual (Filter("m != 0").restriction('m'), None)
+    def testIndexed (self):
+        full = ValDict(Keys.all)
+        full.read(self.name, "True", False)
+        index = columnCache.load(self.name, 'index')
+        self.assertEqual (len(index), 16)
+        self.assertEqual (index['m'][-1], -1)
+        # index is only used when columns are not cached
+        columnCache.remove(columnCache.entryName(self.name, 'columns'))
+        for expr in ("m == 3", "m in [0,14] and s in (2,3)", "s == 4"):
+            parts = list(iterIndexed(self.name, index, Filter(expr).restriction('m'), Filter(expr).restriction('s')))
+            self.assertTrue (sum(len(p) for p in parts) < 30)
+            sel = ValDict(Keys.all)
+            sel.read(self.name, expr, False)
+            ref = ValDict(Keys.all)
+            ref.read(StringIO(open(self.name).read()), expr, False)
+            self.assertEqual (sel.getMeasures(), ref.getMeasures())
+            for m in ref.getMeasures():
+                numpy.testing.assert_array_equal (sel.toArray(m), ref.toArray(m))
+
+class TestFollower (unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.name = os.path.join(self.dir.name, "output.txt")
+    def tearDown(self):
+        self.dir.cleanup()
+    def write (self, text, mode='a'):
+        with open(self.name, mode) as f:
+            f.write(text)
+    def testFollow (self):
+        values = ValDict(Keys.all)
+        follower = OutputFollower(values, self.name)
+        self.assertEqual (follower.update(), 0)
+        self.write ("1\t0\t0\t100\n1\t0\t3\t1")
+        self.assertEqual (follower.update(), 1)
+        self.assertEqual (values.getMeasures(), [0])
+        self.write ("0\n2\t0\t3\t20\n")
+        self.assertEqual (follower.update(), 2)
+        self.assertEqual (values.get(3,1,0,0,0,0), 10.0)
+        self.assertEqual (values.get(3,2,0,0,0,0), 20.0)
+        self.assertEqual (values.getSurveys(3), [1,2])
+        self.assertEqual (follower.measures, set([3]))
+        # truncated: start again
+        self.write ("1\t0\t3\t5\n", 'w')
+        self.assertEqual (follower.update(), 1)
+        self.assertEqual (follower.measures, None)
+        self.assertEqual (values.get(3,1,0,0,0,0), 5.0)
+        self.assertTrue (numpy.isnan(values.get(3,2,0,0,0,0)))
+    def testAggregated (self):
+        values = ValDict(Keys.all - set([Keys.FILE]))
+        other = os.path.join(self.dir.name, "other.txt")
+        with open(other, 'w') as f:
+            f.write("1\t0\t3\t1\n")
+        self.write ("1\t0\t3\t10\n2\t0\t3\t20\n")
+        followers = [OutputFollower(values, name) for name in (other, self.name)]
+        self.assertEqual ([f.update() for f in followers], [1, 2])
+        self.assertEqual (values.get(3,1,0,0,0,0), 11.0)
+        # truncated: values of both files are cleared and read again
+        self.write ("1\t0\t3\t5\n", 'w')
+        self.assertEqual ([f.update() for f in followers], [0, 1])
+        self.assertEqual (followers[1].measures, None)
+        self.assertEqual (values.get(3,1,0,0,0,0), 5.0)
+        self.assertEqual ([f.update() for f in followers], [1, 0])
+        self.assertEqual (followers[0].measures, None)
+        self.assertEqual (values.get(3,1,0,0,0,0), 6.0)
+        self.assertTrue (numpy.isnan(values.get(3,2,0,0,0,0)))
+        self.assertEqual ([f.update() for f in followers], [0, 0])
+        self.assertEqual ([f.measures for f in followers], [set(), set()])
+
+class TestSparse (unittest.TestCase):
+    def testSparse (self):
+        dense = MeasureDict(0)
+        sparse = SparseMeasureDict(0)
+        for md in (dense, sparse):
+            md.addArrays([1,1,2],[0,0,3],[0,2,0],[0,0,5],0,numpy.array([1.0,2.0,4.0]))
+            md.add(1,0,0,0,1,1.0)
+            md.add(1,0,0,0,0,1.0)
+        self.assertEqual (sparse.shape(), dense.shape())
+        self.assertEqual (sparse.get(1,0,0,0,0), 2.0)
+        self.assertTrue (numpy.isnan(sparse.get(2,0,0,0,0)))
+        self.assertEqual (sparse.countSet(), 4)
+        numpy.testing.assert_array_equal (sparse.getArray(), dense.getArray())
+        for index in ((0, slice(0,3), 0, 0, 0), (0, 1, slice(0,4), slice(1,3), slice(0,6)),
+                      (slice(0,2), slice(1,2), 0, 0, slice(0,6)), (1, 2, 3, 0, 5), (0, slice(2,2), 0, 0, 0)):
+            numpy.testing.assert_array_equal (sparse.getSlice(index), dense.getSlice(index))
+        merged = MeasureDict(0)
+        merged.merge(sparse,0)
+        merged.merge(sparse,1)
+        sparse.merge(dense,1)
+        numpy.testing.assert_array_equal (sparse.getArray(), merged.getArray())
+    def testAutomatic (self):
+        global sparseMinCells
+        minCells = sparseMinCells
+        sparseMinCells = 100
+        try:
+            values = ValDict(Keys.all)
+            values.read(StringIO("1\t0\t3\t1\n1\t1\t3\t2\n2\t5002007\t3\t3\n"), "True", False)
+            self.assertTrue (isinstance(values.values[3], SparseMeasureDict))
+            self.assertEqual (values.get(3,2,7,2,5,0), 3.0)
+            self.assertEqual (values.getGenotypes(3), list(range(6)))
+            self.assertTrue (numpy.isnan(values.get(3,2,7,2,4,0)))
+            fixed = {Keys.GROUP: 7, Keys.COHORT: 2}
+            numpy.testing.assert_array_equal (values.getArray(3, (Keys.GENOTYPE, Keys.SURVEY), fixed),
+                [[numpy.nan]*2]*5 + [[numpy.nan, 3.0]])
+            numpy.testing.assert_array_equal (values.getArray(3, Keys.SURVEY, {Keys.GROUP: 9}), [numpy.nan]*2)
+        finally:
+            sparseMinCells = minCells
+
+class TestReadMany (unittest.TestCase):
+    def setUp(self):
+        global columnCache
+        self.cache = columnCache
+        columnCache = None
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = list()
+        for i in range(3):
+            name = os.path.join(self.dir.name, "output"+str(i)+".txt")
+            with open(name, 'w') as f:
+                for s in range(1,4):
+                    f.write("%d\t0\t0\t%d\n%d\t1\t3\t%d\n%d\t1001\t3\t1\n" % (s, 100+i, s, s*i, s))
+            self.files.append(name)
+    def tearDown(self):
+        global columnCache
+        columnCache = self.cache
+        self.dir.cleanup()
+    def check (self, keys):
+        seq = ValDict(keys)
+        for name in self.files:
+            seq.read(name, "True", False)
+        par = ValDict(keys)
+        par.readMany(self.files, "True", False, 2)
+        self.assertEqual (par.files, seq.files)
+        self.assertEqual (par.getMeasures(), seq.getMeasures())
+        self.assertEqual (par.nSurveys, seq.nSurveys)
+        for m in seq.getMeasures():
+            numpy.testing.assert_array_equal (par.toArray(m), seq.toArray(m))
+    def testSeparate (self):
+        self.check (Keys.all)
+    def testCompressed (self):
+        for module in (gzip, bz2, lzma):
+            name = os.path.join(self.dir.name, "output."+module.__name__)
+            with open(self.files[0], 'rb') as src, module.open(name, 'wb') as dest:
+                dest.write(src.read())
+            self.assertEqual (splitRanges(name, 4), [(0, os.path.getsize(name))])
+            numpy.testing.assert_array_equal (readColumns(name), readColumns(self.files[0]))
+    def testSaveLoad (self):
+        global sparseMinCells, sparseMaxDensity
+        minCells, maxDensity = sparseMinCells, sparseMaxDensity
+        for keys in (Keys.all, set([Keys.MEASURE, Keys.SURVEY])):
+            for sparse in (False, True):
+                if sparse:
+                    sparseMinCells, sparseMaxDensity = 0, 2.0
+                try:
+                    seq = ValDict(keys)
+                    for name in self.files:
+                        seq.read(name, "True", False)
+                    # each process acts as a node reducing some files
+                    parts = [os.path.join(self.dir.name, name) for name in ("part0.npz", "part1.dat")]
+                    with concurrent.futures.ProcessPoolExecutor(2) as pool:
+                        list(pool.map(readAndSave, [keys]*2, [self.files[:2], self.files[2:]],
+                                      ["True"]*2, parts, [False, True]))
+                finally:
+                    sparseMinCells, sparseMaxDensity = minCells, maxDensity
+                merged = ValDict.load(parts[0])
+                merged.merge(ValDict.load(parts[1]))
+                self.assertEqual (merged.files, seq.files)
+                self.assertEqual (merged.getMeasures(), seq.getMeasures())
+                self.assertEqual (merged.nSurveys, seq.nSurveys)
+                for m in seq.getMeasures():
+                    self.assertEqual (isinstance(merged.values[m], SparseMeasureDict), sparse)
+                    numpy.testing.assert_array_equal (merged.toArray(m), seq.toArray(m))
+    def testSplit (self):
+        global minRangeSize
+        size = minRangeSize
+        minRangeSize = 10
+        try:
+            ranges = splitRanges(self.files[0], 4)
+            self.assertEqual (len(ranges), 4)
+            for keys in (Keys.all, set([Keys.MEASURE, Keys.GROUP])):
+                seq = ValDict(keys)
+                seq.read(self.files[0], "m!=0", False)
+                par = ValDict(keys)
+                par.read(self.files[0], "m!=0", False, 4)
+                self.assertEqual (par.files, seq.files)
+                self.assertEqual (par.nSurveys, seq.nSurveys)
+                numpy.testing.assert_array_equal (par.toArray(3), seq.toArray(3))
+        finally:
+            minRangeSize = size
+    def testAggregate (self):
+        self.check (set([Keys.MEASURE, Keys.SURVEY]))
+
 def isAgeGroup(measure):
     if measure in set([7,9,21,25,26,28,29,31,32,33,34,35,36,39,40,47,48,49,50,51,54]):
         return False
     return True
 
 class MeasureDict(object):
+    """Values of one measure, stored in a dense array indexed by
+    [file, survey, group, cohort, genotype].
+    
+    Storage is grown geometrically as new indices are seen. Cells which have
+    never been added to hold NaN."""
     def __init__(self,m):
+        self.nFiles = 0
+        self.nSurveys = 0       # number of survey slots (survey numbers start at 1)
         self.nGroups = 0
         self.nCohorts = 0
         self.nGenotypes = 0
-        #(list by fileID) of (list by survey) of (list by group) of (list by cohort) of (list by genotype)
-        self.v=list()
+        self.v = numpy.empty((0,0,0,0,0))
+        self.isSet = numpy.zeros((0,0,0,0,0), dtype=bool)
         if m>=31 and m<=34:
             self.groupLabel="vector species"
         else:
             self.groupLabel="age group"
+    def reserve(self,nFiles,nSurveys,nGroups,nCohorts,nGenotypes):
+        """Make sure the logical shape is at least the given size, growing
+        storage if necessary."""
+        need = (nFiles,nSurveys,nGroups,nCohorts,nGenotypes)
+        cap = self.v.shape
+        if any(n > c for n,c in zip(need,cap)):
+            # grow each exceeded axis to at least double its old capacity
+            newCap = tuple(max(n,2*c) if n > c else c for n,c in zip(need,cap))
+            v = numpy.full(newCap, numpy.nan)
+            isSet = numpy.zeros(newCap, dtype=bool)
+            old = tuple(slice(0,c) for c in cap)
+            v[old] = self.v
+            isSet[old] = self.isSet
+            self.v = v
+            self.isSet = isSet
+        self.nFiles = max(self.nFiles,nFiles)
+        self.nSurveys = max(self.nSurveys,nSurveys)
+        self.nGroups = max(self.nGroups,nGroups)
+        self.nCohorts = max(self.nCohorts,nCohorts)
+        self.nGenotypes = max(self.nGenotypes,nGenotypes)
     def add(self,survey,group,cohort,genotype,f,value):
         """survey:int, group:int, cohort:int, genotype:int, f:int, value:float"""
-        self.nGroups = max(self.nGroups,group+1)
-        self.nCohorts = max(self.nCohorts,cohort+1)
-        self.nGenotypes = max(self.nGenotypes,genotype+1)
-        
-        while f>=len(self.v):
-            self.v.append(list())
-        surveys=self.v[f]
-        while survey >= len(surveys):
-            surveys.append(list())
-        groups=surveys[survey]
-        while group >= len(groups):
-            groups.append(list())
-        cohorts=groups[group]
-        while cohort >= len(cohorts):
-            cohorts.append(list())
-        genotypes=cohorts[cohort]
-        while genotype >= len(genotypes):
-            genotypes.append(0.0)
-        genotypes[genotype] += value
+        self.reserve(f+1,survey+1,group+1,cohort+1,genotype+1)
+        i = (f,survey,group,cohort,genotype)
+        if self.isSet[i]:
+            self.v[i] += value
+        else:
+            self.v[i] = value
+            self.isSet[i] = True
+    def addArrays(self,survey,group,cohort,genotype,f,values):
+        """Like add, but all arguments are integer arrays (or scalars) of the
+        same length as the float array values. Repeated indices are summed."""
+        n = len(values)
+        if n == 0:
+            return
+        index = [numpy.broadcast_to(numpy.asarray(a,dtype=numpy.intp),(n,))
+                 for a in (f,survey,group,cohort,genotype)]
+        self.reserve(*[int(a.max())+1 for a in index])
+        flat = numpy.ravel_multi_index(index, self.v.shape)
+        v = self.v.reshape(-1)
+        isSet = self.isSet.reshape(-1)
+        new = flat[~isSet[flat]]
+        v[new] = 0.0
+        isSet[new] = True
+        numpy.add.at(v, flat, values)
+    def shape(self):
+        """Logical shape: (files, surveys, groups, cohorts, genotypes)."""
+        return (self.nFiles,self.nSurveys,self.nGroups,self.nCohorts,self.nGenotypes)
+    def countSet(self):
+        """Number of cells which have been added to."""
+        return int(numpy.count_nonzero(self.isSet))
+    def coordinates(self):
+        """Return (index, values) for all set cells, where index is a tuple of
+        arrays (file, survey, group, cohort, genotype)."""
+        isSet = self.isSet[:self.nFiles, :self.nSurveys, :self.nGroups, :self.nCohorts, :self.nGenotypes]
+        index = numpy.nonzero(isSet)
+        return index, self.getArray()[index]
+    def clearFile(self,f):
+        """Mark all cells of file f as missing."""
+        if f < self.nFiles:
+            self.v[f] = numpy.nan
+            self.isSet[f] = False
+    def merge(self,other,fOffset):
+        """Add all values of MeasureDict other, with file indices offset by
+        fOffset."""
+        if other.nFiles == 0:
+            return
+        if isinstance(other, SparseMeasureDict):
+            (f,s,g,c,gt), values = other.coordinates()
+            self.addArrays(s,g,c,gt,f+fOffset,values)
+            return
+        self.reserve(fOffset+other.nFiles,other.nSurveys,other.nGroups,other.nCohorts,other.nGenotypes)
+        region = (slice(fOffset,fOffset+other.nFiles), slice(0,other.nSurveys),
+                  slice(0,other.nGroups), slice(0,other.nCohorts), slice(0,other.nGenotypes))
+        v = self.v[region]
+        isSet = self.isSet[region]
+        otherSet = other.isSet[(slice(0,other.nFiles),)+region[1:]]
+        v[otherSet & ~isSet] = 0.0
+        v[otherSet] += other.getArray()[otherSet]
+        isSet |= otherSet
+    def __getstate__(self):
+        # pickle only the used part of storage
+        state = dict(self.__dict__)
+        state['v'] = self.getArray().copy()
+        state['isSet'] = self.isSet[:self.nFiles, :self.nSurveys, :self.nGroups, :self.nCohorts, :self.nGenotypes].copy()
+        return state
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+    def getArray(self):
+        """Return a view of all values, indexed by
+        [file, survey, group, cohort, genotype]. Missing cells are NaN."""
+        return self.v[:self.nFiles, :self.nSurveys, :self.nGroups, :self.nCohorts, :self.nGenotypes]
+    def getSlice(self,index):
+        """Return getArray()[index], where index has one integer or slice
+        (with unit step) per axis, all within shape()."""
+        return self.getArray()[index]
     def get(self,survey,group,cohort,genotype,f):
-        try:
-            return self.v[f][survey][group][cohort][genotype]
-        except LookupError:
-            return 1e1000 - 1e0000 # NaN
+        i = (f,survey,group,cohort,genotype)
+        for x,n in zip(i,(self.nFiles,self.nSurveys,self.nGroups,self.nCohorts,self.nGenotypes)):
+            if x < 0 or x >= n:
+                return numpy.nan
+        return self.v[i]
     def getGroups(self):
         return list(range(0,self.nGroups))
     def getCohorts(self):
@@ -120,12 +541,276 @@ class MeasureDict(object):
     def getGenotypes(self):
         return list(range(0,self.nGenotypes))
 
+class Filter(object):
+    """A filter expression, compiled once and evaluated over whole columns.
+    
+    The expression may use the names f (file name), m (measure), s (survey),
+    g (group), c (cohort) and gt (genotype). Expressions using only these
+    names, constants, comparisons, 'in' lists, arithmetic and boolean
+    operators are evaluated as numpy masks; anything else is evaluated by
+    Python once per entry."""
+    names = ('f','m','s','g','c','gt')
+    compareOps = {
+        ast.Eq: operator.eq, ast.NotEq: operator.ne,
+        ast.Lt: operator.lt, ast.LtE: operator.le,
+        ast.Gt: operator.gt, ast.GtE: operator.ge,
+    }
+    binOps = {
+        ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+        ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    }
+    def __init__(self,expr):
+        self.expr = expr
+        self.code = compile(expr, '<filter>', 'eval')
+        self.tree = ast.parse(expr, mode='eval').body
+        self.vectorized = self.canVectorize(self.tree)
+    
+    def canVectorize(self,node):
+        if isinstance(node, ast.Constant):
+            return True
+        if isinstance(node, ast.Name):
+            return node.id in self.names
+        if isinstance(node, ast.BoolOp):
+            return all(self.canVectorize(x) for x in node.values)
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return self.canVectorize(node.operand)
+            return isinstance(node.op, (ast.USub, ast.UAdd)) and self.isNumeric(node.operand)
+        if isinstance(node, ast.BinOp):
+            return type(node.op) in self.binOps and self.isNumeric(node.left) and self.isNumeric(node.right)
+        if isinstance(node, ast.Compare):
+            if not self.canVectorize(node.left):
+                return False
+            for op, right in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    if not (isinstance(right, (ast.List, ast.Tuple, ast.Set)) and
+                            all(isinstance(x, ast.Constant) for x in right.elts)):
+                        return False
+                elif type(op) not in self.compareOps or not self.canVectorize(right):
+                    return False
+            return True
+        return False
+    
+    def isNumeric(self,node):
+        """True if node is a vectorizable number: arithmetic on strings (e.g.
+        repeating the file name f) is left to Python."""
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, (int, float)) and not isinstance(node.value, bool)
+        if isinstance(node, ast.Name):
+            return node.id in self.names and node.id != 'f'
+        return isinstance(node, (ast.BinOp, ast.UnaryOp)) and self.canVectorize(node)
+    
+    def evaluate(self,node,env):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            return env[node.id]
+        if isinstance(node, ast.BoolOp):
+            parts = [truth(self.evaluate(x, env)) for x in node.values]
+            combine = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+            return functools.reduce(combine, parts)
+        if isinstance(node, ast.UnaryOp):
+            x = self.evaluate(node.operand, env)
+            if isinstance(node.op, ast.Not):
+                return numpy.logical_not(truth(x))
+            return -x if isinstance(node.op, ast.USub) else x
+        if isinstance(node, ast.BinOp):
+            return self.binOps[type(node.op)](self.evaluate(node.left, env), self.evaluate(node.right, env))
+        # Compare; chains like 'a < b < c' are a conjunction of pairs
+        r = True
+        left = self.evaluate(node.left, env)
+        for op, right in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)):
+                values = [x.value for x in right.elts]
+                if isinstance(left, numpy.ndarray):
+                    x = numpy.isin(left, values)
+                else:
+                    x = left in values
+                if isinstance(op, ast.NotIn):
+                    x = numpy.logical_not(x)
+                right = values
+            else:
+                right = self.evaluate(right, env)
+                x = self.compareOps[type(op)](left, right)
+            r = numpy.logical_and(r, x)
+            left = right
+        return r
+    
+    def restriction(self,name,node=None):
+        """Return a set of values outside of which the variable name (e.g.
+        'm') never passes the filter, or None if there is no such set (or it
+        is not obvious from expressions like 'm in [...]' and 'm == ...')."""
+        if node is None:
+            node = self.tree
+        if isinstance(node, ast.BoolOp):
+            sets = [self.restriction(name, x) for x in node.values]
+            if isinstance(node.op, ast.And):
+                sets = [x for x in sets if x is not None]
+                return set.intersection(*sets) if sets else None
+            if any(x is None for x in sets):
+                return None
+            return set.union(*sets)
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            op = node.ops[0]
+            left, right = node.left, node.comparators[0]
+            if isinstance(right, ast.Name) and isinstance(op, ast.Eq):
+                left, right = right, left
+            if not (isinstance(left, ast.Name) and left.id == name):
+                return None
+            if isinstance(op, ast.Eq) and isinstance(right, ast.Constant):
+                return set([right.value])
+            if isinstance(op, ast.In) and isinstance(right, (ast.List, ast.Tuple, ast.Set)) and \
+                    all(isinstance(x, ast.Constant) for x in right.elts):
+                return set(x.value for x in right.elts)
+        return None
+    
+    def __call__(self,f,m,s,g,c,gt):
+        """Evaluate over the file name f and arrays m, s, g, c, gt; return a
+        boolean array."""
+        n = len(m)
+        if self.vectorized:
+            r = self.evaluate(self.tree, {'f':f, 'm':m, 's':s, 'g':g, 'c':c, 'gt':gt})
+            return numpy.array(numpy.broadcast_to(truth(r), (n,)))
+        return numpy.fromiter((bool(eval(self.code, globals(),
+                {'f':f, 'm':m1, 's':s1, 'g':g1, 'c':c1, 'gt':gt1}))
+                for m1,s1,g1,c1,gt1 in zip(m.tolist(),s.tolist(),g.tolist(),c.tolist(),gt.tolist())),
+                dtype=bool, count=n)
+
+def truth(x):
+    """Truth value of x, element-wise for arrays."""
+    if isinstance(x, numpy.ndarray):
+        return x.astype(bool)
+    return bool(x)
+
+class SparseMeasureDict(MeasureDict):
+    """Like MeasureDict, but storing only set cells, as sorted flat indices
+    (into the logical shape) and values. Suitable when few of the possible
+    (file, survey, group, cohort, genotype) combinations are used.
+    
+    Added values are buffered and only sorted and summed when queried."""
+    def __init__(self,m):
+        MeasureDict.__init__(self,m)
+        self.keys = numpy.empty(0, dtype=numpy.int64)
+        self.vals = numpy.empty(0)
+        self.keyShape = self.shape()    # shape keys were computed for
+        self.pending = list()           # list of (index, values) not yet in keys
+    @staticmethod
+    def fromDense(md):
+        r = SparseMeasureDict(0)
+        r.groupLabel = md.groupLabel
+        r.reserve(*md.shape())
+        (f,s,g,c,gt), values = md.coordinates()
+        r.addArrays(s,g,c,gt,f,values)
+        return r
+    def reserve(self,nFiles,nSurveys,nGroups,nCohorts,nGenotypes):
+        self.nFiles = max(self.nFiles,nFiles)
+        self.nSurveys = max(self.nSurveys,nSurveys)
+        self.nGroups = max(self.nGroups,nGroups)
+        self.nCohorts = max(self.nCohorts,nCohorts)
+        self.nGenotypes = max(self.nGenotypes,nGenotypes)
+    def add(self,survey,group,cohort,genotype,f,value):
+        self.addArrays([survey],[group],[cohort],[genotype],[f],numpy.array([value]))
+    def addArrays(self,survey,group,cohort,genotype,f,values):
+        n = len(values)
+        if n == 0:
+            return
+        index = numpy.array([numpy.broadcast_to(numpy.asarray(a,dtype=numpy.int64),(n,))
+                 for a in (f,survey,group,cohort,genotype)])
+        self.reserve(*(index.max(axis=1)+1).tolist())
+        self.pending.append((index, numpy.array(values, dtype=numpy.float64)))
+    def consolidate(self):
+        """Sort and sum pending values into keys and vals."""
+        shape = self.shape()
+        if not self.pending and shape == self.keyShape:
+            return
+        index = [numpy.array(numpy.unravel_index(self.keys, self.keyShape))] if len(self.keys) else []
+        index += [x[0] for x in self.pending]
+        values = numpy.concatenate([self.vals] + [x[1] for x in self.pending])
+        keys = numpy.ravel_multi_index(tuple(numpy.concatenate(index, axis=1)), shape) \
+            if index else numpy.empty(0, dtype=numpy.int64)
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = numpy.flatnonzero(numpy.diff(keys, prepend=-1))
+        self.keys = keys[starts]
+        self.vals = numpy.add.reduceat(values[order], starts) if len(starts) else values
+        self.keyShape = shape
+        self.pending = list()
+    def countSet(self):
+        self.consolidate()
+        return len(self.keys)
+    def coordinates(self):
+        self.consolidate()
+        return numpy.unravel_index(self.keys, self.keyShape), self.vals.copy()
+    def clearFile(self,f):
+        self.consolidate()
+        keep = numpy.unravel_index(self.keys, self.keyShape)[0] != f
+        self.keys = self.keys[keep]
+        self.vals = self.vals[keep]
+    def merge(self,other,fOffset):
+        (f,s,g,c,gt), values = other.coordinates()
+        self.addArrays(s,g,c,gt,f+fOffset,values)
+    def __getstate__(self):
+        self.consolidate()
+        return dict(self.__dict__)
+    def getArray(self):
+        """Return a dense copy of all values (see MeasureDict.getArray)."""
+        self.consolidate()
+        a = numpy.full(self.keyShape, numpy.nan)
+        a.reshape(-1)[self.keys] = self.vals
+        return a
+    def getSlice(self,index):
+        """Return getArray()[index] (see MeasureDict.getSlice) without making
+        a dense copy of all values."""
+        self.consolidate()
+        bounds = [(i, i+1) if not isinstance(i, slice) else i.indices(n)[:2]
+                  for i, n in zip(index, self.keyShape)]
+        strides = numpy.cumprod((self.keyShape + (1,))[:0:-1])[::-1]
+        # keys are sorted, so integer indices before the first slice select a
+        # contiguous range of keys
+        k = next((d for d, i in enumerate(index) if isinstance(i, slice)), len(index)-1)
+        lo = sum(int(b[0])*int(st) for b, st in zip(bounds[:k+1], strides))
+        hi = lo + max(0, bounds[k][1]-bounds[k][0]) * int(strides[k])
+        start, stop = numpy.searchsorted(self.keys, (lo, hi))
+        coords = numpy.unravel_index(self.keys[start:stop], self.keyShape)
+        keep = numpy.ones(stop-start, dtype=bool)
+        for d in range(k+1, len(index)):
+            keep &= (coords[d] >= bounds[d][0]) & (coords[d] < bounds[d][1])
+        dims = [d for d, i in enumerate(index) if isinstance(i, slice)]
+        vals = self.vals[start:stop][keep]
+        if not dims:
+            return vals[0] if len(vals) else numpy.float64(numpy.nan)
+        r = numpy.full([max(0, bounds[d][1]-bounds[d][0]) for d in dims], numpy.nan)
+        r[tuple(coords[d][keep] - bounds[d][0] for d in dims)] = vals
+        return r
+    def get(self,survey,group,cohort,genotype,f):
+        i = (f,survey,group,cohort,genotype)
+        for x,n in zip(i,self.shape()):
+            if x < 0 or x >= n:
+                return numpy.nan
+        self.consolidate()
+        key = numpy.ravel_multi_index(i, self.keyShape)
+        j = numpy.searchsorted(self.keys, key)
+        if j < len(self.keys) and self.keys[j] == key:
+            return self.vals[j]
+        return numpy.nan
+
+# Dense MeasureDicts which would have more than sparseMinCells cells, of which
+# fewer than a fraction sparseMaxDensity are used, are switched to sparse storage.
+sparseMinCells = 1<<24
+sparseMaxDensity = 0.1
+
 def stringIndexAllMatch(strs,ind,char):
     for s in strs:
         if s[ind] != char:
             return False
     return True
 
+# Version of the format written by ValDict.save
+SAVE_VERSION = 1
+
+# Keys corresponding to the dimensions of MeasureDict arrays
+arrayAxes = (Keys.FILE, Keys.SURVEY, Keys.GROUP, Keys.COHORT, Keys.GENOTYPE)
+
 class ValDict (object):
     """Class looking like a dictionary of outputs, but supporting aggregation
     and keeping lists of all keys.
@@ -135,69 +820,278 @@ class ValDict (object):
     def __init__(self,keys):
         self.aggregateKeys = Keys.all - keys
         self.nSurveys=0 # set to max survey number; indecies are +1
-        self.values=list() #key: measure number
+        self.values=list() #key: measure number; value: MeasureDict
         self.measures=set() #set of used measures
         self.files=list()
+        self.surveyTimes=None # time of each survey in days, if known (see surveyTimes)
+        self.generation=0 # incremented by clear (see OutputFollower)
+    
+    def read(self,fileName,filterExpr,exprDebug,workers=1):
+        """Read from fileName, keeping only entries for which the expression
+        filterExpr is true (see Filter). If exprDebug, print each evaluation.
+        
+        If workers is not 1, large files which are not cached are split into
+        byte ranges parsed by up to workers processes (default: one per
+        CPU)."""
+        fID = self.addFile(fileName)
+        flt = Filter(filterExpr)
+        
+        uncached = not hasattr(fileName, 'read') and \
+                (columnCache is None or columnCache.load(fileName) is None)
+        measures = flt.restriction('m')
+        surveys = flt.restriction('s')
+        if uncached and columnCache is not None and (measures is not None or surveys is not None):
+            # use the index to read only the parts of the file which can pass the filter
+            index = columnCache.load(fileName, 'index')
+            if index is not None:
+                for cols in iterIndexed(fileName,index,measures,surveys):
+                    self.addFiltered(fileName,fID,cols,flt,exprDebug)
+                return
+        
+        if uncached and workers != 1 and not exprDebug:
+            ranges = splitRanges(fileName, workers or os.cpu_count() or 1)
+            if len(ranges) > 1:
+                self.readRanges(fileName,fID,filterExpr,ranges)
+                return
+        
+        # Each chunk is filtered and added (aggregating keys) before the next
+        # is read, so memory depends on the output size, not the input size.
+        for cols in iterColumns(fileName):
+            self.addFiltered(fileName,fID,cols,flt,exprDebug)
+    
+    def addFile(self,fileName):
+        """Add fileName to the list of files and return its index (0 if files
+        are aggregated)."""
+        if Keys.FILE in self.aggregateKeys:
+            return 0
+        assert fileName not in self.files, "Reading same file twice?"
+        self.files.append(fileName)
+        return len(self.files) - 1
+    
+    def resetFile(self,fID):
+        """Remove all values read for file fID (used when a followed file is
+        truncated). Not possible when files are aggregated."""
+        if Keys.FILE in self.aggregateKeys:
+            raise Exception("cannot remove values of one file when files are aggregated")
+        for m in self.measures:
+            self.values[m].clearFile(fID)
+    
+    def clear(self):
+        """Remove all values read, keeping the list of files (used when a
+        followed file is truncated while files are aggregated; the other
+        files must then be read again)."""
+        for m in self.measures:
+            md = self.values[m]
+            for f in range(md.shape()[0]):
+                md.clearFile(f)
+        self.generation += 1
     
-    def read(self,fileName,filterExpr,exprDebug):
-        """Read from fileName. If measures is non-empty, only read these measures."""
-        def filterFun(f,m,s,g,c,gt):
-            r=eval(filterExpr)
-            if exprDebug:
-                print(("f="+str(f),"m="+str(m),"s="+str(s),"g="+str(g),"c="+str(c),"g="+str(g)+":",r))
-            return r
-        aKS = Keys.SURVEY in self.aggregateKeys
-        aKG = Keys.GROUP in self.aggregateKeys
-        aKC = Keys.COHORT in self.aggregateKeys
-        aKGT = Keys.GENOTYPE in self.aggregateKeys
-        if Keys.FILE not in self.aggregateKeys:
+    def readRanges(self,fileName,fID,filterExpr,ranges):
+        """Parse byte ranges of fileName in worker processes and add the
+        partial results as file fID."""
+        keys = Keys.all - self.aggregateKeys
+        nErrs = 0
+        with concurrent.futures.ProcessPoolExecutor(len(ranges)) as pool:
+            parts = pool.map(readRange, itertools.repeat(keys), itertools.repeat(fileName),
+                             itertools.repeat(filterExpr), ranges)
+            for part, n in parts:
+                nErrs += n
+                if nErrs>5:
+                    raise Exception ("Too many errors reading "+str(fileName))
+                self.mergeValues(part,fID)
+    
+    def readMany(self,fileNames,filterExpr,exprDebug,workers=1):
+        """Read each of fileNames as with read(). By default files are read
+        one after another in this process; otherwise they are parsed in up
+        to workers processes (0 or None: one per CPU), then merged in the
+        given order so that file numbering is the same as reading
+        sequentially. A single file is split as described for read()."""
+        if len(fileNames) == 1:
+            self.read(fileNames[0],filterExpr,exprDebug,workers)
+            return
+        if workers == 1 or exprDebug:
+            for fileName in fileNames:
+                self.read(fileName,filterExpr,exprDebug)
+            return
+        keys = Keys.all - self.aggregateKeys
+        with concurrent.futures.ProcessPoolExecutor(workers or None) as pool:
+            parts = pool.map(readPartial, itertools.repeat(keys), fileNames,
+                             itertools.repeat(filterExpr), itertools.repeat(columnCache))
+            for part in parts:
+                self.merge(part)
+
+    def readStore(self,dbName,names,filterExpr,exprDebug):
+        """Read files from the database dbName (see ensembleStore), selecting
+        files whose path or scenario is in names (all files if None), and
+        keeping only entries for which filterExpr is true."""
+        from openmalaria.tools.ensembleStore import EnsembleStore
+        flt = Filter(filterExpr)
+        measures = flt.restriction('m')
+        store = EnsembleStore(dbName)
+        try:
+            for dbID, fileName in store.findFiles(names):
+                fID = self.addFile(fileName)
+                m, s, g, c, gt, v = store.query(dbID, measures)
+                keep = flt(fileName,m,s,g,c,gt)
+                if exprDebug:
+                    for x in zip(m.tolist(),s.tolist(),g.tolist(),c.tolist(),gt.tolist(),keep.tolist()):
+                        print(("f="+str(fileName),"m="+str(x[0]),"s="+str(x[1]),"g="+str(x[2]),"c="+str(x[3]),"g="+str(x[2])+":",x[5]))
+                self.addColumns(fID,m[keep],s[keep],g[keep],c[keep],gt[keep],v[keep])
+        finally:
+            store.close()
+
+    @staticmethod
+    def fromStore(keys,dbName,names=None,filterExpr="True"):
+        """Return a new ValDict separating by keys, filled by readStore()."""
+        values = ValDict(keys)
+        values.readStore(dbName,names,filterExpr,False)
+        return values
+
+    def merge(self,other):
+        """Add all data from ValDict other, which must aggregate the same keys.
+        Files of other are appended after those of self (unless files are
+        aggregated, in which case values are summed like other aggregated
+        keys)."""
+        assert self.aggregateKeys == other.aggregateKeys, "merging ValDicts with different keys"
+        fOffset = len(self.files)
+        for fileName in other.files:
             assert fileName not in self.files, "Reading same file twice?"
-            fID = len(self.files)
             self.files.append(fileName)
+        self.mergeValues(other,fOffset)
+    
+    def save(self,fileObj,compress=False):
+        """Write all data to fileObj (a file name or binary file object) in a
+        compact, versioned format (a numpy .npz archive), for reading with
+        ValDict.load. A file name is used as given (no .npz suffix is
+        added). Files which are not names are saved as str(file)."""
+        header = {'format': 'openmalaria.tools.ValDict', 'version': SAVE_VERSION,
+                  'aggregateKeys': sorted(self.aggregateKeys), 'nSurveys': self.nSurveys,
+                  'files': [str(f) for f in self.files], 'measures': dict()}
+        if self.surveyTimes is not None:
+            header['surveyTimes'] = [float(t) for t in self.surveyTimes]
+        arrays = dict()
+        for m in sorted(self.measures):
+            md = self.values[m]
+            sparse = isinstance(md, SparseMeasureDict)
+            header['measures'][str(m)] = {'storage': 'sparse' if sparse else 'dense',
+                                          'shape': list(md.shape()), 'groupLabel': md.groupLabel}
+            if sparse:
+                md.consolidate()
+                arrays['keys'+str(m)] = md.keys
+                arrays['vals'+str(m)] = md.vals
+            else:
+                state = md.__getstate__()
+                arrays['v'+str(m)] = state['v']
+                arrays['isSet'+str(m)] = state['isSet']
+        arrays['header'] = numpy.frombuffer(json.dumps(header).encode('utf-8'), dtype=numpy.uint8)
+        savez = numpy.savez_compressed if compress else numpy.savez
+        if hasattr(fileObj, 'write'):
+            savez(fileObj, **arrays)
         else:
-            fID = 0
-        
-        if type(fileName) == StringIO or type(fileName) == BytesIO:
-            fileObj = fileName
-        else:
-            #give the existing approach a shot
-            fileObj = open(fileName, 'r')
-        nErrs=0
-        for line in fileObj:
-            items=line.split()
-            if (len(items) != 4):
-                print("expected 4 items on line; found (following line):")
-                print(line)
-                nErrs+=1
-                if nErrs>5:
-                    raise Exception ("Too many errors reading "+fileName)
-                continue
-            
-            m=int(items[2])
-            s=int(items[0])
-            g=int(items[1])
-            gt = g // 1000000 # genotype
-            g = g - 1000000*gt
-            c = g // 1000   # cohort
-            g = g - 1000*c
-            if not filterFun(fileName,m,s,g,c,gt):
-                continue
-            if aKS:
-                s=0
-            if aKG:
-                g=0
-            if aKC:
-                c=0
-            if aKGT:
-                gt=0
-            i=len(self.values)
-            while m >= i:
-                self.values.append(MeasureDict(m))
-                i+=1
-            self.measures.add(m)
-            self.nSurveys=max(self.nSurveys,s)
-            self.values[m].add(s,g,c,gt,fID,robustFloat(items[3]))
+            # numpy would append .npz to a name without it
+            with open(fileObj, 'wb') as f:
+                savez(f, **arrays)
+    
+    @staticmethod
+    def load(fileObj):
+        """Read a ValDict written by save()."""
+        with numpy.load(fileObj, allow_pickle=False) as data:
+            header = json.loads(bytes(data['header']).decode('utf-8'))
+            if header.get('format') != 'openmalaria.tools.ValDict' or header.get('version') != SAVE_VERSION:
+                raise Exception("not a saved ValDict or unsupported version")
+            values = ValDict(Keys.all - set(header['aggregateKeys']))
+            values.nSurveys = header['nSurveys']
+            values.files = header['files']
+            if 'surveyTimes' in header:
+                values.surveyTimes = numpy.array(header['surveyTimes'])
+            for key, info in header['measures'].items():
+                m = int(key)
+                while m >= len(values.values):
+                    values.values.append(MeasureDict(len(values.values)))
+                if info['storage'] == 'sparse':
+                    md = SparseMeasureDict(m)
+                    md.reserve(*info['shape'])
+                    md.keys = data['keys'+key]
+                    md.vals = data['vals'+key]
+                    md.keyShape = md.shape()
+                else:
+                    md = MeasureDict(m)
+                    md.__setstate__({'v': data['v'+key], 'isSet': data['isSet'+key]})
+                    md.nFiles, md.nSurveys, md.nGroups, md.nCohorts, md.nGenotypes = info['shape']
+                md.groupLabel = info['groupLabel']
+                values.values[m] = md
+                values.measures.add(m)
+        return values
+    
+    def mergeValues(self,other,fOffset):
+        """Add values (not file names) of other, offsetting file indices."""
+        i=len(self.values)
+        while len(other.values) > i:
+            self.values.append(MeasureDict(i))
+            i+=1
+        for m in other.measures:
+            o = other.values[m]
+            shape = (fOffset+o.nFiles,o.nSurveys,o.nGroups,o.nCohorts,o.nGenotypes)
+            self.storageFor(m,shape,o.countSet()).merge(o,fOffset)
+        self.measures |= other.measures
+        self.nSurveys=max(self.nSurveys,other.nSurveys)
+        if self.surveyTimes is None:
+            self.surveyTimes = other.surveyTimes
+    
+    def addFiltered(self,fileName,fID,cols,flt,exprDebug):
+        """Decode, filter and add an array of outputDtype read from fileName."""
+        m = cols['m']
+        s = cols['s']
+        g, c, gt = decodeGroups(cols['g'])
+        keep = flt(fileName,m,s,g,c,gt)
+        if exprDebug:
+            for x in zip(m.tolist(),s.tolist(),g.tolist(),c.tolist(),gt.tolist(),keep.tolist()):
+                print(("f="+str(fileName),"m="+str(x[0]),"s="+str(x[1]),"g="+str(x[2]),"c="+str(x[3]),"g="+str(x[2])+":",x[5]))
+        self.addColumns(fID,m[keep],s[keep],g[keep],c[keep],gt[keep],cols['v'][keep])
+    
+    def addColumns(self,fID,m,s,g,c,gt,v):
+        """Add values from (decoded) column arrays to file fID, aggregating
+        keys as required."""
+        if len(v) == 0:
+            return
+        if Keys.SURVEY in self.aggregateKeys:
+            s=0
+        if Keys.GROUP in self.aggregateKeys:
+            g=0
+        if Keys.COHORT in self.aggregateKeys:
+            c=0
+        if Keys.GENOTYPE in self.aggregateKeys:
+            gt=0
+        s, g, c, gt = numpy.broadcast_arrays(s, g, c, gt, m)[:4]
+        i=len(self.values)
+        while m.max() >= i:
+            self.values.append(MeasureDict(i))
+            i+=1
+        self.nSurveys=max(self.nSurveys,int(s.max()))
+        # group rows by measure; there are few measures but many rows
+        order = numpy.argsort(m, kind='stable')
+        bounds = numpy.flatnonzero(numpy.diff(m[order])) + 1
+        for part in numpy.split(order, bounds):
+            measure = int(m[part[0]])
+            self.measures.add(measure)
+            shape = (fID+1,int(s[part].max())+1,int(g[part].max())+1,int(c[part].max())+1,int(gt[part].max())+1)
+            md = self.storageFor(measure,shape,len(part))
+            md.addArrays(s[part],g[part],c[part],gt[part],fID,v[part])
     
+    def storageFor(self,m,shape,nNew):
+        """Return the MeasureDict for measure m, first switching it to sparse
+        storage if growing it to shape with up to nNew new cells would leave
+        it mostly empty."""
+        md = self.values[m]
+        if not isinstance(md, SparseMeasureDict):
+            cells = 1
+            for a,b in zip(shape, md.shape()):
+                cells *= max(a,b)
+            if cells > sparseMinCells and md.countSet() + nNew < cells * sparseMaxDensity:
+                md = SparseMeasureDict.fromDense(md)
+                self.values[m] = md
+        return md
+
     def getFiles(self):
         return list(range(len(self.files)))
     def getFileName(self,n):
@@ -231,6 +1125,15 @@ class ValDict (object):
             return [1]
         else:
             return list(range(1,self.nSurveys+1))
+    def getSurveyTimes(self,m):
+        """Times (in days from the start of monitoring) of the surveys
+        returned by getSurveys(m); NaN where unknown. Requires surveyTimes
+        to be set (see surveyTimes.attach)."""
+        surveys = numpy.array(self.getSurveys(m))
+        times = numpy.full(len(surveys), numpy.nan)
+        known = surveys <= len(self.surveyTimes)
+        times[known] = self.surveyTimes[surveys[known]-1]
+        return times
     def getAllGroups(self):
         groups=set()
         for x in self.values:
@@ -257,6 +1160,81 @@ class ValDict (object):
         if f==None:
             f=0
         return self.values[m].get(s,g,c,gt,f)
+    def axisRange(self,m,key):
+        """Return (start, stop) such that range(start, stop) are the indices
+        used for key (see Keys) by measure m, as returned by getSurveys,
+        getGroups, etc. or (0, 1) for aggregated keys."""
+        if key in self.aggregateKeys:
+            return (0, 1)
+        if key == Keys.FILE:
+            return (0, len(self.files))
+        if key == Keys.SURVEY:
+            surveys = self.getSurveys(m)
+            return (surveys[0], surveys[-1]+1) if surveys else (1, 1)
+        md = self.values[m]
+        if key == Keys.GROUP:
+            return (0, md.nGroups)
+        if key == Keys.COHORT:
+            return (0, md.nCohorts)
+        if key == Keys.GENOTYPE:
+            return (0, md.nGenotypes)
+        raise KeyError("no axis for key "+str(key))
+    def getArray(self,m,axis=Keys.SURVEY,fixed=None):
+        """Return the values of measure m along one or more axes.
+        
+        axis is a key (see Keys) or tuple of keys; the result has one
+        dimension per key, in the same order, covering the indices returned
+        by getSurveys(m), getGroups(m), etc. Other keys take the index given
+        in dict fixed (default 0, as with get). The result is a view of the
+        stored array where possible; missing cells are NaN."""
+        axes = tuple(axis) if isinstance(axis, (tuple, list)) else (axis,)
+        fixed = fixed or dict()
+        md = self.values[m]
+        mShape = md.shape()
+        index = list()
+        shape = list()
+        outside = False
+        for dim, key in enumerate(arrayAxes):
+            if key in axes:
+                start, stop = self.axisRange(m, key)
+                index.append(slice(min(start, mShape[dim]), min(stop, mShape[dim])))
+                shape.append(stop - start)
+            else:
+                i = fixed.get(key)
+                i = 0 if i is None else i
+                outside = outside or i < 0 or i >= mShape[dim]
+                index.append(i)
+        # only the requested cells are read: sparse measures are not densified
+        r = numpy.full(shape, numpy.nan) if outside else md.getSlice(tuple(index))
+        if r.shape != tuple(shape):
+            # this measure has fewer entries than others: pad with NaN
+            padded = numpy.full(shape, numpy.nan)
+            padded[tuple(slice(0, n) for n in r.shape)] = r
+            r = padded
+        inArrayOrder = [key for key in arrayAxes if key in axes]
+        return r.transpose([inArrayOrder.index(key) for key in axes])
+    def toArray(self,m):
+        """Return all values of measure m as an array indexed by
+        [file, survey, group, cohort, genotype] (a view, not a copy, unless
+        the measure uses sparse storage). Aggregated keys have length 1;
+        missing cells are NaN."""
+        return self.values[m].getArray()
+    def setArray(self,m,a,groupLabel=None):
+        """Store array a (shaped as returned by toArray) as measure m,
+        replacing any values of m. NaN cells are treated as missing."""
+        a = numpy.asarray(a, dtype=numpy.float64)
+        assert a.ndim == len(arrayAxes), "expected an array indexed by [file, survey, group, cohort, genotype]"
+        while m >= len(self.values):
+            self.values.append(MeasureDict(len(self.values)))
+        md = MeasureDict(m)
+        md.reserve(*a.shape)
+        md.v[:] = a
+        md.isSet[:] = ~numpy.isnan(a)
+        if groupLabel is not None:
+            md.groupLabel = groupLabel
+        self.values[m] = md
+        self.measures.add(m)
+        self.nSurveys = max(self.nSurveys, a.shape[1]-1)
 
 
 #http://stackoverflow.com/questions/2974124/reading-floating-point-numbers-with-1-qnan-values-in-python
@@ -270,23 +1248,460 @@ def robustFloat(s):
         else:
             raise
 
-def readEntries (fname):
-    """Return a dict of entries read from file. Keys have type Multi3Keys,
-    where a corresponds to measure, b to survey and c to group.
+# Columns of a survey output file, in file order: survey, group code,
+# measure, value. Group codes combine genotype*1000000 + cohort*1000 + group.
+outputDtype = numpy.dtype([('s',numpy.int32),('g',numpy.int64),('m',numpy.int32),('v',numpy.float64)])
+
+# Cache of parsed columns used by readColumns; set to None to disable.
+columnCache = ColumnCache()
+
+def decodeGroups(code):
+    """Split an array of group codes into (group, cohort, genotype) arrays."""
+    gt = code // 1000000
+    code = code - 1000000*gt
+    c = code // 1000
+    return code - 1000*c, c, gt
+
+def parseLines(text,name,nErrs=0,maxErrs=5):
+    """Parse text in the survey output format into an array of outputDtype.
     
-    Note: ValDict is probably more efficient due to use of arrays over dicts."""
-    values=dict()
-    fileObj = open(fname, 'r')
-    for line in fileObj:
+    Returns (array, nErrs), where nErrs is incremented for each malformed
+    line (those are printed and skipped). Raises when more than maxErrs errors
+    have been found in total (unless maxErrs is None)."""
+    if isinstance(text, bytes):
+        text = text.decode('latin-1')
+    nLines = text.count('\n')
+    if len(text) and text[-1] != '\n':
+        nLines += 1
+    if nLines == 0:
+        return numpy.empty(0, dtype=outputDtype), nErrs
+    try:
+        cols = numpy.loadtxt(StringIO(text), dtype=outputDtype, comments=None, ndmin=1)
+        if len(cols) == nLines:
+            return cols, nErrs
+    except ValueError:
+        pass
+    # Some line didn't parse (NaN spelt oddly, wrong number of items, blank
+    # line): go through line by line, as robustFloat does.
+    rows=list()
+    for line in text.splitlines(True):
         items=line.split()
         if (len(items) != 4):
             print("expected 4 items on line; found (following line):")
             print(line)
+            nErrs+=1
+            if maxErrs is not None and nErrs>maxErrs:
+                raise Exception ("Too many errors reading "+str(name))
             continue
-            
-        key=Multi3Keys(int(items[2]),int(items[0]),int(items[1]))
-        values[key]=robustFloat(items[3])
+        rows.append((int(items[0]),int(items[1]),int(items[2]),robustFloat(items[3])))
+    return numpy.array(rows, dtype=outputDtype), nErrs
+
+def iterChunks(fileObj,chunkSize=1<<24):
+    """Yield the content of fileObj in pieces of roughly chunkSize bytes,
+    each ending at the end of a line."""
+    while True:
+        chunk = fileObj.read(chunkSize)
+        if not chunk:
+            return
+        if chunk[-1:] not in ('\n', b'\n'):
+            chunk += fileObj.readline()
+        yield chunk
+
+# Minimum size of byte ranges when splitting one file between processes
+minRangeSize = 1<<24
+
+def splitRanges(fileName,n):
+    """Split fileName into at most n (start, stop) byte ranges, each at least
+    minRangeSize long (except the last) and starting at the start of a line.
+    Compressed files cannot be split."""
+    size = os.path.getsize(fileName)
+    if compressionOf(fileName) is not None:
+        return [(0, size)]
+    n = max(1, min(n, size // minRangeSize))
+    bounds = [0]
+    with open(fileName, 'rb') as f:
+        for i in range(1, n):
+            pos = size * i // n
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()        # move to the start of the next line
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Magic bytes at the start of compressed files, and modules to read them
+compressionFormats = [
+    (b'\x1f\x8b', gzip),
+    (b'BZh', bz2),
+    (b'\xfd7zXZ\x00', lzma),
+]
+
+def compressionOf(fileName):
+    """Return the module (gzip, bz2 or lzma) needed to decompress fileName,
+    or None if it is not compressed."""
+    with open(fileName, 'rb') as f:
+        magic = f.read(6)
+    for prefix, module in compressionFormats:
+        if magic.startswith(prefix):
+            return module
+    return None
+
+def openOutput(fileName):
+    """Open fileName for reading in binary mode, decompressing it on the fly
+    if it is compressed with gzip, bzip2 or xz. File objects (e.g. StringIO)
+    are returned as is."""
+    if hasattr(fileName, 'read'):
+        return fileName
+    module = compressionOf(fileName)
+    if module is not None:
+        return module.open(fileName, 'rb')
+    return open(fileName, 'rb')
+
+def iterColumns(fileName,maxErrs=5,chunkSize=1<<24,useCache=True):
+    """Read a survey output file in chunks of roughly chunkSize bytes,
+    yielding an array of outputDtype for each. Memory use depends on
+    chunkSize, not on the size of the file.
+    
+    Results for files on disk are stored in and loaded from columnCache
+    (memory mapped, hence read-only) when this is not None and useCache is
+    set. Files with malformed lines are not stored, so that reading them
+    again applies maxErrs again."""
+    cache = columnCache if useCache and not hasattr(fileName, 'read') else None
+    if cache is not None:
+        cols = cache.load(fileName)
+        if cols is not None:
+            step = max(1, chunkSize // outputDtype.itemsize)
+            for i in range(0, len(cols), step):
+                yield cols[i:i+step]
+            return
+    writer = cache.writer(fileName, outputDtype) if cache is not None else None
+    fileObj = openOutput(fileName)
+    # build an index (see iterIndexed) while we're at it, if we can seek in the file
+    runs = list() if cache is not None and compressionOf(fileName) is None else None
+    try:
+        nErrs = 0
+        offset = 0
+        nRows = 0
+        for chunk in iterChunks(fileObj, chunkSize):
+            cols, nErrs = parseLines(chunk, fileName, nErrs, maxErrs)
+            nRows += len(cols)
+            if writer is not None:
+                writer.append(cols)
+            if runs is not None:
+                runs.append(indexRuns(chunk, offset, cols))
+                offset += len(chunk)
+            yield cols
+        if writer is not None and nErrs == 0:
+            writer.commit()
+        if runs is not None:
+            runs = joinRuns(runs)
+            # an index of very short runs isn't worth using
+            if len(runs) * minIndexRun <= nRows:
+                cache.store(fileName, runs, 'index')
+    finally:
+        if writer is not None:
+            writer.abort()
+        if fileObj is not fileName:
+            fileObj.close()
+
+# Files are only indexed when runs are on average at least this many lines
+minIndexRun = 4
+
+# An index of a survey output file: runs of consecutive lines with the same
+# measure and survey, with their byte range. Runs with measure -1 contain
+# malformed lines.
+indexDtype = numpy.dtype([('m',numpy.int32),('s',numpy.int32),('start',numpy.int64),('stop',numpy.int64)])
+
+def indexRuns(chunk,offset,cols):
+    """Index the text chunk, found at byte offset in the file, given the
+    columns parsed from it. Returns an array of indexDtype."""
+    lineStarts = numpy.concatenate([[0], numpy.flatnonzero(numpy.frombuffer(chunk, numpy.uint8) == 10) + 1])
+    if lineStarts[-1] == len(chunk):
+        lineStarts = lineStarts[:-1]
+    if len(lineStarts) == len(cols):
+        m = cols['m']
+        s = cols['s']
+    else:
+        # some lines are malformed: find them again
+        m = numpy.full(len(lineStarts), -1, dtype=numpy.int32)
+        s = numpy.full(len(lineStarts), -1, dtype=numpy.int32)
+        for i, line in enumerate(chunk.splitlines()):
+            items = line.split()
+            try:
+                if len(items) == 4:
+                    m[i], s[i] = int(items[2]), int(items[0])
+            except ValueError:
+                pass
+    if len(m) == 0:
+        return numpy.empty(0, dtype=indexDtype)
+    first = numpy.concatenate([[0], numpy.flatnonzero((numpy.diff(m) != 0) | (numpy.diff(s) != 0)) + 1])
+    runs = numpy.empty(len(first), dtype=indexDtype)
+    runs['m'] = m[first]
+    runs['s'] = s[first]
+    runs['start'] = lineStarts[first] + offset
+    runs['stop'] = numpy.concatenate([lineStarts[first[1:]], [len(chunk)]]) + offset
+    return runs
+
+def joinRuns(parts):
+    """Concatenate arrays of indexDtype, joining adjacent runs with the same
+    measure and survey."""
+    runs = numpy.concatenate(parts) if parts else numpy.empty(0, dtype=indexDtype)
+    if len(runs) == 0:
+        return runs
+    same = (runs['m'][1:] == runs['m'][:-1]) & (runs['s'][1:] == runs['s'][:-1]) & \
+           (runs['start'][1:] == runs['stop'][:-1])
+    first = numpy.concatenate([[True], ~same])
+    last = numpy.concatenate([~same, [True]])
+    r = runs[first]
+    r['stop'] = runs['stop'][last]
+    return r
+
+def iterIndexed(fileName,index,measures=None,surveys=None,maxErrs=5,chunkSize=1<<24):
+    """Like iterColumns, but using index (see indexRuns) to read only lines
+    whose measure is in measures and survey in surveys (None: any)."""
+    keep = numpy.ones(len(index), dtype=bool)
+    if measures is not None:
+        keep &= numpy.isin(index['m'], list(measures))
+    if surveys is not None:
+        keep &= numpy.isin(index['s'], list(surveys))
+    runs = index[keep | (index['m'] < 0)]
+    if len(runs) == 0:
+        return
+    # merge runs which are contiguous in the file
+    split = numpy.flatnonzero(runs['start'][1:] != runs['stop'][:-1]) + 1
+    starts = runs['start'][numpy.concatenate([[0], split])]
+    stops = runs['stop'][numpy.concatenate([split - 1, [len(runs) - 1]])]
+    nErrs = 0
+    pieces = list()
+    size = 0
+    with open(fileName, 'rb') as fileObj:
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            # join the (often short) spans into chunks before parsing
+            for piece in iterRange(fileObj, start, stop, chunkSize):
+                pieces.append(piece)
+                size += len(piece)
+                if size >= chunkSize:
+                    cols, nErrs = parseLines(b''.join(pieces), fileName, nErrs, maxErrs)
+                    yield cols
+                    pieces = list()
+                    size = 0
+    if pieces:
+        cols, nErrs = parseLines(b''.join(pieces), fileName, nErrs, maxErrs)
+        yield cols
+
+def iterRange(fileObj,start,stop,chunkSize=1<<24):
+    """Like iterChunks, but only reading from byte start to stop (both at
+    the start of a line or the end of the file)."""
+    fileObj.seek(start)
+    while fileObj.tell() < stop:
+        chunk = fileObj.read(min(chunkSize, stop - fileObj.tell()))
+        if not chunk:
+            break
+        if chunk[-1:] != b'\n':
+            chunk += fileObj.readline()
+        yield chunk
+
+def readColumns(fileName,maxErrs=5,useCache=True):
+    """Read a whole survey output file into an array of outputDtype (see
+    iterColumns)."""
+    if useCache and columnCache is not None and not hasattr(fileName, 'read'):
+        cols = columnCache.load(fileName)
+        if cols is not None:
+            return cols
+    parts = list(iterColumns(fileName, maxErrs, useCache=useCache))
+    if len(parts) == 1:
+        return parts[0]
+    return numpy.concatenate(parts) if parts else numpy.empty(0, dtype=outputDtype)
+
+def readAndSave(keys,fileNames,filterExpr,outName,compress=False):
+    """Read fileNames into a new ValDict and save it to outName (see
+    ValDict.save). A compute node can use this to reduce its share of an
+    ensemble; results are combined with ValDict.load and ValDict.merge."""
+    values = ValDict(keys)
+    for fileName in fileNames:
+        values.read(fileName,filterExpr,False)
+    values.save(outName,compress)
+
+def readPartial(keys,fileName,filterExpr,cache):
+    """Read one file into a new ValDict, using cache as columnCache. This is
+    the unit of work of ValDict.readMany (run in a worker process)."""
+    global columnCache
+    columnCache = cache
+    values = ValDict(keys)
+    values.read(fileName,filterExpr,False)
     return values
 
+class OutputFollower(object):
+    """Reads lines appended to a survey output file (e.g. by a running
+    simulation) into a ValDict, parsing only the new data on each update.
+    
+    The byte offset read so far and any incomplete last line are
+    remembered. If the file is truncated or replaced (different inode), the
+    file's values are cleared and it is read again from the start. When files
+    are aggregated, one file's values can't be told apart, so all values are
+    cleared (see ValDict.clear) and every follower of the ValDict reads its
+    file again on its next update. Compressed files are not supported."""
+    def __init__(self,values,fileName,filterExpr="True",chunkSize=1<<24):
+        self.values = values
+        self.fileName = fileName
+        self.filter = Filter(filterExpr)
+        self.chunkSize = chunkSize
+        self.fID = values.addFile(fileName)
+        self.generation = values.generation
+        self.identity = None
+        self.offset = 0
+        self.partial = b''
+        self.nErrs = 0
+        self.measures = set()   # measures read by the last update; None if the file was read again
+    
+    def update(self):
+        """Read any newly appended complete lines; return the number of
+        entries read (before filtering)."""
+        self.measures = set()
+        try:
+            st = os.stat(self.fileName)
+        except FileNotFoundError:
+            return 0        # not (re)created yet
+        identity = (st.st_dev, st.st_ino)
+        cleared = self.generation != self.values.generation
+        if identity != self.identity or st.st_size < self.offset or cleared:
+            if self.identity is not None:
+                if cleared:
+                    pass    # values were cleared because of another file
+                elif Keys.FILE in self.values.aggregateKeys:
+                    self.values.clear()
+                else:
+                    self.values.resetFile(self.fID)
+                self.measures = None
+            self.generation = self.values.generation
+            self.identity = identity
+            self.offset = 0
+            self.partial = b''
+            self.nErrs = 0
+        n = 0
+        with open(self.fileName, 'rb') as fileObj:
+            fileObj.seek(self.offset)
+            while True:
+                data = fileObj.read(self.chunkSize)
+                if not data:
+                    break
+                self.offset += len(data)
+                data = self.partial + data
+                end = data.rfind(b'\n') + 1
+                self.partial = data[end:]
+                if end:
+                    cols, self.nErrs = parseLines(data[:end], self.fileName, self.nErrs)
+                    self.values.addFiltered(self.fileName,self.fID,cols,self.filter,False)
+                    if self.measures is not None:
+                        self.measures.update(numpy.unique(cols['m']).tolist())
+                    n += len(cols)
+        return n
+
+def readRange(keys,fileName,filterExpr,byteRange):
+    """Read byte range (start, stop) of fileName into a new ValDict, which has
+    no file names and uses file index 0. Returns the ValDict and the number
+    of malformed lines found. This is the unit of work of ValDict.readRanges."""
+    values = ValDict(keys)
+    flt = Filter(filterExpr)
+    start, stop = byteRange
+    nErrs = 0
+    with openOutput(fileName) as fileObj:
+        for chunk in iterRange(fileObj, start, stop):
+            cols, nErrs = parseLines(chunk, fileName, nErrs)
+            values.addFiltered(fileName,0,cols,flt,False)
+    return values, nErrs
+
+# Bit widths used to pack (measure, survey, group code) into one int64:
+# up to 1023 measures, 262143 surveys and group codes below 2^35 (genotypes
+# below 34359, see decodeGroups)
+packBits = (10, 18, 35)
+
+def packKeys(m,s,g):
+    """Pack arrays of measure, survey and group code into int64 keys which
+    sort in (measure, survey, group) order."""
+    m = numpy.asarray(m, dtype=numpy.int64)
+    s = numpy.asarray(s, dtype=numpy.int64)
+    g = numpy.asarray(g, dtype=numpy.int64)
+    for x, bits, name in zip((m,s,g), packBits, ("measure","survey","group")):
+        if x.size and (x.min() < 0 or x.max() >= 1<<bits):
+            raise ValueError(name+" out of range for packed keys")
+    return (m << (packBits[1]+packBits[2])) | (s << packBits[2]) | g
+
+def unpackKeys(keys):
+    """Inverse of packKeys: return (m, s, g) arrays."""
+    g = keys & ((1<<packBits[2])-1)
+    s = (keys >> packBits[2]) & ((1<<packBits[1])-1)
+    return keys >> (packBits[1]+packBits[2]), s, g
+
+class Entries(object):
+    """Values of an output file indexed by (measure, survey, group code).
+    
+    Stored as a sorted column of packed keys (see packKeys) and a column of
+    values; lookups use binary search. Also behaves like a read-only dict
+    with Multi3Keys keys (a: measure, b: survey, c: group code)."""
+    def __init__(self,m,s,g,v):
+        keys = packKeys(m,s,g)
+        order = numpy.argsort(keys, kind='stable')
+        keys = keys[order]
+        # where a key is repeated, keep the last value (as a dict would)
+        last = numpy.flatnonzero(numpy.diff(keys, append=-1))
+        self.packed = keys[last]
+        self.vals = numpy.asarray(v, dtype=numpy.float64)[order][last]
+    def lookup(self,m,s,g):
+        """Vectorised lookup: return the values for arrays m, s, g, with NaN
+        where there is no entry."""
+        keys = packKeys(m,s,g)
+        if len(self.packed) == 0:
+            return numpy.full(keys.shape, numpy.nan)
+        i = numpy.searchsorted(self.packed, keys)
+        i[i == len(self.packed)] = 0
+        return numpy.where(self.packed[i] == keys, self.vals[i], numpy.nan)
+    def index(self,key):
+        try:
+            packed = packKeys(key.a, key.b, key.c)
+        except (ValueError, TypeError):
+            raise KeyError(key)
+        i = numpy.searchsorted(self.packed, packed)
+        if i < len(self.packed) and self.packed[i] == packed:
+            return i
+        raise KeyError(key)
+    def __getitem__(self,key):
+        return float(self.vals[self.index(key)])
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    def __contains__(self,key):
+        try:
+            self.index(key)
+            return True
+        except KeyError:
+            return False
+    def __len__(self):
+        return len(self.packed)
+    def keys(self):
+        m, s, g = unpackKeys(self.packed)
+        return [Multi3Keys(*k) for k in zip(m.tolist(), s.tolist(), g.tolist())]
+    def __iter__(self):
+        return iter(self.keys())
+    def values(self):
+        return self.vals.tolist()
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+def readEntries (fname,useCache=True):
+    """Return an Entries object (which behaves like a dict with Multi3Keys
+    keys, where a corresponds to measure, b to survey and c to group) of
+    entries read from file.
+    
+    Note: ValDict is probably more efficient due to use of arrays over dicts."""
+    cols = readColumns(fname, maxErrs=None, useCache=useCache)
+    return Entries(cols['m'],cols['s'],cols['g'],cols['v'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+#
+# This file is part of the openmalaria.tools package.
+# For copyright and licensing information about this package, see the
+# NOTICE.txt and LICENSE.txt files in its top-level directory; they are
+# available at https://github.com/vecnet/openmalaria.tools
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License (MPL), version 2.0.  If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Times of surveys, read from the monitoring/surveys/surveyTime elements of a
+scenario XML file (including repeatStep and repeatEnd, as written by
+translateXML for schema 33).
+
+Times are in days from the start of the monitoring period, rounded to whole
+time steps; survey n (numbered from 1 as in output files) is at index n-1.
+"""
+
+import datetime
+import hashlib
+import os
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+from io import StringIO
+
+import numpy
+
+from openmalaria.tools import readOutput
+from openmalaria.tools.outputCache import ColumnCache
+from openmalaria.tools.readOutput import Keys, ValDict
+
+daysPerYear = 365
+
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def parseDate(text):
+    return datetime.date(*[int(x) for x in text.split('-')])
+
+def parseTime(text, interval, startDate=None):
+    """Convert an OpenMalaria time (e.g. '5t', '30d', '1.5y', '2000-01-01' or
+    a plain number of time steps) to days."""
+    text = text.strip()
+    if text.count('-') == 2:
+        if startDate is None:
+            raise ValueError("time " + text + " is a date but monitoring has no startDate")
+        return float((parseDate(text) - startDate).days)
+    unit = text[-1:]
+    if unit == 'y':
+        return float(text[:-1]) * daysPerYear
+    if unit == 'd':
+        return float(text[:-1])
+    if unit == 't':
+        text = text[:-1]
+    return float(text) * interval
+
+def readSurveyTimes(fileName):
+    """Parse the survey schedule of scenario fileName (a name or file
+    object). The document is streamed and discarded as it is read, so large
+    scenarios are cheap."""
+    specs = list()      # (time, repeatStep, repeatEnd) strings
+    interval = 5
+    startDate = None
+    path = list()
+    for event, elem in ET.iterparse(fileName, events=('start', 'end')):
+        if event == 'start':
+            path.append(localName(elem.tag))
+            if path[1:] == ['monitoring'] and elem.get('startDate'):
+                startDate = parseDate(elem.get('startDate'))
+            continue
+        if path[1:] == ['monitoring', 'surveys', 'surveyTime']:
+            specs.append((elem.text, elem.get('repeatStep'), elem.get('repeatEnd')))
+        elif path[1:] == ['model', 'parameters']:
+            interval = int(elem.get('interval', interval))
+        path.pop()
+        if len(path) == 1:
+            elem.clear()
+
+    steps = list()
+    for time, step, end in specs:
+        start = round(parseTime(time, interval, startDate) / interval)
+        if step is None:
+            steps.append(numpy.array([start]))
+        else:
+            stride = round(parseTime(step, interval) / interval)
+            stop = round(parseTime(end, interval, startDate) / interval)
+            steps.append(numpy.arange(start, stop, max(stride, 1)))
+    steps = numpy.unique(numpy.concatenate(steps)) if steps else numpy.empty(0)
+    return steps.astype(numpy.float64) * interval
+
+def scenarioHash(fileName, block=1<<20):
+    h = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            h.update(data)
+    return h.hexdigest()
+
+# Survey times by scenario hash, for this process
+memo = dict()
+
+def surveyTimes(fileName):
+    """Survey times of scenario fileName, cached by the hash of its contents
+    (in memory) and in readOutput.columnCache (on disk, if enabled)."""
+    h = scenarioHash(fileName)
+    if h not in memo:
+        cache = readOutput.columnCache
+        times = cache.load(fileName, 'surveyTimes') if cache is not None else None
+        if times is None:
+            times = readSurveyTimes(fileName)
+            if cache is not None:
+                cache.store(fileName, times, 'surveyTimes')
+        memo[h] = numpy.array(times)
+    return memo[h]
+
+def attach(values, fileName):
+    """Set the survey times of ValDict values from scenario fileName."""
+    values.surveyTimes = surveyTimes(fileName)
+    return values.surveyTimes
+
+def annual(values, m):
+    """Sum measure m over the surveys in each year of monitoring (year 0
+    includes surveys at times in (0, 365] days, etc.). Returns (years,
+    array) where array is as ValDict.toArray(m) but with one entry per year
+    on the survey axis; NaN where no survey in a year has a value.
+    Requires values.surveyTimes."""
+    if Keys.SURVEY in values.aggregateKeys:
+        raise Exception("surveys are aggregated")
+    a = values.toArray(m)[:, 1:]
+    n = min(a.shape[1], len(values.surveyTimes))
+    a = a[:, :n]
+    year = numpy.ceil(values.surveyTimes[:n] / daysPerYear).astype(numpy.int64) - 1
+    starts = numpy.flatnonzero(numpy.diff(year, prepend=year[0]-1))
+    isSet = ~numpy.isnan(a)
+    sums = numpy.add.reduceat(numpy.where(isSet, a, 0.0), starts, axis=1)
+    counts = numpy.add.reduceat(isSet, starts, axis=1)
+    return year[starts], numpy.where(counts > 0, sums, numpy.nan)
+
+class TestSurveyTimes (unittest.TestCase):
+    scenario = """<?xml version="1.0" encoding="UTF-8"?>
+<om:scenario xmlns:om="http://openmalaria.org/schema/scenario_33" name="x" schemaVersion="33">
+  <demography/>
+  <monitoring name="m" startDate="2000-01-01">
+    <SurveyOptions/>
+    <surveys diagnostic="standard">
+      <surveyTime>0.5y</surveyTime>
+      <surveyTime repeatStep="1y" repeatEnd="3.5y">1.0y</surveyTime>
+      <surveyTime>2000-01-31</surveyTime>
+      <surveyTime>73</surveyTime>
+    </surveys>
+  </monitoring>
+  <interventions name="i"/>
+  <model><parameters interval="5"/></model>
+</om:scenario>"""
+    def testRead (self):
+        times = readSurveyTimes(StringIO(self.scenario))
+        self.assertEqual (list(times), [30.0, 180.0, 365.0, 730.0, 1095.0])
+    def testAnnual (self):
+        values = ValDict(set([Keys.MEASURE, Keys.SURVEY]))
+        values.read(StringIO("".join("%d\t0\t0\t%d\n" % (s, s) for s in range(1, 6))), "True", False)
+        values.surveyTimes = readSurveyTimes(StringIO(self.scenario))
+        self.assertEqual (list(values.getSurveyTimes(0)), [30.0, 180.0, 365.0, 730.0, 1095.0])
+        years, a = annual(values, 0)
+        self.assertEqual (list(years), [0, 1, 2])
+        self.assertEqual (list(a[0, :, 0, 0, 0]), [6.0, 4.0, 5.0])
+    def testCache (self):
+        with tempfile.TemporaryDirectory() as d:
+            name = os.path.join(d, "scenario.xml")
+            with open(name, 'w') as f:
+                f.write(self.scenario)
+            memo.clear()
+            old = readOutput.columnCache
+            readOutput.columnCache = ColumnCache(os.path.join(d, "cache"))
+            try:
+                values = ValDict(set([Keys.MEASURE]))
+                self.assertEqual (len(attach(values, name)), 5)
+                self.assertTrue (scenarioHash(name) in memo)
+                self.assertEqual (len(readOutput.columnCache.load(name, 'surveyTimes')), 5)
+            finally:
+                readOutput.columnCache = old
+
+if __name__ == '__main__':
+    unittest.main()